@@ -0,0 +1,1454 @@
+"""
+Benchmarks and checks that run against a scratch database built from the
+Chicago sample data, without going through the web server. The shards and
+startup commands are the exceptions: they start local server processes.
+
+Run from the server directory, e.g. `python3 bench.py plans --copies 20`.
+"""
+import argparse
+import functools
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import shutil
+import string
+import subprocess
+import urllib.request
+from collections import OrderedDict
+
+from db import DB
+from db import CACHED_STATEMENTS
+from db import dict_factory
+from db import add_trace_callback
+import plans
+from shards import shard_for_zip
+from search import MAX_RESULTS
+import stats
+
+DEFAULT_DATA = os.path.join("..", "data", "chicago-1k.json.gz")
+
+
+def read_records(data_file):
+    opener = gzip.open if data_file.endswith(".gz") else open
+    with opener(data_file, "rt") as f:
+        return json.load(f)
+
+
+def build_database(db_file, data_file, copies, **connect_args):
+    """
+    Creates a fresh database and loads `copies` copies of the sample data.
+    Every copy gets its own inspection ids and restaurant names so the
+    tables grow with the number of copies.
+
+    Returns: the open connection, opened with connect_args.
+    """
+    conn = sqlite3.connect(db_file, **connect_args)
+    conn.row_factory = dict_factory
+    db = DB(conn)
+    db.create_script()
+    records = read_records(data_file)
+    for copy in range(copies):
+        for record in records:
+            record = dict(record)
+            record["inspection_id"] = "%s-%d" % (record["inspection_id"], copy)
+            if copy:
+                record["name"] = "%s %d" % (record["name"], copy)
+            db.ingest_inspection(record)
+    db.commit()
+    return conn
+
+
+def sample_inputs(conn):
+    """
+    Picks an existing restaurant, inspection and location to query with.
+    """
+    c = conn.cursor()
+    row = c.execute("""SELECT i.id AS inspection_id, r.id AS restaurant_id,
+                       r.name, r.address, r.latitude, r.longitude
+                       FROM ri_inspections AS i JOIN ri_restaurants AS r
+                       ON i.restaurant_id == r.id
+                       WHERE r.latitude IS NOT NULL LIMIT 1""").fetchone()
+    c.close()
+    return row
+
+
+# DB calls made on every request; none of these may scan a whole table.
+HOT_PATH = [
+    ("find_restaurant",
+        lambda db, s: db.find_restaurant(s["restaurant_id"])),
+    ("find_inspection",
+        lambda db, s: db.find_inspection(s["inspection_id"])),
+    ("find_inspections",
+        lambda db, s: db.find_inspections(s["restaurant_id"])),
+    ("find_restaurant_by_name_adress",
+        lambda db, s: db.find_restaurant_by_name_adress(s["name"], s["address"])),
+    ("find_restaurant_by_inspection_id",
+        lambda db, s: db.find_restaurant_by_inspection_id(s["inspection_id"])),
+    ("find_tweets_by_restaurant",
+        lambda db, s: db.find_tweets_by_restaurant(s["restaurant_id"])),
+    ("match_by_name",
+        lambda db, s: db.match_by_name([s["name"].lower(), "pizza"])),
+    ("match_by_geo",
+        lambda db, s: db.match_by_geo(float(s["latitude"]),
+                                      float(s["longitude"]))),
+    ("find_primary_restaurant",
+        lambda db, s: db.find_primary_restaurant(s["restaurant_id"])),
+    ("find_linked_restaurants",
+        lambda db, s: db.find_linked_restaurants(s["restaurant_id"])),
+    ("find_cluster",
+        lambda db, s: db.find_cluster(s["restaurant_id"])),
+    ("find_all_restaurants_by_inspection_id",
+        lambda db, s: db.find_all_restaurants_by_inspection_id(s["inspection_id"])),
+    ("get_candidates_within_block",
+        lambda db, s: db.get_candidates_within_block(db.block_chunks(4)[0])),
+    ("inspection_stats",
+        lambda db, s: db.inspection_stats(["zip", "month"])),
+    ("tweet_stats",
+        lambda db, s: db.tweet_stats(20)),
+    ("restaurant_tweet_stats",
+        lambda db, s: db.restaurant_tweet_stats(s["restaurant_id"])),
+]
+
+
+def check_plans(config):
+    """
+    Builds a benchmark-sized database, runs every hot-path DB call with
+    plan auditing on, and fails if any of them does a full table scan.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_database(os.path.join(tmp, "bench.db"), config.data,
+                              config.copies)
+        count = conn.execute("SELECT COUNT(id) AS cnt FROM ri_restaurants").fetchone()
+        print("Restaurants loaded: %d" % count["cnt"])
+        sample = sample_inputs(conn)
+        auditor = plans.attach(conn)
+        db = DB(conn)
+        failures = 0
+        for name, call in HOT_PATH:
+            call(db, sample)
+            for entry in auditor.flush(conn):
+                status = "SCAN" if entry["scans"] else "ok"
+                print("%-38s %-4s %s" % (name, status, "; ".join(entry["plan"])))
+                if entry["scans"]:
+                    failures += 1
+        conn.close()
+    if failures:
+        print("%d hot-path statement(s) regressed to a full table scan" % failures)
+        return 1
+    print("All hot-path statements use an index")
+    return 0
+
+
+def wsgi_get(app, path, query=""):
+    """
+    Calls a GET route of a Bottle app directly through WSGI.
+
+    Returns: the response body.
+    """
+    return wsgi_call(app, "GET", path, query)
+
+
+def wsgi_post(app, path, data):
+    """
+    POSTs data as JSON to a route of a Bottle app through WSGI.
+
+    Returns: the response body.
+    """
+    return wsgi_call(app, "POST", path, body=json.dumps(data).encode("utf-8"))
+
+
+def wsgi_call(app, method, path, query="", body=b""):
+    environ = {"REQUEST_METHOD": method, "PATH_INFO": path,
+               "QUERY_STRING": query, "SERVER_NAME": "bench",
+               "SERVER_PORT": "0", "SERVER_PROTOCOL": "HTTP/1.1",
+               "CONTENT_TYPE": "application/json",
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(body),
+               "wsgi.errors": sys.stderr}
+    status = []
+    body = b"".join(app(environ, lambda s, headers: status.append(s)))
+    if not status[0].startswith(("200", "201", "202")):
+        raise RuntimeError("%s returned %s" % (path, status[0]))
+    return body
+
+
+def time_calls(fn, repeat):
+    """
+    Returns the best of three average times of `repeat` calls to fn.
+    """
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = (time.perf_counter() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_json(config):
+    """
+    Times GET /restaurants/<id> for a restaurant with many inspections,
+    with the stdlib encoder and dict rows (the original behaviour), the
+    fast encoder and dict rows, and the fast encoder and tuple rows.
+    """
+    import bottle
+    import fastjson
+    import server
+
+    records = read_records(config.data)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        conn.row_factory = dict_factory
+        db = DB(conn)
+        db.create_script()
+        db.add_restaurant(records[0])
+        restaurant_id = db.find_restaurant_by_name_adress(
+            records[0]["name"], records[0]["address"], False)["id"]
+        for i in range(config.inspections):
+            record = dict(records[i % len(records)])
+            record["inspection_id"] = "bench-%d" % i
+            db.add_inspection(record, restaurant_id)
+        db.commit()
+
+        server.app.db_connection = conn
+        server.app.response_cache.ttl = 0
+        path = "/restaurants/%d" % restaurant_id
+        print("Encoder: %s, %d inspections" % (
+            "orjson" if fastjson.orjson else "json", config.inspections))
+        runs = [("stdlib json, dict rows", bottle.json_dumps, ""),
+                ("fast json, dict rows", fastjson.dumps, ""),
+                ("fast json, tuple rows", fastjson.dumps, "rows=tuples")]
+        for label, json_dumps, query in runs:
+            fastjson.install(server.app, json_dumps)
+            size = len(wsgi_get(server.app, path, query))
+            seconds = time_calls(lambda: wsgi_get(server.app, path, query),
+                                 config.repeat)
+            print("%-24s %8.2f ms  %9d bytes" % (label, seconds * 1000, size))
+        fastjson.install(server.app)
+        conn.close()
+    return 0
+
+
+def bench_clean(config):
+    """
+    Times GET /clean on a copy of a freshly built database, once plainly
+    and once under tracemalloc to report peak Python memory. The second run
+    starts with the similarity scores memoized by the first.
+    """
+    import server
+    from scoring import SimilarityCache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.db")
+        build_database(source, config.data, config.copies).close()
+        server.app.scaling = config.scaling
+        server.app.response_cache.ttl = 0
+        server.app.similarity_cache = SimilarityCache()
+        for traced in (False, True):
+            db_file = os.path.join(tmp, "clean.db")
+            shutil.copyfile(source, db_file)
+            conn = sqlite3.connect(db_file)
+            conn.row_factory = dict_factory
+            server.app.db_connection = conn
+            count = conn.execute("SELECT COUNT(id) AS cnt FROM ri_restaurants").fetchone()["cnt"]
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            wsgi_get(server.app, "/clean", config.query)
+            seconds = time.perf_counter() - start
+            if traced:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print("peak memory %.1f MiB" % (peak / 2 ** 20))
+            else:
+                print("%d restaurants, %s clean: %.3f s, %d clusters" % (
+                    count, config.query or ("blocking" if config.scaling else "full"),
+                    seconds, conn.execute("SELECT COUNT(*) AS cnt FROM ri_clusters").fetchone()["cnt"]))
+                print("scoring", json.dumps(server.app.clean_stats))
+            cache = server.app.similarity_cache.stats()
+            print("similarity cache: %d hits, %d misses, %d entries" % (
+                cache["hits"], cache["misses"], cache["size"]))
+            conn.close()
+            os.remove(db_file)
+    return 0
+
+
+def bench_txn(config):
+    """
+    Replays the sample inspections through POST /inspections under
+    several /txn commit policies, reporting throughput and how long
+    records waited to be committed.
+    """
+    import server
+
+    records = read_records(config.data)[:config.records]
+    gap = 1.0 / config.rate if config.rate else 0
+    print("%d inspections%s" % (len(records),
+          ", %d per second" % config.rate if config.rate else ""))
+    print("%8s %8s %12s %8s %22s %10s %10s" % ("N", "T (ms)", "records/s",
+          "commits", "size/timer/manual", "avg wait", "max wait"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for policy in config.policies.split(","):
+            size, ms = (policy.split(":") + ["0"])[:2]
+            db_file = os.path.join(tmp, "txn.db")
+            conn = sqlite3.connect(db_file, check_same_thread=False)
+            conn.row_factory = dict_factory
+            DB(conn).create_script()
+            server.app.db_connection = conn
+            wsgi_get(server.app, "/txn/%s" % size, "ms=%s" % ms)
+            server.app.group_commit.reset_stats()
+            start = time.perf_counter()
+            for record in records:
+                wsgi_post(server.app, "/inspections", record)
+                if gap:
+                    time.sleep(gap)
+            wsgi_get(server.app, "/commit")
+            seconds = time.perf_counter() - start
+            stats = server.app.group_commit.stats()
+            commits = stats["commits"]
+            print("%8s %8s %12.0f %8d %22s %8.1fms %8.1fms" % (
+                size, ms, len(records) / seconds, sum(commits.values()),
+                "%d/%d/%d" % (commits["size"], commits["timer"], commits["manual"]),
+                stats["avg_wait"] * 1000, stats["max_wait"] * 1000))
+            wsgi_get(server.app, "/txn/1")
+            conn.close()
+            os.remove(db_file)
+    return 0
+
+
+def lookup_ingest(db, record):
+    """
+    The ingest POST /inspections did before DB.ingest_inspection: look the
+    inspection and restaurant up, then insert what is missing.
+    """
+    restaurant = db.find_restaurant_by_name_adress(record["name"],
+                                                   record["address"], False)
+    if db.find_inspection(record["inspection_id"]) is not None:
+        return restaurant, "duplicate"
+    outcome = "added"
+    if restaurant is None:
+        db.add_restaurant(record)
+        restaurant = db.find_restaurant_by_name_adress(record["name"],
+                                                       record["address"], False)
+        outcome = "created"
+    db.add_inspection(record, restaurant["id"])
+    return restaurant, outcome
+
+
+def bench_ingest(config):
+    """
+    Loads the sample inspections, then new inspections of the same
+    restaurants, then the first records again as repeats, with the
+    lookup-then-insert ingest and with DB.ingest_inspection, reporting
+    throughput and SQL statements per record. Both must give the same
+    restaurant ids and outcomes.
+    """
+    records = []
+    for copy in range(config.copies):
+        for record in read_records(config.data):
+            record["inspection_id"] = "%s-%d" % (record["inspection_id"], copy)
+            if copy:
+                record["name"] = "%s %d" % (record["name"], copy)
+            records.append(record)
+    known = [dict(record, inspection_id=record["inspection_id"] + "-known")
+             for record in records]
+    passes = (("new", records), ("known", known), ("repeat", records))
+    ingests = [("lookup", lookup_ingest),
+               ("upsert", lambda db, record: db.ingest_inspection(record))]
+    print("%d records, best of %d runs" % (len(records), config.repeat))
+    print("%8s %8s %12s %12s" % ("ingest", "pass", "records/s",
+                                 "statements"))
+    best = {}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in range(config.repeat):
+            for name, ingest in ingests:
+                db_file = os.path.join(tmp, "ingest.db")
+                conn = sqlite3.connect(db_file)
+                conn.row_factory = dict_factory
+                db = DB(conn)
+                db.create_script()
+                statements = []
+                # Statements run inside FTS5 or triggers are traced with a
+                # "--" prefix; only count the ones DB issues.
+                add_trace_callback(conn, lambda statement: statement.startswith("--")
+                                   or statements.append(statement))
+                results[name] = []
+                for label, batch in passes:
+                    del statements[:]
+                    start = time.perf_counter()
+                    for record in batch:
+                        results[name].append(ingest(db, record))
+                    db.commit()
+                    seconds = time.perf_counter() - start
+                    # The last statement is the commit.
+                    rate = (len(batch) / seconds,
+                            (len(statements) - 1) / len(batch))
+                    best[name, label] = max(best.get((name, label), rate), rate)
+                conn.close()
+                os.remove(db_file)
+    for name, ingest in ingests:
+        for label, batch in passes:
+            print("%8s %8s %12.0f %12.2f" % ((name, label) + best[name, label]))
+    if results["lookup"] != results["upsert"]:
+        print("ingests disagree")
+        return 1
+    return 0
+
+
+class CountingConnection(sqlite3.Connection):
+    """
+    Connection that replays sqlite3's statement cache (an LRU of
+    cached_statements entries keyed on the SQL text) to count its hits and
+    misses, which the sqlite3 module does not expose.
+    """
+    def __init__(self, *args, cached_statements=128, **kwargs):
+        super().__init__(*args, cached_statements=cached_statements, **kwargs)
+        self.cache_size = cached_statements
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, sql):
+        if sql in self.statements:
+            self.statements.move_to_end(sql)
+            self.hits += 1
+            return
+        self.misses += 1
+        if self.cache_size:
+            self.statements[sql] = None
+            if len(self.statements) > self.cache_size:
+                self.statements.popitem(last=False)
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or CountingCursor)
+
+    def execute(self, sql, parameters=()):
+        self.record(sql)
+        return super().execute(sql, parameters)
+
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        self.connection.record(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.connection.record(sql)
+        return super().executemany(sql, seq_of_parameters)
+
+
+def bench_statements(config):
+    """
+    Runs ingest, the hot-path reads, tweet matching and a blocking clean
+    with several statement cache sizes, reporting the cache hit rate and
+    the time taken.
+    """
+    sizes = [int(size) for size in config.sizes.split(",")]
+    print("%8s %10s %10s %10s %10s" % ("cache", "executes", "distinct",
+                                         "hit rate", "seconds"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            db_file = os.path.join(tmp, "statements.db")
+            start = time.perf_counter()
+            conn = build_database(db_file, config.data, config.copies,
+                                  factory=CountingConnection,
+                                  cached_statements=size)
+            db = DB(conn)
+            rows = conn.execute("""SELECT i.id AS inspection_id,
+                                r.id AS restaurant_id, r.name, r.address,
+                                r.latitude, r.longitude
+                                FROM ri_inspections AS i JOIN ri_restaurants AS r
+                                ON i.restaurant_id == r.id
+                                WHERE r.latitude IS NOT NULL
+                                LIMIT ?""", [config.samples]).fetchall()
+            for sample in rows:
+                for name, call in HOT_PATH:
+                    call(db, sample)
+                words = sample["name"].lower().split()
+                db.match_by_name([" ".join(words[:n])
+                                  for n in range(1, len(words) + 1)])
+            for chunk in db.block_chunks(4):
+                for restaurant in db.match_with_blocking(chunk, 0.7):
+                    db.gen_aut_restaurant(restaurant)
+            seconds = time.perf_counter() - start
+            executes = conn.hits + conn.misses
+            distinct = len(conn.statements) if size else conn.misses
+            print("%8d %10d %10s %9.1f%% %10.3f" % (
+                size, executes, distinct if size >= distinct else ">%d" % size,
+                100.0 * conn.hits / executes, seconds))
+            conn.close()
+            os.remove(db_file)
+    return 0
+
+
+def http_call(url, body=None):
+    """
+    Returns: (status, body) of a GET, or of a POST of body as JSON.
+    """
+    if body is not None:
+        body = json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=body)
+    req.add_header("Content-Type", "application/json")
+    try:
+        with urllib.request.urlopen(req, timeout=600) as rv:
+            return rv.status, rv.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def start_server(port, *args):
+    """
+    Starts server.py on port and waits until it answers /hello.
+    """
+    process = subprocess.Popen([sys.executable, "server.py", "--port", str(port),
+                                "--cache-ttl", "0"] + list(args),
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            http_call("http://localhost:%d/hello" % port)
+            return process
+        except Exception:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server on port %d did not start" % port)
+
+
+def post_inspection(urls, record):
+    """
+    POSTs an inspection to the one url, or to its shard's when urls has
+    one per shard.
+
+    Returns: the status.
+    """
+    url = urls[0]
+    if len(urls) > 1:
+        url = urls[shard_for_zip(record["zip"], len(urls))]
+    return http_call(url + "/inspections", record)[0]
+
+
+def run_deployment(config, tmp, num_shards, records, direct=False):
+    """
+    Starts one server (num_shards 0) or num_shards shard servers behind
+    a router, ingests records with config.clients concurrent clients,
+    checks the routed reads and runs a blocking clean. With direct set
+    the clients post each inspection to its shard, as shards.shard_for_zip
+    picks it, rather than through the router.
+
+    Returns: a dict of results.
+    """
+    processes = []
+    try:
+        if num_shards == 0:
+            db_files = [os.path.join(tmp, "single.db")]
+            processes.append(start_server(config.port, "--database",
+                                          db_files[0]))
+        else:
+            db_files = [os.path.join(tmp, "shard-%d.db" % i)
+                        for i in range(num_shards)]
+            urls = []
+            for i, db_file in enumerate(db_files):
+                port = config.port + 1 + i
+                processes.append(start_server(port, "--database", db_file,
+                                              "--shard-id", str(i)))
+                urls.append("http://localhost:%d" % port)
+            processes.append(start_server(config.port, "--shards",
+                                          ",".join(urls)))
+        base = "http://localhost:%d" % config.port
+        http_call(base + "/create")
+        http_call(base + "/txn/%d" % config.txn)
+        targets = urls if direct else [base]
+        start = time.perf_counter()
+        with multiprocessing.Pool(config.clients) as pool:
+            statuses = pool.map(functools.partial(post_inspection, targets),
+                                records, chunksize=16)
+        http_call(base + "/commit")
+        ingest = time.perf_counter() - start
+        failed = sum(1 for status in statuses if status not in (200, 201))
+        count = int(http_call(base + "/count")[1])
+
+        routed = 0
+        sample = [record for record in records
+                  if record["latitude"]][::max(1, len(records) // 50)]
+        for record in sample:
+            status, body = http_call(base + "/restaurants/by-inspection/%s"
+                                     % record["inspection_id"])
+            restaurant = json.loads(body)
+            status, body = http_call(base + "/restaurants/%d" % restaurant["id"])
+            inspections = [insp["id"] for insp in json.loads(body)["inspections"]]
+            status, body = http_call(base + "/tweet",
+                                     {"key": "t-%s" % record["inspection_id"],
+                                      "text": "lunch",
+                                      "lat": restaurant["latitude"],
+                                      "long": restaurant["longitude"]})
+            matched = restaurant["id"] in json.loads(body)["matches"]
+            status, body = http_call(base + "/tweets/%d" % restaurant["id"])
+            if (restaurant["name"] == record["name"] and matched
+                    and record["inspection_id"] in inspections
+                    and json.loads(body)):
+                routed += 1
+
+        start = time.perf_counter()
+        status, body = http_call(base + "/clean?strategy=blocking")
+        clean = time.perf_counter() - start
+        # The risk and month of an inspection do not depend on the clusters.
+        stats_groups = json.loads(http_call(
+            base + "/stats/inspections?by=risk,month")[1])["groups"]
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    restaurants = []
+    clusters = 0
+    for db_file in db_files:
+        conn = sqlite3.connect(db_file)
+        restaurants.append(conn.execute(
+            "SELECT COUNT(*) FROM ri_restaurants").fetchone()[0])
+        clusters += conn.execute("SELECT COUNT(*) FROM ri_clusters").fetchone()[0]
+        conn.close()
+    return {"ingest": len(records) / ingest, "failed": failed, "count": count,
+            "routed": routed, "checked": len(sample),
+            "clean_status": status, "clean": clean, "clusters": clusters,
+            "restaurants": restaurants, "stats": stats_groups}
+
+
+def bench_shards(config):
+    """
+    Local multi-process harness of the sharded deployment: compares one
+    server with config.shards shard servers behind a router on ingest
+    throughput, routed reads, /count, /stats and a parallel blocking
+    /clean.
+    """
+    records = []
+    for copy in range(config.copies):
+        for record in read_records(config.data):
+            record["inspection_id"] = "%s-%d" % (record["inspection_id"], copy)
+            if copy:
+                record["name"] = "%s %d" % (record["name"], copy)
+            records.append(record)
+    if config.records:
+        records = records[:config.records]
+    print("%d inspections, %d clients, /txn/%d" % (len(records), config.clients,
+                                                  config.txn))
+    print("%10s %12s %8s %8s %10s %10s %10s  %s" % (
+        "layout", "records/s", "failed", "count", "routed", "clean (s)",
+        "clusters", "restaurants per shard"))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_shards, direct in ((0, False), (config.shards, False),
+                                   (config.shards, True)):
+            rv = run_deployment(config, tmp, num_shards, records, direct)
+            results.append(rv)
+            print("%10s %12.0f %8d %8d %10s %10s %10d  %s" % (
+                ("single" if not num_shards else "%d %s" % (
+                    num_shards, "direct" if direct else "routed")),
+                rv["ingest"], rv["failed"], rv["count"],
+                "%d/%d" % (rv["routed"], rv["checked"]),
+                "%.3f" % rv["clean"] if rv["clean_status"] == 200
+                else rv["clean_status"],
+                rv["clusters"], rv["restaurants"]))
+    single = results[0]
+    ok = True
+    for sharded in results[1:]:
+        ok = ok and (single["count"] == sharded["count"]
+                     and single["stats"] == sharded["stats"]
+                     and sharded["routed"] == sharded["checked"]
+                     and not sharded["failed"]
+                     and sharded["clean_status"] == 200)
+        if config.clients == 1:
+            # Ingest order, and with it the clusters, only repeat with one
+            # client.
+            ok = ok and single["clusters"] == sharded["clusters"]
+    print("OK" if ok else "MISMATCH")
+    return 0 if ok else 1
+
+
+def bench_replicas(config):
+    """
+    Times GET /restaurants/<id> while a /clean runs, on a server reading
+    from its own connection and on one with read replicas, and reports
+    the X-Data-Age the replica responses carried.
+    """
+    print("%10s %8s %10s %10s %10s %10s %10s" % (
+        "replicas", "GETs", "p50 (ms)", "p99 (ms)", "max (ms)", "max age",
+        "clean (s)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for replicas in (0, config.replicas):
+            db_file = os.path.join(tmp, "replicas.db")
+            conn = build_database(db_file, config.data, config.copies)
+            ids = [row["id"] for row in
+                   conn.execute("SELECT id FROM ri_restaurants").fetchall()]
+            conn.close()
+            server = start_server(config.port, "--database", db_file,
+                                  "--replicas", str(replicas),
+                                  "--replica-interval", str(config.interval),
+                                  "--max-staleness", str(config.max_staleness))
+            base = "http://localhost:%d" % config.port
+            try:
+                clean = {}
+
+                def run_clean():
+                    start = time.perf_counter()
+                    clean["status"] = http_call(base + "/clean?" + config.query)[0]
+                    clean["seconds"] = time.perf_counter() - start
+
+                cleaner = threading.Thread(target=run_clean)
+                cleaner.start()
+                latencies = []
+                ages = []
+                while cleaner.is_alive():
+                    url = base + "/restaurants/%d" % ids[len(latencies) % len(ids)]
+                    start = time.perf_counter()
+                    with urllib.request.urlopen(url, timeout=600) as rv:
+                        rv.read()
+                        ages.append(float(rv.headers.get("X-Data-Age") or 0))
+                    latencies.append(time.perf_counter() - start)
+                cleaner.join()
+            finally:
+                server.terminate()
+                server.wait()
+            os.remove(db_file)
+            latencies.sort()
+            print("%10d %8d %10.1f %10.1f %10.1f %10.3f %10.3f" % (
+                replicas, len(latencies),
+                latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000,
+                latencies[-1] * 1000, max(ages), clean["seconds"]))
+    return 0
+
+
+def bench_violations(config):
+    """
+    Reports the database size and the time to scan ri_inspections and to
+    read every restaurant's inspections with the violations stored as
+    text and coded (violations.compress), after a VACUUM each, and checks
+    that the reads return the same inspections.
+    """
+    import violations
+
+    print("%8s %12s %12s %12s %14s" % ("storage", "size (KiB)", "stored (KiB)",
+                                       "scan (ms)", "by rest. (ms)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "violations.db")
+        conn = build_database(db_file, config.data, config.copies)
+        db = DB(conn)
+        restaurant_ids = [row["id"] for row in
+                          conn.execute("SELECT id FROM ri_restaurants").fetchall()]
+        reads = {}
+        for storage in ("text", "coded"):
+            if storage == "coded":
+                start = time.perf_counter()
+                coded = violations.compress(conn)
+                print("coded %d inspections in %.3f s" % (
+                    coded, time.perf_counter() - start))
+                db = DB(conn)
+            conn.execute("VACUUM")
+            stored = conn.execute("""SELECT SUM(length(violations)) AS size
+                                  FROM ri_inspections""").fetchone()["size"]
+            c = conn.cursor()
+            c.row_factory = None
+            start = time.perf_counter()
+            for _ in range(config.repeat):
+                c.execute("SELECT * FROM ri_inspections").fetchall()
+            scan = (time.perf_counter() - start) / config.repeat
+            c.close()
+            start = time.perf_counter()
+            for _ in range(config.repeat):
+                reads[storage] = [db.find_inspection_rows(restaurant_id)
+                                  for restaurant_id in restaurant_ids]
+            by_restaurant = (time.perf_counter() - start) / config.repeat
+            print("%8s %12.1f %12.1f %12.1f %14.1f" % (
+                storage, os.path.getsize(db_file) / 1024, stored / 1024,
+                scan * 1000, by_restaurant * 1000))
+        conn.close()
+    if reads["text"] != reads["coded"]:
+        print("coded violations read back differently")
+        return 1
+    return 0
+
+
+# Violation and restaurant searches timed by bench_search.
+SEARCHES = [("inspections", "rodent"), ("inspections", "no hot water"),
+            ("inspections", "hand sink"), ("inspections", "7-38-005"),
+            ("restaurants", "pizza"), ("restaurants", "halsted")]
+
+
+def tweet_ngrams(text):
+    """
+    The lower-cased 1 to 4 word n grams of a tweet, as server.py's /tweet
+    builds them for exact name matching.
+    """
+    words = text.translate(str.maketrans(
+        "", "", string.punctuation)).lower().split()
+    return [" ".join(words[i:i + n]) for n in range(1, 5)
+            for i in range(len(words) - n + 1)]
+
+
+def bench_search(config):
+    """
+    Times full-text searches against the LIKE scans they replace, and
+    compares exact and full-text tweet name matching on tweets naming
+    sample restaurants.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_database(os.path.join(tmp, "search.db"), config.data,
+                              config.copies)
+        db = DB(conn)
+        print("%12s %14s %10s %10s %10s %10s" % ("in", "query", "LIKE rows",
+              "LIKE (ms)", "FTS rows", "FTS (ms)"))
+        for scope, query in SEARCHES:
+            if scope == "inspections":
+                like = """SELECT id FROM ri_inspections
+                          WHERE violations LIKE ?"""
+                search = db.search_inspections
+            else:
+                like = """SELECT id FROM ri_restaurants
+                          WHERE name LIKE ? OR address LIKE ?"""
+                search = db.search_restaurants
+            pattern = "%" + query + "%"
+            args = [pattern] * like.count("?")
+            like_rows = len(conn.execute(like, args).fetchall())
+            like_seconds = time_calls(
+                lambda: conn.execute(like, args).fetchall(), config.repeat)
+            rows = len(search(query, MAX_RESULTS))
+            seconds = time_calls(lambda: search(query, 20), config.repeat)
+            print("%12s %14s %10d %10.2f %10d %10.2f" % (
+                scope, query, like_rows, like_seconds * 1000, rows,
+                seconds * 1000))
+        names = [row["name"] for row in conn.execute(
+            "SELECT name FROM ri_restaurants ORDER BY id LIMIT ?",
+            [config.tweets]).fetchall()]
+        tweets = ["Dinner at %s tonight!" % name for name in names]
+        found = {"exact": 0, "fts": 0}
+        timing = {}
+        for match in ("exact", "fts"):
+            start = time.perf_counter()
+            for name, text in zip(names, tweets):
+                if match == "fts":
+                    ids = db.match_by_name_fts(text)
+                else:
+                    ids = db.match_by_name(tweet_ngrams(text))
+                found[match] += any(db.find_restaurant(rest_id)[0]["name"] == name
+                                    for rest_id in ids)
+            timing[match] = (time.perf_counter() - start) / len(tweets)
+        for match in ("exact", "fts"):
+            print("tweet names %5s: %d of %d restaurants found, %.2f ms per tweet"
+                  % (match, found[match], len(tweets), timing[match] * 1000))
+        conn.close()
+    return 0
+
+
+def same_store(a, b):
+    """
+    Returns: the first part in which stores a and b differ, None if none.
+    """
+    if len(a) != len(b):
+        return "rows"
+    for column in a.columns:
+        if ([a.columns[column][i] for i in range(len(a))]
+                != [b.columns[column][i] for i in range(len(b))]):
+            return column
+    for part in ("names", "primaries", "clusters"):
+        if getattr(a, part) != getattr(b, part):
+            return part
+    return None
+
+
+def bench_snapshot(config):
+    """
+    Cleans a freshly built database with the blocking strategy, writes a
+    snapshot of the store and compares the startup load of the store from
+    ri_restaurants with the load from the snapshot.
+    """
+    from store import RestaurantStore
+    from store import attach_store
+    import snapshot
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "snapshot.db")
+        snapshot_file = os.path.join(tmp, "store.snap")
+        conn = build_database(db_file, config.data, config.copies)
+        store = RestaurantStore.load(conn)
+        attach_store(conn, store)
+        db = DB(conn)
+        for chunk in db.block_chunks(4):
+            for restaurant in db.match_with_blocking(chunk, 0.7):
+                db.gen_aut_restaurant(restaurant)
+        conn.commit()
+        start = time.perf_counter()
+        size = snapshot.export(store, conn, snapshot_file)
+        export_seconds = time.perf_counter() - start
+        print("%d restaurants, snapshot %.1f KiB written in %.1f ms" % (
+            len(store), size / 1024, export_seconds * 1000))
+        loads = (("database", lambda: RestaurantStore.load(conn)),
+                 ("snapshot", lambda: snapshot.load(snapshot_file, conn)))
+        print("%10s %12s" % ("load", "best (ms)"))
+        for name, load in loads:
+            best = None
+            for _ in range(config.repeat):
+                start = time.perf_counter()
+                loaded = load()
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            print("%10s %12.1f" % (name, best * 1000))
+            difference = same_store(store, loaded)
+            if difference is not None:
+                print("%s store differs in %s" % (name, difference))
+                return 1
+        conn.close()
+    return 0
+
+
+def clean_result(conn):
+    """
+    Returns: the clusters' member ids and the restaurants' clean flags.
+    """
+    clusters = sorted(sorted(json.loads(row["member_ids"])) for row in conn.execute(
+        "SELECT member_ids FROM ri_clusters"))
+    cleaned = [(row["id"], row["clean"]) for row in conn.execute(
+        "SELECT id, clean FROM ri_restaurants ORDER BY id")]
+    return clusters, cleaned
+
+
+def run_job(jobs, db_file, strategy, scorer, cancel_after=None):
+    """
+    Runs a clean job of the given strategy to the end. With cancel_after,
+    the job is cancelled once that many blocks are checkpointed, then
+    resumed.
+
+    Returns: the job's progress over all its runs, as stored.
+    """
+    from jobs import CleanJob
+
+    class CancellingJob(CleanJob):
+        def checkpoint(self, conn, index, clusters):
+            super().checkpoint(conn, index, clusters)
+            if self.blocks_run == cancel_after:
+                self.cancel()
+
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = dict_factory
+    job_id = jobs.create(conn, strategy, {"window": 5}, 4)
+    if cancel_after is not None:
+        row = conn.execute("SELECT params, blocks FROM ri_clean_jobs WHERE id = ?",
+                           [job_id]).fetchone()
+        job = CancellingJob(job_id, db_file, strategy, json.loads(row["params"]),
+                            json.loads(row["blocks"]), [], scorer)
+        job.start()
+        job.thread.join()
+    jobs.start(conn, job_id, db_file, scorer).thread.join()
+    jobs.forget()
+    progress = jobs.progress(conn, job_id)
+    conn.close()
+    return progress
+
+
+def bench_jobs(config):
+    """
+    Runs a clean job of each strategy on copies of a freshly built database,
+    once without stopping and once cancelled after its first block and
+    resumed, and checks that both write the same clusters.
+    """
+    from jobs import CleanJobs
+    from scoring import PairScorer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.db")
+        build_database(source, config.data, config.copies).close()
+        for strategy in ("blocking", "sorted", "full"):
+            results = []
+            for cancel_after in (None, 1):
+                db_file = os.path.join(tmp, "%s-%s.db" % (strategy, cancel_after))
+                shutil.copyfile(source, db_file)
+                start = time.perf_counter()
+                progress = run_job(CleanJobs(), db_file, strategy,
+                                   PairScorer(0.7), cancel_after)
+                seconds = time.perf_counter() - start
+                conn = sqlite3.connect(db_file)
+                conn.row_factory = dict_factory
+                results.append(clean_result(conn))
+                conn.close()
+                print("%-8s %-11s %s in %.2f s, %d blocks, %d clusters" % (
+                    strategy, "resumed" if cancel_after else "whole",
+                    progress["status"], seconds, progress["blocks_done"],
+                    len(results[-1][0])))
+                if progress["clusters"] != len(results[-1][0]):
+                    print("job reports %d clusters" % progress["clusters"])
+                    return 1
+            if results[0] != results[1]:
+                print("%s: the resumed job wrote different %s" % (
+                    strategy, "clusters" if results[0][0] != results[1][0]
+                    else "clean flags"))
+                return 1
+    return 0
+
+
+# The groupings of /stats/inspections bench_stats checks and times.
+STATS_GROUPINGS = [[], ["zip"], ["risk"], ["facility_type"], ["month"],
+                   ["zip", "month"]]
+
+
+def scan_stats(conn, keys):
+    """
+    The groups of DB.inspection_stats counted from ri_inspections joined to
+    ri_restaurants, as /stats would without the rollups.
+    """
+    columns = [stats.MONTH + " AS month" if key == "month" else
+               "coalesce(%s, '') AS %s" % (stats.DIMENSIONS[key], key)
+               for key in keys]
+    columns.append("COUNT(*) AS inspections")
+    columns += ["coalesce(SUM(i.results IS '%s'), 0) AS %s"
+                % (stats.RESULTS[counter], counter)
+                for counter in stats.COUNTERS[1:]]
+    sql = """SELECT %s FROM ri_inspections AS i
+             JOIN ri_restaurants AS r ON r.id == i.restaurant_id""" % (
+        ", ".join(columns))
+    if keys:
+        sql += " GROUP BY %s ORDER BY %s" % (", ".join(keys), ", ".join(keys))
+    return [stats.with_rates(group) for group in conn.execute(sql).fetchall()]
+
+
+def rollup_rows(conn):
+    return (conn.execute("""SELECT * FROM ri_inspection_stats
+                         WHERE inspections != 0
+                         ORDER BY dimension, value, month""").fetchall(),
+            conn.execute("""SELECT * FROM ri_tweet_stats
+                         ORDER BY restaurant_id""").fetchall())
+
+
+def bench_stats(config):
+    """
+    Ingests and cleans a database and matches tweets to some of its
+    restaurants, checks that the rollups kept up along the way equal a
+    recount, then times /stats queries on the rollups against counting
+    the same groups from the tables.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_database(os.path.join(tmp, "stats.db"), config.data,
+                              config.copies)
+        db = DB(conn)
+        for chunk in db.block_chunks(4):
+            for restaurant in db.match_with_blocking(chunk, 0.7):
+                db.gen_aut_restaurant(restaurant)
+        restaurants = conn.execute(
+            """SELECT id, name, latitude, longitude FROM ri_restaurants
+               ORDER BY id LIMIT ?""", [config.tweets]).fetchall()
+        for number, restaurant in enumerate(restaurants):
+            text = "Dinner at %s tonight!" % restaurant["name"]
+            located = number % 2 and restaurant["latitude"] is not None
+            db.match_tweet_restaurant(
+                {"key": "bench-%d" % number, "text": text},
+                tweet_ngrams(text),
+                restaurant["latitude"] if located else "",
+                restaurant["longitude"] if located else "")
+        conn.commit()
+        kept = rollup_rows(conn)
+        db.rebuild_stats()
+        if rollup_rows(conn) != kept:
+            print("rollups differ from a recount")
+            return 1
+        print("rollups of %d inspections and %d tweet matches equal a "
+              "recount" % (db.count_inspections(), conn.execute(
+                  "SELECT COUNT(*) AS cnt FROM ri_tweetmatch").fetchone()["cnt"]))
+        print("%18s %8s %12s %12s" % ("by", "groups", "rollup (ms)",
+                                      "scan (ms)"))
+        for keys in STATS_GROUPINGS:
+            groups = db.inspection_stats(keys)
+            if groups != scan_stats(conn, keys):
+                print("stats by %s differ from a scan" % ",".join(keys))
+                return 1
+            rollup_seconds = time_calls(lambda: db.inspection_stats(keys),
+                                        config.repeat)
+            scan_seconds = time_calls(lambda: scan_stats(conn, keys),
+                                      config.repeat)
+            print("%18s %8d %12.2f %12.2f" % (",".join(keys) or "(totals)",
+                  len(groups), rollup_seconds * 1000, scan_seconds * 1000))
+        top_scan = """SELECT restaurant_id, COUNT(*) AS tweets
+                      FROM ri_tweetmatch GROUP BY restaurant_id
+                      ORDER BY tweets DESC, restaurant_id DESC LIMIT 20"""
+        rollup_seconds = time_calls(lambda: db.tweet_stats(20), config.repeat)
+        scan_seconds = time_calls(lambda: conn.execute(top_scan).fetchall(),
+                                  config.repeat)
+        print("%18s %8d %12.2f %12.2f" % ("top tweeted", 20,
+              rollup_seconds * 1000, scan_seconds * 1000))
+        conn.close()
+    return 0
+
+
+# Servers bench_startup starts, by name: the server.py flags of each.
+STARTUP_CONFIGS = OrderedDict([
+    ("sql", []),
+    ("sql, prewarm", ["--prewarm"]),
+    ("columnar", ["--columnar"]),
+    ("columnar, prewarm", ["--columnar", "--prewarm"]),
+])
+
+
+def start_timed_server(port, db_file, args):
+    """
+    Starts server.py on db_file and polls /hello until it answers.
+
+    Returns: (process, seconds to the first answer, list the lines the
+             server logs are appended to)
+    """
+    lines = []
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "server.py", "--port", str(port),
+                                "--database", db_file, "--cache-ttl", "0"]
+                               + args,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True)
+
+    def read_log():
+        for line in process.stderr:
+            lines.append(line)
+
+    threading.Thread(target=read_log, daemon=True).start()
+    while True:
+        try:
+            http_call("http://localhost:%d/hello" % port)
+            return process, time.perf_counter() - start, lines
+        except Exception:
+            if (process.poll() is not None
+                    or time.perf_counter() - start > 60):
+                process.kill()
+                raise RuntimeError("server on port %d did not start" % port)
+            time.sleep(0.002)
+
+
+def tweet_about(base, records, key):
+    """
+    Ingests records as new restaurants, then tweets their names from
+    their location.
+
+    Returns: the matches of each tweet.
+    """
+    for record in records:
+        http_call(base + "/inspections", record)
+    matches = []
+    for i, record in enumerate(records):
+        status, body = http_call(base + "/tweet",
+                                 {"key": "%s-%d" % (key, i),
+                                  "text": "dinner at %s" % record["name"].lower(),
+                                  "lat": record["latitude"],
+                                  "long": record["longitude"]})
+        matches.append(sorted(json.loads(body)["matches"]) if status == 201
+                       else status)
+    return matches
+
+
+def bench_startup(config):
+    """
+    Times how long server.py takes to answer its first /hello and its
+    first /tweet on a freshly built database, with and without --columnar
+    and --prewarm. Each server ingests restaurants and tweets about them
+    as soon as it answers, while a --prewarm store is still loading, then
+    again once every server is warm; the matches must be the same for
+    every server.
+    """
+    records = [record for record in read_records(config.data)
+               if record["latitude"]][:2 * config.restaurants]
+    for i, record in enumerate(records):
+        record.update(inspection_id="startup-%d" % i,
+                      name="%s STARTUP" % record["name"])
+    during, after = records[:config.restaurants], records[config.restaurants:]
+    base = "http://localhost:%d" % config.port
+    expected = None
+    print("%20s %12s %12s %16s" % ("server", "/hello (ms)", "median (ms)",
+                                   "first /tweet (ms)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        built = os.path.join(tmp, "built.db")
+        build_database(built, config.data, config.copies).close()
+        db_file = os.path.join(tmp, "startup.db")
+        for name, args in STARTUP_CONFIGS.items():
+            started = []
+            first_tweets = []
+            for _ in range(config.repeat):
+                shutil.copyfile(built, db_file)
+                process, seconds, lines = start_timed_server(config.port,
+                                                             db_file, args)
+                try:
+                    started.append(seconds)
+                    start = time.perf_counter()
+                    http_call(base + "/tweet", {"key": "first", "text": "lunch",
+                                                "lat": 41.88, "long": -87.63})
+                    first_tweets.append(time.perf_counter() - start)
+                    matches = tweet_about(base, during, "during")
+                    while ("--prewarm" in args and not any(
+                            "in the background" in line for line in lines)):
+                        if process.poll() is not None:
+                            raise RuntimeError("server on port %d stopped"
+                                               % config.port)
+                        time.sleep(0.01)
+                    matches += tweet_about(base, after, "after")
+                finally:
+                    process.terminate()
+                    process.wait()
+                if expected is None:
+                    expected = matches
+                elif matches != expected:
+                    print("%s matched %d tweets differently" % (
+                        name, sum(a != b for a, b in zip(matches, expected))))
+                    return 1
+            started.sort()
+            print("%20s %12.1f %12.1f %16.1f" % (
+                name, started[0] * 1000, started[len(started) // 2] * 1000,
+                min(first_tweets) * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--data",
+        help="Gzipped JSON inspection data (default %s)" % DEFAULT_DATA,
+        default=DEFAULT_DATA
+    )
+    common.add_argument(
+        "--copies",
+        help="Copies of the data to load (default 20)",
+        default=20,
+        type=int
+    )
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("plans", parents=[common],
+                        help="Fail if a hot-path query scans a table")
+    json_bench = commands.add_parser("json", parents=[common],
+                                     help="Time encoding of GET /restaurants/<id>")
+    json_bench.add_argument(
+        "--inspections",
+        help="Inspections for the benchmarked restaurant (default 5000)",
+        default=5000,
+        type=int
+    )
+    json_bench.add_argument(
+        "--repeat",
+        help="Requests per timing (default 20)",
+        default=20,
+        type=int
+    )
+    clean_bench = commands.add_parser("clean", parents=[common],
+                                      help="Time and measure memory of /clean")
+    clean_bench.add_argument(
+        "-s", "--scaling",
+        help="Use the blocking clean",
+        default=False,
+        action="store_true"
+    )
+    clean_bench.add_argument(
+        "--query",
+        help="Query string passed to /clean",
+        default=""
+    )
+    txn_bench = commands.add_parser("txn", parents=[common],
+                                    help="Compare /txn commit policies")
+    txn_bench.add_argument(
+        "--policies",
+        help="Comma separated N:T pairs of records and milliseconds "
+             "(default 1:0,10:0,100:0,100:5,1000:0,1000:20,100000:50)",
+        default="1:0,10:0,100:0,100:5,1000:0,1000:20,100000:50"
+    )
+    txn_bench.add_argument(
+        "--records",
+        help="Inspections to post (default 1000)",
+        default=1000,
+        type=int
+    )
+    txn_bench.add_argument(
+        "--rate",
+        help="Inspections posted per second, 0 for as fast as possible",
+        default=0,
+        type=float
+    )
+    statements_bench = commands.add_parser("statements", parents=[common],
+                                           help="Statement cache hit rates")
+    statements_bench.add_argument(
+        "--sizes",
+        help="cached_statements values to compare (default 0,16,128,%d)"
+             % CACHED_STATEMENTS,
+        default="0,16,128,%d" % CACHED_STATEMENTS
+    )
+    statements_bench.add_argument(
+        "--samples",
+        help="Restaurants to run the hot-path reads for (default 200)",
+        default=200,
+        type=int
+    )
+    shards_bench = commands.add_parser("shards", parents=[common],
+                                       help="Run a sharded deployment locally")
+    shards_bench.add_argument(
+        "--shards",
+        help="Shard servers (default 4)",
+        default=4,
+        type=int
+    )
+    shards_bench.add_argument(
+        "--records",
+        help="Inspections to post, 0 for all (default 0)",
+        default=0,
+        type=int
+    )
+    shards_bench.add_argument(
+        "--clients",
+        help="Client processes posting inspections (default 8)",
+        default=8,
+        type=int
+    )
+    shards_bench.add_argument(
+        "--txn",
+        help="/txn records per commit (default 1)",
+        default=1,
+        type=int
+    )
+    shards_bench.add_argument(
+        "--port",
+        help="Port of the server or router, shards use the next ones "
+             "(default 31000)",
+        default=31000,
+        type=int
+    )
+    replicas_bench = commands.add_parser("replicas", parents=[common],
+                                         help="GET latency during /clean")
+    replicas_bench.add_argument(
+        "--replicas",
+        help="Replicas of the compared server (default 2)",
+        default=2,
+        type=int
+    )
+    replicas_bench.add_argument(
+        "--interval",
+        help="Seconds between replica snapshots (default 1)",
+        default=1.0,
+        type=float
+    )
+    replicas_bench.add_argument(
+        "--max-staleness",
+        help="Staleness bound in seconds (default 5)",
+        default=5.0,
+        type=float
+    )
+    replicas_bench.add_argument(
+        "--query",
+        help="Query string passed to /clean (default strategy=blocking)",
+        default="strategy=blocking"
+    )
+    replicas_bench.add_argument(
+        "--port",
+        help="Server port (default 31000)",
+        default=31000,
+        type=int
+    )
+    ingest_bench = commands.add_parser("ingest", parents=[common],
+                                       help="Compare POST /inspections ingest paths")
+    ingest_bench.add_argument(
+        "--repeat",
+        help="Runs to take the best of (default 3)",
+        default=3,
+        type=int
+    )
+    violations_bench = commands.add_parser("violations", parents=[common],
+                                           help="Size and scans, text vs coded violations")
+    violations_bench.add_argument(
+        "--repeat",
+        help="Scans per timing (default 3)",
+        default=3,
+        type=int
+    )
+    search_bench = commands.add_parser("search", parents=[common],
+                                       help="Full-text search vs LIKE scans")
+    search_bench.add_argument(
+        "--repeat",
+        help="Searches per timing (default 5)",
+        default=5,
+        type=int
+    )
+    search_bench.add_argument(
+        "--tweets",
+        help="Restaurants to tweet about (default 500)",
+        default=500,
+        type=int
+    )
+    commands.add_parser("jobs", parents=[common],
+                        help="Check resumed clean jobs against whole ones")
+    stats_bench = commands.add_parser("stats", parents=[common],
+                                      help="Rollups vs counting from tables")
+    stats_bench.add_argument(
+        "--repeat",
+        help="Queries per timing (default 5)",
+        default=5,
+        type=int
+    )
+    stats_bench.add_argument(
+        "--tweets",
+        help="Restaurants to tweet about (default 500)",
+        default=500,
+        type=int
+    )
+    snapshot_bench = commands.add_parser("snapshot", parents=[common],
+                                         help="Store load, database vs snapshot")
+    snapshot_bench.add_argument(
+        "--repeat",
+        help="Loads per timing (default 5)",
+        default=5,
+        type=int
+    )
+    startup_bench = commands.add_parser("startup", parents=[common],
+                                        help="Time to first request of server.py")
+    startup_bench.add_argument(
+        "--repeat",
+        help="Starts of each server (default 5)",
+        default=5,
+        type=int
+    )
+    startup_bench.add_argument(
+        "--restaurants",
+        help="Restaurants ingested while starting and after (default 50)",
+        default=50,
+        type=int
+    )
+    startup_bench.add_argument(
+        "--port",
+        help="Server port (default 31000)",
+        default=31000,
+        type=int
+    )
+    config = parser.parse_args()
+    if config.command == "plans":
+        sys.exit(check_plans(config))
+    elif config.command == "json":
+        sys.exit(bench_json(config))
+    elif config.command == "statements":
+        sys.exit(bench_statements(config))
+    elif config.command == "txn":
+        sys.exit(bench_txn(config))
+    elif config.command == "clean":
+        sys.exit(bench_clean(config))
+    elif config.command == "shards":
+        sys.exit(bench_shards(config))
+    elif config.command == "replicas":
+        sys.exit(bench_replicas(config))
+    elif config.command == "ingest":
+        sys.exit(bench_ingest(config))
+    elif config.command == "violations":
+        sys.exit(bench_violations(config))
+    elif config.command == "search":
+        sys.exit(bench_search(config))
+    elif config.command == "stats":
+        sys.exit(bench_stats(config))
+    elif config.command == "jobs":
+        sys.exit(bench_jobs(config))
+    elif config.command == "snapshot":
+        sys.exit(bench_snapshot(config))
+    elif config.command == "startup":
+        sys.exit(bench_startup(config))
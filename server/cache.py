@@ -0,0 +1,172 @@
+"""
+In-process caches for the read endpoints.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry when full.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None.
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits,
+                    "misses": self.misses}
+
+
+class ResponseCache:
+    """
+    Read-through cache of GET responses with a time to live.
+
+    Entries are grouped by (route, resource) so a write to one restaurant
+    can drop every cached variant (query string) of that restaurant's
+    responses at once. The time of the last invalidation of each of the
+    maxsize most recently written resources is kept, and for the others
+    the latest of those forgotten, so that a response read from a replica
+    snapshot taken before a write is not cached again after it.
+    """
+    def __init__(self, ttl=5.0, maxsize=4096):
+        self.ttl = ttl
+        self.groups = LRUCache(maxsize)
+        self.invalidated = OrderedDict()
+        self.horizon = 0.0
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, route, resource, variant):
+        if self.ttl <= 0:
+            return None
+        group = self.groups.get((route, resource))
+        entry = group.get(variant) if group is not None else None
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, route, resource, variant, value, as_of=None, max_age=None):
+        """
+        Caches a response whose data was read as of the time as_of. It is
+        not cached when the resource was invalidated after as_of, and with
+        max_age it is kept no later than as_of plus max_age.
+        """
+        if self.ttl <= 0:
+            return
+        ttl = self.ttl
+        if as_of is not None:
+            with self.groups.lock:
+                invalidated = self.invalidated.get((route, resource),
+                                                   self.horizon)
+            if as_of < invalidated:
+                return
+            if max_age is not None:
+                ttl = min(ttl, as_of + max_age - time.time())
+                if ttl <= 0:
+                    return
+        group = self.groups.get((route, resource))
+        if group is None:
+            group = {}
+            self.groups.put((route, resource), group)
+        group[variant] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, route, resource):
+        """
+        Drops every cached response of one resource.
+        """
+        key = (route, resource)
+        with self.groups.lock:
+            self.groups.entries.pop(key, None)
+            self.invalidated[key] = time.time()
+            self.invalidated.move_to_end(key)
+            while len(self.invalidated) > self.maxsize:
+                key, forgotten = self.invalidated.popitem(last=False)
+                self.horizon = max(self.horizon, forgotten)
+
+    def clear(self):
+        with self.groups.lock:
+            self.groups.entries.clear()
+            self.invalidated.clear()
+            self.horizon = time.time()
+
+    def stats(self):
+        return {"groups": len(self.groups.entries), "hits": self.hits,
+                "misses": self.misses, "ttl": self.ttl}
+
+
+class InspectionCounter:
+    """
+    Number of inspections visible on the server's connection, kept up to
+    date on insert, commit and rollback instead of counted with SQL.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.committed = 0
+        self.pending = 0
+
+    def reset(self, count):
+        with self.lock:
+            self.loaded = True
+            self.committed = count
+            self.pending = 0
+
+    def load(self, count):
+        """
+        Sets the counter from a count read on the server's connection,
+        which includes the inserts not committed yet: those stay pending
+        and only the rest is counted as committed.
+        """
+        with self.lock:
+            self.loaded = True
+            self.committed = count - self.pending
+
+    def added(self, n=1):
+        with self.lock:
+            self.pending += n
+
+    def commit(self):
+        with self.lock:
+            self.committed += self.pending
+            self.pending = 0
+
+    def rollback(self):
+        with self.lock:
+            self.pending = 0
+
+    def value(self):
+        with self.lock:
+            return self.committed + self.pending
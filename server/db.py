@@ -1,8 +1,20 @@
 from os import path
 import json
-import jellyfish as td
 import string #we're using it to get letters of the alphabet
 import math
+import sqlite3
+from contextlib import closing
+from store import STORES
+from normalize import KEY_COLUMNS
+from normalize import MATCH_KEYS_VERSION
+from normalize import restaurant_keys
+from search import contains_phrase
+from search import fts_query
+from search import name_phrases
+from search import tokens
+import stats
+from violations import codec_for
+from violations import release as release_codec
 
 # Error class for when request data is bad
 class InspError(Exception):
@@ -25,19 +37,76 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+# Restaurant columns returned to clients; the match keys stay internal.
+RESTAURANT_COLUMNS = """id, name, facility_type, address, city, state, zip,
+                        latitude, longitude, clean"""
+
+# Sort keys of the sorted neighbourhood passes: name, address, zip and name.
+SORTED_PASSES = (("norm_name",),
+                 ("norm_address", "norm_name"),
+                 ("zip_prefix", "norm_name"))
+
+# Size of each connection's prepared statement cache. DB issues a fixed set
+# of statements (variable-length IN lists go through json_each), so they
+# all stay prepared.
+CACHED_STATEMENTS = 512
+
+# Row type for the cleaning and matching paths, which read whole tables.
+# sqlite3.Row is indexable by column name like the dicts from dict_factory
+# but shares one column list per query instead of building a dict per row;
+# dicts are only built for rows returned over HTTP.
+CLEAN_ROW_FACTORY = sqlite3.Row
+
+# Inspection columns that can be requested from find_inspections.
+INSPECTION_FIELDS = ("id", "risk", "inspection_date", "inspection_type",
+                     "results", "violations")
+
+def inspection_columns(fields=None, _cache={}):
+    """
+    Returns the (shared, cached) column list for a selection of inspection
+    fields.
+    """
+    key = tuple(fields) if fields is not None else INSPECTION_FIELDS
+    columns = _cache.get(key)
+    if columns is None:
+        columns = _cache[key] = list(key)
+    return columns
+
+# sqlite3 keeps a single trace callback per connection, so everything that
+# wants to see the statements a connection runs registers here instead.
+TRACE_CALLBACKS = {}
+
+def add_trace_callback(connection, callback):
+    """
+    Adds a callback that receives every SQL statement run on a connection.
+    """
+    callbacks = TRACE_CALLBACKS.setdefault(connection, [])
+    callbacks.append(callback)
+    def trace(statement):
+        for fn in callbacks:
+            fn(statement)
+    connection.set_trace_callback(trace)
+
 """
 Wraps a single connection to the database with higher-level functionality.
 """
 class DB:
     def __init__(self, connection):
         self.conn = connection
+        # In-memory restaurant columns, when the server keeps them.
+        self.store = STORES.get(connection)
+        # When set, the cleaning writes are left for the caller to commit,
+        # so a block of clusters can be committed at once.
+        self.defer_commits = False
 
     def execute_script(self, script_file):
-        with open(script_file, "r") as script:
-            c = self.conn.cursor()
+        with open(script_file, "r") as script, \
+                closing(self.conn.cursor()) as c:
             # Only using executescript for running a series of SQL commands.
             c.executescript(script.read())
             self.conn.commit()
+        # A reset drops the coded violations setting.
+        release_codec(self.conn)
 
     def create_script(self):
         """
@@ -56,6 +125,85 @@ class DB:
         if not path.exists(script_file):
             raise InspError("Seed Script not found")
         self.execute_script(script_file)
+        # The script inserts restaurants without their match keys.
+        self.fill_match_keys()
+
+    def fill_match_keys(self):
+        """
+        Adds the match key columns and their indexes to a database created
+        before they existed, and computes the keys of the restaurants
+        inserted without them (by schema/seed.sql or before the columns
+        were added), as add_restaurant would. When the keys were computed
+        by another MATCH_KEYS_VERSION, those of every restaurant are
+        computed again. A new epoch then keeps a --snapshot of the old
+        keys from being mapped.
+
+        Returns: the number of restaurants given their keys.
+        """
+        with closing(self.conn.cursor()) as c:
+            c.row_factory = None
+            columns = [row[1] for row in
+                       c.execute("PRAGMA table_info(ri_restaurants)")]
+            for column in KEY_COLUMNS:
+                if column not in columns:
+                    c.execute("ALTER TABLE ri_restaurants ADD COLUMN %s text"
+                              % column)
+            c.execute("""CREATE INDEX IF NOT EXISTS ri_restaurants_norm_name
+                      ON ri_restaurants (norm_name)""")
+            c.execute("""CREATE INDEX IF NOT EXISTS ri_restaurants_name_key
+                      ON ri_restaurants (name_key)""")
+            c.execute("""CREATE INDEX IF NOT EXISTS ri_restaurants_block
+                      ON ri_restaurants (block_key, zip_prefix)""")
+            c.execute("""CREATE TABLE IF NOT EXISTS ri_meta (
+                      name text PRIMARY KEY, value text)""")
+            version = c.execute("""SELECT value FROM ri_meta
+                                WHERE name = 'match_keys'""").fetchone()
+            if version is None or version[0] != MATCH_KEYS_VERSION:
+                rows = c.execute("""SELECT id, name, address, city, state, zip
+                                 FROM ri_restaurants""").fetchall()
+                c.execute("""INSERT INTO ri_meta (name, value)
+                          VALUES ('match_keys', ?) ON CONFLICT (name)
+                          DO UPDATE SET value = excluded.value""",
+                          [MATCH_KEYS_VERSION])
+            else:
+                # add_restaurant writes every key, so one missing marks a
+                # row without them, found through the block index.
+                rows = c.execute("""SELECT id, name, address, city, state, zip
+                                 FROM ri_restaurants
+                                 WHERE block_key IS NULL""").fetchall()
+            values = []
+            for row in rows:
+                keys = restaurant_keys(dict(zip(
+                    ("name", "address", "city", "state", "zip"), row[1:])))
+                values.append(tuple(keys[column] for column in KEY_COLUMNS)
+                              + (row[0],))
+            c.executemany("UPDATE ri_restaurants SET %s WHERE id = ?"
+                          % ", ".join("%s = ?" % column
+                                      for column in KEY_COLUMNS), values)
+            if values:
+                c.execute("""UPDATE ri_meta SET value = lower(hex(randomblob(8)))
+                          WHERE name = 'epoch'""")
+        self.conn.commit()
+        return len(values)
+
+    def reserve_restaurant_ids(self, first_id):
+        """
+        Makes the restaurant ids handed out from now on larger than
+        first_id, through the AUTOINCREMENT counter of ri_restaurants.
+        Each shard of a sharded deployment reserves its own id range.
+
+        Inputs: first_id - (integer) id below every new restaurant id.
+        """
+        with closing(self.conn.cursor()) as c:
+            row = c.execute("""SELECT seq FROM sqlite_sequence
+                            WHERE name = 'ri_restaurants'""").fetchone()
+            if row is None:
+                c.execute("""INSERT INTO sqlite_sequence (name, seq)
+                          VALUES ('ri_restaurants', ?)""", [first_id])
+            elif row["seq"] < first_id:
+                c.execute("""UPDATE sqlite_sequence SET seq = ?
+                          WHERE name = 'ri_restaurants'""", [first_id])
+            self.conn.commit()
 
     def find_restaurant(self, restaurant_id):
         """
@@ -65,11 +213,10 @@ class DB:
         Inputs: restaurant_id - (integer) id for a restaurant.
         Returns: restaurant object if it exists, None if it does not.
         """
-        c = self.conn.cursor()
-        table = c.execute(""" SELECT * FROM ri_restaurants WHERE id == (?)""",
-                            [str(restaurant_id)])
-        results = table.fetchall()
-        c.close()
+        with closing(self.conn.cursor()) as c:
+            table = c.execute(""" SELECT %s FROM ri_restaurants WHERE id == (?)"""
+                                % RESTAURANT_COLUMNS, [str(restaurant_id)])
+            results = table.fetchall()
         if results == []:
              return None
         else:
@@ -83,34 +230,268 @@ class DB:
         Inputs: inspection_id - (string) id for an individual inspection.
         Returns: inspection object if it exists, None if it does not.
         """
-        c = self.conn.cursor()
-        table = c.execute(""" SELECT * FROM ri_inspections WHERE id == (?)""",
-                            [str(inspection_id)])
-        results = table.fetchall()
-        c.close()
+        with closing(self.conn.cursor()) as c:
+            table = c.execute("""SELECT id, risk, inspection_date,
+                              inspection_type, results, %s, restaurant_id
+                              FROM ri_inspections WHERE id == (?)"""
+                              % self.violations_column(),
+                              [str(inspection_id)])
+            results = table.fetchall()
         if results == []:
             return None
         else:
             return results
 
-    def find_inspections(self, restaurant_id):
+    def find_inspections(self, restaurant_id, after=None, limit=None,
+                         fields=None):
         """
-        Searches for all the inspection associated with a restaurant.
+        Searches for all the inspection associated with a restaurant, in
+        inspection id order.
 
         Inputs: restaurant_id - (integer) id for an restaurant.
+                after - (string) only return inspections with a greater id.
+                limit - (integer) maximum number of inspections to return.
+                fields - (list) columns to return, see INSPECTION_FIELDS.
         Returns: all inspections associated with the corresponding restaurant.
         """
-        c = self.conn.cursor()
-        table = c.execute("""SELECT i.id, risk,
-                            inspection_date, inspection_type, results,
-                            violations
-                            FROM ri_inspections as i JOIN ri_restaurants AS r 
-                            ON i.restaurant_id == r.id 
-                            WHERE restaurant_id == (?)""", [str(restaurant_id)])
-        results = table.fetchall()
-        c.close()
+        with closing(self.conn.cursor()) as c:
+            table = self.select_inspections(c, restaurant_id, after, limit, fields)
+            results = table.fetchall()
         return results
 
+    def find_inspection_rows(self, restaurant_id, after=None, limit=None,
+                             fields=None):
+        """
+        Like find_inspections, but returns the rows as tuples along with
+        one shared list of column names instead of a dict per row.
+
+        Returns: (columns, rows)
+        """
+        with closing(self.conn.cursor()) as c:
+            c.row_factory = None
+            table = self.select_inspections(c, restaurant_id, after, limit, fields)
+            results = table.fetchall()
+        return inspection_columns(fields), results
+
+    def iter_inspections(self, restaurant_id, after=None, limit=None,
+                         fields=None, batch_size=500):
+        """
+        Like find_inspections, but yields the inspections a batch at a time
+        instead of reading them all into memory.
+        """
+        c = self.conn.cursor()
+        try:
+            table = self.select_inspections(c, restaurant_id, after, limit,
+                                            fields)
+            while True:
+                rows = table.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            c.close()
+
+    def select_inspections(self, c, restaurant_id, after, limit, fields):
+        """
+        Runs the keyset-paginated inspection query on cursor c.
+        """
+        if fields is None:
+            fields = INSPECTION_FIELDS
+        for field in fields:
+            if field not in INSPECTION_FIELDS:
+                raise InspError("Unknown inspection field %s" % field)
+        # One statement per field list: no cursor is after "" and a
+        # negative limit is no limit.
+        sql = """SELECT %s FROM ri_inspections AS i
+                 WHERE i.restaurant_id == (?) AND i.id > (?)
+                 ORDER BY i.id LIMIT (?)""" % ", ".join(
+                    self.violations_column("i.") if field == "violations"
+                    else "i." + field for field in fields)
+        return c.execute(sql, [restaurant_id,
+                               "" if after is None else str(after),
+                               -1 if limit is None else limit])
+
+    def violations_column(self, prefix=""):
+        """
+        Returns: the select expression of the violations column, decoded
+                 when the database stores coded violations.
+        """
+        if codec_for(self.conn) is None:
+            return prefix + "violations"
+        return "violations_text(%sviolations) AS violations" % prefix
+
+    def stored_violations(self, inspection):
+        """
+        Returns: the violations of an inspection as they are stored.
+        """
+        violations = inspection.get("violations", None)
+        codec = codec_for(self.conn)
+        if codec is None:
+            return violations
+        return codec.encode(violations)
+
+    def index_violations(self, c, rowid, inspection):
+        """
+        Adds the violations of an inspection just inserted as rowid to the
+        full-text index.
+        """
+        violations = inspection.get("violations", None)
+        if violations:
+            c.execute("""INSERT INTO ri_inspections_fts (rowid, violations)
+                      VALUES (?, ?)""", (rowid, violations))
+
+    def rebuild_search_index(self):
+        """
+        Rebuilds the full-text indexes from the tables, after rows were
+        inserted around add_restaurant and add_inspection (the seed script).
+        """
+        with closing(self.conn.cursor()) as c:
+            c.execute("""INSERT INTO ri_restaurants_fts (ri_restaurants_fts)
+                      VALUES ('rebuild')""")
+            c.execute("""INSERT INTO ri_inspections_fts (ri_inspections_fts)
+                      VALUES ('delete-all')""")
+            c.execute("""INSERT INTO ri_inspections_fts (rowid, violations)
+                      SELECT rowid, %s FROM ri_inspections
+                      WHERE violations != ''""" % self.violations_column())
+            self.conn.commit()
+
+    def search_restaurants(self, query, limit, offset=0):
+        """
+        Full-text search of restaurant names and addresses, names weighing
+        more, best matches first.
+
+        Inputs: query - (string) words, "phrases" and prefix* terms.
+        Returns: the restaurants with their score.
+        """
+        match = fts_query(query)
+        if match is None:
+            return []
+        with closing(self.conn.cursor()) as c:
+            sql = """SELECT %s, -bm25(ri_restaurants_fts, 10.0, 1.0) AS score
+                     FROM ri_restaurants_fts JOIN ri_restaurants AS r
+                     ON r.id == ri_restaurants_fts.rowid
+                     WHERE ri_restaurants_fts MATCH (?)
+                     ORDER BY bm25(ri_restaurants_fts, 10.0, 1.0)
+                     LIMIT (?) OFFSET (?)""" % ", ".join(
+                        "r." + column.strip()
+                        for column in RESTAURANT_COLUMNS.split(","))
+            return c.execute(sql, [match, limit, offset]).fetchall()
+
+    def search_inspections(self, query, limit, offset=0):
+        """
+        Full-text search of the violations of inspections, best matches
+        first. Words are matched on their stem ("rodents" finds "rodent").
+
+        Inputs: query - (string) words, "phrases" and prefix* terms.
+        Returns: the inspections, with their restaurant's name and their
+                 score.
+        """
+        match = fts_query(query)
+        if match is None:
+            return []
+        with closing(self.conn.cursor()) as c:
+            sql = """SELECT i.id, i.restaurant_id, r.name, i.inspection_date,
+                     i.inspection_type, i.results,
+                     -bm25(ri_inspections_fts) AS score
+                     FROM ri_inspections_fts
+                     JOIN ri_inspections AS i
+                     ON i.rowid == ri_inspections_fts.rowid
+                     JOIN ri_restaurants AS r ON r.id == i.restaurant_id
+                     WHERE ri_inspections_fts MATCH (?)
+                     ORDER BY bm25(ri_inspections_fts)
+                     LIMIT (?) OFFSET (?)"""
+            return c.execute(sql, [match, limit, offset]).fetchall()
+
+    def count_inspection(self, c, inspection, restaurant):
+        """
+        Counts an inspection just inserted in the rollups of /stats, under
+        the zip code and facility type of its restaurant.
+        """
+        c.executemany(stats.ADD_COUNTS,
+                      stats.inspection_counts(inspection, restaurant))
+
+    def rebuild_stats(self):
+        """
+        Recounts the rollups of /stats from the tables, after rows were
+        inserted around add_inspection and add_tweet (the seed script).
+        """
+        with closing(self.conn.cursor()) as c:
+            c.execute("DELETE FROM ri_inspection_stats")
+            c.execute("DELETE FROM ri_tweet_stats")
+            c.execute(stats.COUNT_ALL)
+            c.execute(stats.COUNT_ALL_TWEETS)
+            self.conn.commit()
+
+    def inspection_stats(self, keys):
+        """
+        Inspections and their results by zip code, risk or facility type
+        and by month, from the rollups.
+
+        Inputs: keys - (list) what to group by, see stats.group_by; no
+                       keys for the totals.
+        Returns: the groups ordered by their keys, each with its keys, its
+                 counts and its pass and fail rates.
+        """
+        dimension = next((key for key in keys if key != "month"),
+                         stats.TOTALS_DIMENSION)
+        columns = ["month" if key == "month" else "value AS " + key
+                   for key in keys]
+        columns += ["coalesce(SUM(%s), 0) AS %s" % (counter, counter)
+                    for counter in stats.COUNTERS]
+        sql = """SELECT %s FROM ri_inspection_stats
+                 WHERE dimension == (?)""" % ", ".join(columns)
+        if keys:
+            group = ", ".join("month" if key == "month" else "value"
+                              for key in keys)
+            sql += """ GROUP BY %s HAVING SUM(inspections) > 0
+                      ORDER BY %s""" % (group, group)
+        with closing(self.conn.cursor()) as c:
+            groups = c.execute(sql, [dimension]).fetchall()
+        return [stats.with_rates(group) for group in groups]
+
+    def tweet_stats(self, limit):
+        """
+        The restaurants matched to the most tweets, from the rollups.
+
+        Inputs: limit - (integer) how many restaurants
+        Returns: the restaurants' id, name and tweet counts, most tweets
+                 first.
+        """
+        with closing(self.conn.cursor()) as c:
+            sql = """SELECT t.restaurant_id, r.name, t.tweets,
+                     t.name_matches, t.geo_matches, t.both_matches
+                     FROM ri_tweet_stats AS t
+                     JOIN ri_restaurants AS r ON r.id == t.restaurant_id
+                     ORDER BY t.tweets DESC, t.restaurant_id DESC
+                     LIMIT (?)"""
+            return c.execute(sql, [limit]).fetchall()
+
+    def restaurant_tweet_stats(self, restaurant_id):
+        """
+        The tweet counts of a restaurant, from the rollups.
+
+        Inputs: restaurant_id - (integer) restaurant id
+        Returns: the counts, zero for a restaurant without tweets.
+        """
+        with closing(self.conn.cursor()) as c:
+            row = c.execute("""SELECT restaurant_id, tweets, name_matches,
+                            geo_matches, both_matches FROM ri_tweet_stats
+                            WHERE restaurant_id == (?)""",
+                            [restaurant_id]).fetchone()
+        if row is None:
+            row = {"restaurant_id": restaurant_id, "tweets": 0,
+                   "name_matches": 0, "geo_matches": 0, "both_matches": 0}
+        return row
+
+    def count_inspections(self):
+        """
+        Counts the inspections in the database.
+        """
+        with closing(self.conn.cursor()) as c:
+            table = c.execute("""SELECT COUNT(id) as cnt FROM ri_inspections""")
+            count = table.fetchone()["cnt"]
+        return count
+
     def add_inspection_for_restaurant(self, inspection, restaurant):
         """
         Finds or creates the restaurant then inserts the inspection and
@@ -141,43 +522,123 @@ class DB:
         else:
             return None
     
-    def add_inspection(self, inspection, restaurant_id):
+    def add_inspection(self, inspection, restaurant_id, restaurant=None):
         """
         Adds an inspection into the database. If the corresponding restaurant 
         does not already exist, it is created.
 
         Inputs: inspection - (object) data structure containing inspection.
                 restuarant_id - (integer) id for an restaurant.
+                restaurant - (object) the restaurant's zip and
+                             facility_type, read from the database when
+                             not given.
         """
         inspection_id = inspection["inspection_id"]
-        c = self.conn.cursor()
-        c.execute("""INSERT INTO ri_inspections 
-                    (id,risk,inspection_date,inspection_type,
-                    results,violations,restaurant_id)
-                    VALUES (?,?,?,?,?,?,?)""", 
-                    (inspection_id, inspection.get("risk", None),
-                    inspection.get("date", None),
-                    inspection.get("inspection_type", None),
-                    inspection.get("results", None),
-                    inspection.get("violations", None), restaurant_id))
-        c.close()
+        with closing(self.conn.cursor()) as c:
+            c.execute("""INSERT INTO ri_inspections 
+                        (id,risk,inspection_date,inspection_type,
+                        results,violations,restaurant_id)
+                        VALUES (?,?,?,?,?,?,?)""", 
+                        (inspection_id, inspection.get("risk", None),
+                        inspection.get("date", None),
+                        inspection.get("inspection_type", None),
+                        inspection.get("results", None),
+                        self.stored_violations(inspection), restaurant_id))
+            self.index_violations(c, c.lastrowid, inspection)
+            if restaurant is None:
+                restaurant = c.execute("""SELECT zip, facility_type
+                                       FROM ri_restaurants WHERE id == (?)""",
+                                       [restaurant_id]).fetchone() or {}
+            self.count_inspection(c, inspection, restaurant)
     
     def add_restaurant(self, data, clean = False):
         """
-        Reads in data and adds a restaurant to the database.
+        Reads in data and adds a restaurant to the database, along with its
+        normalized match keys.
 
         Inputs: data (JSON) - information about restaurant
+        Returns: the id of the new restaurant.
         """
-        c = self.conn.cursor()
-        c.execute(""" INSERT INTO ri_restaurants 
-                    (name, facility_type, address, city, state, zip,
-                    latitude, longitude, clean) VALUES (?,?,?,?,?,?,?,?,?)""",
-                    (data["name"], data.get("facility_type", None),
-                    data.get("address", None), data.get("city", None),
-                    data.get("state", None), data.get("zip", None),
-                    data.get("latitude", None), data.get("longitude", None),
-                    clean))
-        c.close()
+        keys = restaurant_keys(data)
+        with closing(self.conn.cursor()) as c:
+            c.execute(""" INSERT INTO ri_restaurants 
+                        (name, facility_type, address, city, state, zip,
+                        latitude, longitude, clean, %s)
+                        VALUES (?,?,?,?,?,?,?,?,?,%s)""" % (", ".join(KEY_COLUMNS),
+                                            ",".join("?" * len(KEY_COLUMNS))),
+                        (data["name"], data.get("facility_type", None),
+                        data.get("address", None), data.get("city", None),
+                        data.get("state", None), data.get("zip", None),
+                        data.get("latitude", None), data.get("longitude", None),
+                        clean) + tuple(keys[column] for column in KEY_COLUMNS))
+            restaurant_id = c.lastrowid
+            c.execute("""INSERT INTO ri_restaurants_fts (rowid, name, address)
+                      VALUES (?, ?, ?)""", (restaurant_id, data["name"],
+                                            data.get("address", None)))
+            if self.store is not None:
+                keys.update(data)
+                self.store.append(restaurant_id, keys, clean)
+            return restaurant_id
+
+    def ingest_inspection(self, data):
+        """
+        Adds a posted inspection unless its id was already loaded, creating
+        its restaurant when no restaurant has its name and address.
+
+        The inspection of a known restaurant is inserted with ON CONFLICT
+        DO NOTHING, the changed row count telling a new inspection from a
+        repeat, instead of looking the inspection up first.
+
+        Inputs: data - (object) the posted inspection and restaurant.
+        Returns: (restaurant, outcome) where restaurant is {"id": ...}, None
+                 for a repeated inspection of an unknown restaurant, and
+                 outcome is "added", "created" (with a new restaurant) or
+                 "duplicate".
+        """
+        inspection_id = data["inspection_id"]
+        with closing(self.conn.cursor()) as c:
+            c.row_factory = None
+            row = c.execute("""SELECT id, zip, facility_type
+                            FROM ri_restaurants
+                            WHERE name == (?) AND address == (?)
+                            ORDER BY id LIMIT 1""",
+                            (data["name"], data["address"])).fetchone()
+            if row is not None:
+                # Coding violations with a new heading writes it to
+                # ri_violation_clauses, so those are inserted as text and
+                # coded once the insert is known not to be a repeat.
+                codec = codec_for(self.conn)
+                deferred = (codec is not None
+                            and not codec.known(data.get("violations", None)))
+                c.execute("""INSERT INTO ri_inspections
+                          (id, risk, inspection_date, inspection_type,
+                          results, violations, restaurant_id)
+                          VALUES (?,?,?,?,?,?,?)
+                          ON CONFLICT (id) DO NOTHING""",
+                          (inspection_id, data.get("risk", None),
+                          data.get("date", None),
+                          data.get("inspection_type", None),
+                          data.get("results", None),
+                          data["violations"] if deferred
+                          else self.stored_violations(data), row[0]))
+                if not c.rowcount:
+                    return {"id": row[0]}, "duplicate"
+                rowid = c.lastrowid
+                if deferred:
+                    c.execute("""UPDATE ri_inspections SET violations = ?
+                              WHERE rowid = ?""",
+                              (codec.encode(data["violations"]), rowid))
+                self.index_violations(c, rowid, data)
+                self.count_inspection(c, data, {"zip": row[1],
+                                                "facility_type": row[2]})
+                return {"id": row[0]}, "added"
+            seen = c.execute("""SELECT 1 FROM ri_inspections WHERE id == (?)""",
+                             [str(inspection_id)]).fetchone()
+        if seen is not None:
+            return None, "duplicate"
+        restaurant = {"id": self.add_restaurant(data)}
+        self.add_inspection(data, restaurant["id"], data)
+        return restaurant, "created"
 
     def find_restaurant_by_name_adress(self, restaurant_name,
                                              restaurant_address,
@@ -191,27 +652,26 @@ class DB:
                 restaurant_address - (string) address of a restaurant object
         Returns: Restaurant (object) if it exists, None if it does not.
         """
-        c = self.conn.cursor()
-        if return_all_attr:
-            table = c.execute("""SELECT id, 
-                                        name, 
-                                        facility_type, 
-                                        address, 
-                                        city, 
-                                        state, 
-                                        zip, 
-                                        latitude, 
-                                        longitude, 
-                                        clean 
-                                FROM ri_restaurants 
-                                WHERE name == (?) AND address == (?)""",
-                            (restaurant_name, restaurant_address))
-        else:
-            table = c.execute("""SELECT id FROM ri_restaurants 
-                                WHERE name == (?) AND address == (?)""",
+        with closing(self.conn.cursor()) as c:
+            if return_all_attr:
+                table = c.execute("""SELECT id, 
+                                            name, 
+                                            facility_type, 
+                                            address, 
+                                            city, 
+                                            state, 
+                                            zip, 
+                                            latitude, 
+                                            longitude, 
+                                            clean 
+                                    FROM ri_restaurants 
+                                    WHERE name == (?) AND address == (?)""",
                                 (restaurant_name, restaurant_address))
-        results = table.fetchall()
-        c.close()
+            else:
+                table = c.execute("""SELECT id FROM ri_restaurants 
+                                    WHERE name == (?) AND address == (?)""",
+                                    (restaurant_name, restaurant_address))
+            results = table.fetchall()
         if results == []:
             return None
         else:
@@ -228,18 +688,27 @@ class DB:
         Inputs: inspection_id - (string) id for an individual inspection.
         Returns: Restaurant (object) if it exists.
         """
+        # Only the raw row needs the inspection's columns.
+        if not raw:
+            columns = "r.name, r.address"
+        elif codec_for(self.conn) is None:
+            columns = "*"
+        else:
+            # The decoded column comes last and replaces the stored one in
+            # the row dict.
+            columns = "*, " + self.violations_column("i.")
         try:
-            c = self.conn.cursor()
-            table = c.execute("""SELECT * FROM ri_inspections as i
-                                JOIN ri_restaurants as r ON
-                                r.id = i.restaurant_id
-                                WHERE i.id == (?)""", [str(inspection_id)])
-            results = table.fetchall()
-            if raw:
-                return results[0]
-            name = results[0]["name"]
-            address = results[0]["address"]
-            c.close()
+            with closing(self.conn.cursor()) as c:
+                table = c.execute("""SELECT %s FROM ri_inspections as i
+                                    JOIN ri_restaurants as r ON
+                                    r.id = i.restaurant_id
+                                    WHERE i.id == (?)""" % columns,
+                                  [str(inspection_id)])
+                results = table.fetchall()
+                if raw:
+                    return results[0]
+                name = results[0]["name"]
+                address = results[0]["address"]
             return self.find_restaurant_by_name_adress(name, address)
         except Exception as e:
             print(e, "find_restaurant_by_inspection_id")
@@ -255,6 +724,15 @@ class DB:
         Aborts
         """
         self.conn.rollback()
+        # Clause ids the codec added may have been rolled back.
+        release_codec(self.conn)
+
+    def commit_writes(self):
+        """
+        Commits a cleaning write unless commits are deferred.
+        """
+        if not self.defer_commits:
+            self.conn.commit()
 
     def set_transaction_size(self, transaction_size):
         """
@@ -270,15 +748,15 @@ class DB:
         Returns: a list of tweets
         """
         try:
-            c = self.conn.cursor()
-            sql = """select tkey, match from ri_tweetmatch 
-                     where restaurant_id == (?)"""
-            table = c.execute(sql, [str(restaurant_id)]).fetchall()
-            return table
+            with closing(self.conn.cursor()) as c:
+                sql = """select tkey, match from ri_tweetmatch 
+                         where restaurant_id == (?)"""
+                return c.execute(sql, [str(restaurant_id)]).fetchall()
         except:
             return []
         
-    def match_tweet_restaurant(self, tweet, tweet_ngrams, lat, lon):
+    def match_tweet_restaurant(self, tweet, tweet_ngrams, lat, lon,
+                               name_match="exact"):
         """
         Find a restaurant match of a tweet
 
@@ -286,9 +764,15 @@ class DB:
                 tweet_ngrams - (list) n grams of words in tweet
                 lat - (string) latitude
                 lon - (string) longitude
+                name_match - (string) "exact" to match names equal to an
+                             n gram, "fts" for names found as a phrase in
+                             the tweet through the full-text index
         Returns: a dictionary of matches
         """
-        match_by_name = self.match_by_name(tweet_ngrams)
+        if name_match == "fts":
+            match_by_name = self.match_by_name_fts(tweet["text"])
+        else:
+            match_by_name = self.match_by_name(tweet_ngrams)
         matches = {rest_id: "name" for rest_id in match_by_name}
         if lat and lon:
             match_by_geo = self.match_by_geo(float(lat), float(lon))
@@ -309,18 +793,43 @@ class DB:
         Inputs: tweet_ngrams - (list) n grams of words in tweet
         Returns: rv - (list) a list of matches
         """
+        if self.store is not None:
+            return self.store.match_by_name(tweet_ngrams)
         try:
-            c = self.conn.cursor()
-            questionmarks = '?' * len(tweet_ngrams)
-            sql = """select id from ri_restaurants 
-                    where lower(name) in (%s)""" % (",").join(questionmarks)
-            table = c.execute(sql, tweet_ngrams).fetchall()
-            rv = [dct["id"] for dct in table]
-            c.close()
+            with closing(self.conn.cursor()) as c:
+                sql = """select id from ri_restaurants where lower(name)
+                        in (select value from json_each(?))"""
+                table = c.execute(sql, [json.dumps(tweet_ngrams)]).fetchall()
+                rv = [dct["id"] for dct in table]
             return rv
         except:
             return []
 
+    def match_by_name_fts(self, text):
+        """
+        Find the restaurants whose whole name occurs in text as a phrase,
+        ignoring case and punctuation and whatever its length. Candidates
+        are the names starting with a word of text, from the full-text
+        index.
+
+        Inputs: text - (string) the tweet
+        Returns: rv - (list) a list of matches
+        """
+        words, match = name_phrases(text)
+        if match is None:
+            return []
+        try:
+            with closing(self.conn.cursor()) as c:
+                c.row_factory = None
+                table = c.execute("""SELECT rowid, name FROM ri_restaurants_fts
+                                  WHERE ri_restaurants_fts MATCH (?)""",
+                                  [match]).fetchall()
+            return [rest_id for rest_id, name in table
+                    if contains_phrase(words, tokens(name))]
+        except Exception as e:
+            print(e, "error matching tweet names")
+            return []
+
     def match_by_geo(self, lat, lon):
         """
         Find a restaurant match by comparing latitiude
@@ -330,17 +839,18 @@ class DB:
                 lon - (string) longitude
         Returns: rv - (list) a list of matches
         """
+        if self.store is not None:
+            return self.store.match_by_geo(lat, lon)
         try:
-            c = self.conn.cursor()
-            range_loc = [lat - 0.00225001,
-                         lat + 0.00225001,
-                         lon - 0.00302190,
-                         lon + 0.00302190]
-            sql = """SELECT id FROM ri_restaurants WHERE latitude 
-                    BETWEEN ? AND ? AND longitude BETWEEN ? AND ?"""
-            table = c.execute(sql, range_loc).fetchall()
-            rv = [dct["id"] for dct in table]
-            c.close()
+            with closing(self.conn.cursor()) as c:
+                range_loc = [lat - 0.00225001,
+                             lat + 0.00225001,
+                             lon - 0.00302190,
+                             lon + 0.00302190]
+                sql = """SELECT id FROM ri_restaurants WHERE latitude 
+                        BETWEEN ? AND ? AND longitude BETWEEN ? AND ?"""
+                table = c.execute(sql, range_loc).fetchall()
+                rv = [dct["id"] for dct in table]
             return rv
         except Exception as e:
             return []
@@ -353,11 +863,12 @@ class DB:
                 rest_id - (integer) restaurant id
                 match - (string) how the tweet was matched.
         """
-        c = self.conn.cursor()
-        c.execute(""" INSERT INTO ri_tweetmatch 
-                    (tkey, restaurant_id, match) VALUES (?,?,?)""",
-                    (tweet_key, rest_id, match))
-        c.close()
+        with closing(self.conn.cursor()) as c:
+            c.execute(""" INSERT INTO ri_tweetmatch 
+                        (tkey, restaurant_id, match) VALUES (?,?,?)""",
+                        (tweet_key, rest_id, match))
+            c.execute(stats.ADD_TWEET, (rest_id, match == "name",
+                                        match == "geo", match == "both"))
         
     def add_tweet(self, tweet_key, matches):
         """
@@ -376,16 +887,20 @@ class DB:
 
         Returns: All not cleaned restaurants.
         '''
+        if self.store is not None:
+            return self.store.not_clean()
         try:
-            c = self.conn.cursor()
-            sql = """SELECT *
-            FROM ri_restaurants WHERE clean == 0"""
-            table = c.execute(sql).fetchall()
+            with closing(self.conn.cursor()) as c:
+                c.row_factory = CLEAN_ROW_FACTORY
+                sql = """SELECT *
+                FROM ri_restaurants WHERE clean == 0"""
+                table = c.execute(sql).fetchall()
             return table
         except Exception as e:
             return []
     
-    def find_linked(self, restaurant_main, restaurants, parameter):
+    def find_linked(self, restaurant_main, restaurants, parameter,
+                    scorer = None):
         '''
         Takes the restaurant identified as the main and gets all
         restaurants within a similaritty score of it.
@@ -394,28 +909,27 @@ class DB:
                 restaurants (list) - list of restaurants that will
                                      be checked for similarity
                 parameter (float) - threshold determined for similarity
+                scorer (PairScorer) - scoring cascade and its counters,
+                                      by default state, city and name
+                                      compared against parameter
         
         Returns: list of all restuarants linked to main
         '''
         try:  
+            if scorer is None:
+                from scoring import PairScorer
+                scorer = PairScorer(parameter)
             ids = []
             linked_rests = {restaurant_main["id"]:[]}
             for restaurant in restaurants:
-                jw_state = td.jaro_winkler(restaurant_main["state"].lower(),
-                                        restaurant["state"].lower())
-                jw_city = td.jaro_winkler(restaurant_main["city"].lower(),
-                                        restaurant["city"].lower())
-                if jw_state >= parameter and jw_city >= parameter:
-                    jw_name  = td.jaro_winkler(restaurant_main["name"].lower(),
-                                        restaurant["name"].lower())
-                    if jw_name >= parameter:
-                        linked_rests[restaurant_main["id"]].append(restaurant)
-                        ids.append(restaurant["id"])
+                if scorer.match(restaurant_main, restaurant):
+                    linked_rests[restaurant_main["id"]].append(restaurant)
+                    ids.append(restaurant["id"])
             return (linked_rests, ids)
         except Exception as e:
             print(e)
 
-    def find_all_linked(self, parameter, block = False):
+    def find_all_linked(self, parameter, block = False, scorer = None):
         '''
         Finds all linked restaurants for every restauarant in the DB.
 
@@ -424,31 +938,54 @@ class DB:
         Retuens: list of linked restaurants
         '''
         try:
-            all_ids = []
             not_clean = list(self.not_clean())
             all_restaurants = list(self.find_all_restaurants())
-            linked_rests = []
-            for restaurant_main in not_clean:
-                if restaurant_main["id"] not in all_ids:
-                    dct_linked, ids_temp = self.find_linked(restaurant_main,
-                                                all_restaurants, parameter)
-                    linked_rests.append(dct_linked)
-                    all_ids += ids_temp
-            return linked_rests
+            return self.link_restaurants(not_clean, all_restaurants, parameter,
+                                         scorer)
         except Exception as e:
             return None
 
-    def find_all_restaurants(self, table_name = None):
+    def link_restaurants(self, not_clean, all_restaurants, parameter,
+                         scorer = None):
         '''
-        Returns all resturants
+        Links every not cleaned restaurant to all of the restaurants
+        similar to it.
+
+        Inputs: not_clean (list) - restaurants that still need cleaning
+                all_restaurants (list) - restaurants to compare them with
+                parameter (float) - threshold determined for similarity
+                scorer (PairScorer) - optional scoring cascade
+
+        Returns: list of linked restaurants
         '''
-        c = self.conn.cursor()
-        if table_name:
-            list_index_matched = self.get_candidates_within_block(table_name)
+        if scorer is None:
+            from scoring import PairScorer
+            scorer = PairScorer(parameter)
+        all_ids = set()
+        linked_rests = []
+        for restaurant_main in not_clean:
+            if restaurant_main["id"] not in all_ids:
+                dct_linked, ids_temp = self.find_linked(restaurant_main,
+                                            all_restaurants, parameter, scorer)
+                linked_rests.append(dct_linked)
+                all_ids.update(ids_temp)
+        return linked_rests
+
+    def find_all_restaurants(self, chunk = None):
+        '''
+        Returns all resturants, or the candidate pairs of one block
+        when given its chunk of block keys.
+        '''
+        if chunk:
+            return self.get_candidates_within_block(chunk)
+        elif self.store is not None:
+            return self.store.all_rows()
         else:
-            sql = """SELECT *
-            FROM ri_restaurants"""
-            table = c.execute(sql).fetchall()
+            with closing(self.conn.cursor()) as c:
+                c.row_factory = CLEAN_ROW_FACTORY
+                sql = """SELECT *
+                FROM ri_restaurants"""
+                table = c.execute(sql).fetchall()
             return table
 
     def gen_aut_restaurant(self, matched_restaurants):
@@ -484,6 +1021,7 @@ class DB:
                         composite_id = dct["id"]
                         break
                 self.add_linked_restaurants(composite_id, restaurant_ids)
+                self.add_cluster(composite_id, restaurant_ids)
                 self.update_cleaned_restaurant(restaurant_ids)
                 self.update_inspection_restaurant_id(composite_id,
                                                     restaurant_ids)
@@ -527,14 +1065,13 @@ class DB:
                 restaurant_ids (list) - list of restaurant ids
         '''
         try:
-            c = self.conn.cursor()
-            for restaurant_id in restaurant_ids:   
-                c.execute(""" INSERT INTO ri_linked 
-                            (primary_rest_id, original_rest_id) 
-                            VALUES (?, ?)""",
-                            (str(composite_id), str(restaurant_id)))
-            self.conn.commit()
-            c.close()
+            with closing(self.conn.cursor()) as c:
+                for restaurant_id in restaurant_ids:   
+                    c.execute(""" INSERT INTO ri_linked 
+                                (primary_rest_id, original_rest_id) 
+                                VALUES (?, ?)""",
+                                (str(composite_id), str(restaurant_id)))
+                self.commit_writes()
         except Exception as e:
             return []
         
@@ -545,15 +1082,16 @@ class DB:
         Inputs: restaurant_ids (list) - a list of restaurant ids to
                                         be updated.
         '''
+        if self.store is not None:
+            self.store.set_clean(restaurant_ids)
         try:
-            c = self.conn.cursor()
-            for rest_id in restaurant_ids:  
-                sql = """UPDATE ri_restaurants 
-                        SET clean = 1 
-                        WHERE id == (?)"""
-                c.execute(sql, [str(rest_id)])
-            self.conn.commit()
-            c.close()
+            with closing(self.conn.cursor()) as c:
+                for rest_id in restaurant_ids:  
+                    sql = """UPDATE ri_restaurants 
+                            SET clean = 1 
+                            WHERE id == (?)"""
+                    c.execute(sql, [str(rest_id)])
+                self.commit_writes()
         except Exception as e:
             return []
 
@@ -562,14 +1100,21 @@ class DB:
         Updates the inspection 
         '''
         try:
-            c = self.conn.cursor()
-            questionmarks = '?' * len(link_ids)
-            sql = """UPDATE ri_inspections 
-                    SET restaurant_id = (?) 
-                    WHERE restaurant_id IN (%s)""" % (",").join(questionmarks)
-            c.execute(sql, [str(clean_id)] + link_ids)
-            self.conn.commit()
-            c.close()
+            with closing(self.conn.cursor()) as c:
+                link_json = json.dumps(link_ids)
+                # The rollups move the inspections to the composite's groups.
+                moved = c.execute(stats.MOVED_INSPECTIONS,
+                                  [link_json]).fetchall()
+                composite = c.execute("""SELECT zip, facility_type
+                                      FROM ri_restaurants WHERE id == (?)""",
+                                      [clean_id]).fetchone()
+                c.executemany(stats.ADD_COUNTS,
+                              stats.moved_counts(moved, composite))
+                sql = """UPDATE ri_inspections 
+                        SET restaurant_id = (?) 
+                        WHERE restaurant_id IN (SELECT value FROM json_each(?))"""
+                c.execute(sql, [str(clean_id), link_json])
+                self.commit_writes()
         except Exception as e:
             print(e, "error")
     
@@ -582,20 +1127,98 @@ class DB:
         Returns: a tuple of all the linked restaurants and the primary
                  restaurant associated with the inspection.
         '''
-        try:  
-            p_restaurant = self.find_restaurant_by_inspection_id(inspection_id,
-                                                                True)
-            attributes = ["id", "name", "facility_type", "address",
-                          "city", "state", "zip", "latitude",
-                          "longitude", "clean"]
-            p_restaurant = {attribute:p_restaurant[attribute] 
-                            for attribute in attributes}
-            p_restaurant_id = p_restaurant["id"]
-            linked_restaurants = self.find_linked_restaurants(p_restaurant_id)
-            return (linked_restaurants, p_restaurant)
+        try:
+            with closing(self.conn.cursor()) as c:
+                sql = """SELECT i.restaurant_id, p.primary_rest_id, cl.member_ids
+                         FROM ri_inspections AS i
+                         LEFT JOIN ri_primary AS p
+                         ON p.restaurant_id == i.restaurant_id
+                         LEFT JOIN ri_clusters AS cl
+                         ON cl.primary_rest_id == p.primary_rest_id
+                         WHERE i.id == (?)"""
+                row = c.execute(sql, [str(inspection_id)]).fetchone()
+            return self.cluster_restaurants(row)
         except Exception as e:
             print(e, "error_find_all_by_insp")
 
+    def find_cluster(self, restaurant_id):
+        '''
+        Finds the primary restaurant of a restaurant and all of the
+        restaurants linked to that primary.
+
+        Inputs: restuarant_id - (integer) id for an restaurant.
+
+        Returns: a tuple of all the linked restaurants and the primary
+                 restaurant, or None if the restaurant does not exist.
+        '''
+        if self.store is not None:
+            cluster = self.store.cluster_ids(restaurant_id)
+            return self.read_cluster(*cluster) if cluster is not None else None
+        try:
+            with closing(self.conn.cursor()) as c:
+                sql = """SELECT r.id AS restaurant_id, p.primary_rest_id,
+                         cl.member_ids
+                         FROM ri_restaurants AS r
+                         LEFT JOIN ri_primary AS p ON p.restaurant_id == r.id
+                         LEFT JOIN ri_clusters AS cl
+                         ON cl.primary_rest_id == p.primary_rest_id
+                         WHERE r.id == (?)"""
+                row = c.execute(sql, [restaurant_id]).fetchone()
+            return self.cluster_restaurants(row)
+        except Exception as e:
+            print(e, "error_find_cluster")
+
+    def cluster_restaurants(self, row):
+        '''
+        Reads the restaurants of a resolved cluster. A restaurant that was
+        never linked is its own primary and has no linked restaurants.
+
+        Inputs: row - (object) restaurant_id, primary_rest_id and member_ids
+                      of a restaurant, as read from ri_primary/ri_clusters.
+
+        Returns: a tuple of the linked restaurants and the primary restaurant.
+        '''
+        if row is None:
+            return None
+        primary_id = row["primary_rest_id"] or row["restaurant_id"]
+        member_ids = json.loads(row["member_ids"] or "[]")
+        return self.read_cluster(primary_id, member_ids)
+
+    def read_cluster(self, primary_id, member_ids):
+        '''
+        Reads the primary and linked restaurants of a cluster.
+
+        Returns: a tuple of the linked restaurants and the primary restaurant.
+        '''
+        with closing(self.conn.cursor()) as c:
+            sql = """SELECT id, name, facility_type, address, city, state, zip,
+                     latitude, longitude, clean FROM ri_restaurants
+                     WHERE id IN (SELECT value FROM json_each(?))"""
+            rows = c.execute(sql, [json.dumps([primary_id] + member_ids)]).fetchall()
+        by_id = {rest["id"]: rest for rest in rows}
+        linked_restaurants = [by_id[rest_id] for rest_id in member_ids
+                              if rest_id in by_id]
+        return (linked_restaurants, by_id[primary_id])
+
+    def add_cluster(self, composite_id, restaurant_ids):
+        '''
+        Records the composite as the primary of itself and of every
+        restaurant linked to it, along with the cluster's member list.
+
+        Inputs: composite_id (int) - composite restaurant id
+                restaurant_ids (list) - list of linked restaurant ids
+        '''
+        with closing(self.conn.cursor()) as c:
+            c.executemany("""INSERT OR REPLACE INTO ri_primary
+                            (restaurant_id, primary_rest_id) VALUES (?, ?)""",
+                          [(rest_id, composite_id)
+                           for rest_id in [composite_id] + restaurant_ids])
+            c.execute("""INSERT OR REPLACE INTO ri_clusters
+                         (primary_rest_id, member_ids) VALUES (?, ?)""",
+                      (composite_id, json.dumps(restaurant_ids)))
+            self.commit_writes()
+        if self.store is not None:
+            self.store.add_cluster(composite_id, restaurant_ids)
 
     def find_primary_restaurant(self, restaurant_id):
         '''
@@ -607,16 +1230,16 @@ class DB:
         Returns: primary restaurant if it exists
         '''
         try:
-            c = self.conn.cursor()
-            sql = """ SELECT primary_rest_id FROM ri_linked
-                    WHERE original_rest_id == (?)"""
-            table = c.execute(sql, [restaurant_id]).fetchall()
-            print(table, "table find p rest")
+            with closing(self.conn.cursor()) as c:
+                sql = """ SELECT r.id, r.name, r.facility_type, r.address, r.city,
+                        r.state, r.zip, r.latitude, r.longitude, r.clean
+                        FROM ri_primary AS p
+                        JOIN ri_restaurants AS r ON r.id == p.primary_rest_id
+                        WHERE p.restaurant_id == (?)"""
+                table = c.execute(sql, [restaurant_id]).fetchall()
             if table == []:
                 return []
-            primary_rest_id = table[0]["primary_rest_id"]
-            primary_restaurant = self.find_restaurant(primary_rest_id)
-            return primary_restaurant[0]
+            return table[0]
         except Exception as e:
             return []
     
@@ -631,143 +1254,150 @@ class DB:
                  the primary restaurant id.
         '''
         try:
-            c = self.conn.cursor()
-            sql = """ SELECT rir.id, rir.name, rir.facility_type,
-                       rir.address, rir.city, rir.state, rir.zip,
-                       rir.latitude, rir.longitude, rir.clean
-                       FROM ri_linked as ril 
-                       INNER JOIN ri_restaurants as rir
-                       ON ril.original_rest_id == rir.id
-                       WHERE primary_rest_id == (?)"""
-            table = c.execute(sql, [primary_rest_id]).fetchall()
-            return table
+            with closing(self.conn.cursor()) as c:
+                sql = """ SELECT rir.id, rir.name, rir.facility_type,
+                           rir.address, rir.city, rir.state, rir.zip,
+                           rir.latitude, rir.longitude, rir.clean
+                           FROM ri_linked as ril 
+                           INNER JOIN ri_restaurants as rir
+                           ON ril.original_rest_id == rir.id
+                           WHERE primary_rest_id == (?)"""
+                return c.execute(sql, [primary_rest_id]).fetchall()
         except Exception as e:
             print(e, "find_linked_restaurants")
             return []
 
-    def create_blocks(self, num_blocks):
+    def block_chunks(self, num_blocks):
         """
-        Creates #n blocks within the database based on the 
-        first letter of restaurant names. Creates chunks 
-        of letters and adds the restaurant to the chunk if the 
-        first letter of the restaurant is in that chunk.
+        Splits the letters and digits restaurant names start with (their
+        block keys) into num_blocks chunks.
         Inputs:
             - num_blocks: Number of blocks to be created.
         Returns:
-            - nothing. Updates the dataset.
-        """
-        try:    
-            c = self.conn.cursor()
-            alphabet_string = list(string.ascii_lowercase)
-            for i in range(0, 10):
-                alphabet_string.append(str(i))
-            n = math.ceil(len(alphabet_string)/num_blocks)
-            chunks = [alphabet_string[x:x+n] for x in range(0, len(alphabet_string), n)]
-            for index, chunk in enumerate(chunks):
-                questionmarks = '?' * len(chunk)
-                temp_table_name = f"ri_rest_b_{index + 1}"
-                temp_table_query = """CREATE TEMPORARY TABLE \"{}\" 
-                                    AS SELECT id, name, facility_type,
-                                    address, city, state, zip,
-                                    latitude, longitude, clean  
-                                    FROM ri_restaurants WHERE SUBSTR(LOWER(name), 1, 1) IN ({})""".format(temp_table_name, (",").join(questionmarks))
-                c.execute(temp_table_query, chunk)
-                self.conn.commit()
-        except Exception as e:
-            print(e, "error from create_blocks")
-    
-    def create_index(self, table_name, index_num):
-        """
-        Creates an index in the block based on the 
-        first 4 digits of the restaurants zip code. 
-        Inputs:
-            - table_name(str): name of the block table
-            - index_num(int): unique number for the index name
-        Returns:
-            - nothing. Updates the database.
-        """
-        try:
-            c = self.conn.cursor()
-            index_query = """CREATE INDEX zip_index_{}
-                            ON {} (SUBSTR(zip, 0, 5))""".format(index_num, table_name)
-            c.execute(index_query)
-            self.conn.commit()
-        except Exception as e:
-            print(e, "error from create_index")
-    
-    def get_block_names(self):
+            - chunks (list of lists): the characters of each block.
         """
-        Gets the temporary table names in the database.
-            - Returns:
-                table (list): list of temporary table names.
-        """
-        try:
-            c = self.conn.cursor()
-            table = c.execute("""SELECT tbl_name FROM sqlite_temp_master where 
-                         type='table' and tbl_name like 'ri_rest_b_%'""").fetchall()
-            table = [dct["tbl_name"] for dct in table]
-            return table
-        except Exception as e:
-            print(e, "error in get block names")
-    
-    def get_candidates_within_block(self, table_name):
+        alphabet_string = list(string.ascii_lowercase)
+        for i in range(0, 10):
+            alphabet_string.append(str(i))
+        n = math.ceil(len(alphabet_string)/num_blocks)
+        return [alphabet_string[x:x+n] for x in range(0, len(alphabet_string), n)]
+
+    def get_candidates_within_block(self, chunk):
         """
         Gets the candidates for matching algorithm within the block
-        based on the first 4 digits of the zip code.
+        based on the first 4 digits of the zip code. Rows with the same
+        zip prefix share one candidate list. The block is read straight
+        from ri_restaurants through the (block_key, zip_prefix) index,
+        so nothing is copied and the call can be repeated.
         Inputs: 
-            - table_name: name of the block
+            - chunk (list): block keys (first characters) of the block
         Returns:
             - candidate_blocks (list of tuples): candidates for matching
             (row, list of candidates)
         """
         try:
             candidate_blocks = []
-            c = self.conn.cursor()
-            rows = c.execute(f"SELECT * FROM {table_name} WHERE clean == 0")
-            for row in rows.fetchall():
-                _zip_subcode = row["zip"][:4]
-                query = f"SELECT * FROM {table_name} WHERE SUBSTR(zip, 0, 5) == (?)"""
-                cantidate_temp = c.execute(query, [_zip_subcode]).fetchall()
-                candidate_blocks.append((row, cantidate_temp))
+            candidates_by_zip = {}
+            keys = json.dumps(list(chunk))
+            with closing(self.conn.cursor()) as c:
+                c.row_factory = CLEAN_ROW_FACTORY
+                rows = c.execute("""SELECT * FROM ri_restaurants
+                                 WHERE block_key IN (SELECT value FROM json_each(?))
+                                 AND clean == 0 ORDER BY id""", [keys])
+                query = """SELECT * FROM ri_restaurants
+                        WHERE block_key IN (SELECT value FROM json_each(?))
+                        AND zip_prefix == (?) ORDER BY id"""
+                for row in rows.fetchall():
+                    _zip_subcode = row["zip_prefix"]
+                    cantidate_temp = candidates_by_zip.get(_zip_subcode)
+                    if cantidate_temp is None:
+                        cantidate_temp = c.execute(query,
+                                            [keys, _zip_subcode]).fetchall()
+                        candidates_by_zip[_zip_subcode] = cantidate_temp
+                    candidate_blocks.append((row, cantidate_temp))
             return candidate_blocks
         except Exception as e:
             print(e, "error in get candidates_within_block")
 
-    def match_with_blocking(self, block_name, parameter):
+    def match_with_blocking(self, chunk, parameter, scorer = None):
         """
         Matches the candidate restaurants comes within a block and with
         similar zip codes.
 
         Inputs:
             - Parameter(float): JW similarity score paramter
-            - block_name(str): name of the block
+            - chunk (list): block keys of the block
         Returns:
             - matched restaurants(list): list of matched restaurants based 
             on the algorithm
         """
         try:
-            candidate_pairs = self.get_candidates_within_block(block_name)
-            all_ids = []
-            linked_rests = []
-            for pair in candidate_pairs:
-                restaurant_main = pair[0]
-                list_candidates = pair[1]
-                
-                if restaurant_main["id"] not in all_ids:
-                    dct_linked, ids_temp = self.find_linked(restaurant_main,
-                                                list_candidates, parameter)
-                    linked_rests.append(dct_linked)
-                    all_ids += ids_temp
-            return linked_rests
+            candidate_pairs = self.get_candidates_within_block(chunk)
+            return self.link_candidates(candidate_pairs, parameter, scorer)
         except Exception as e:
             print(e, "error within clean_with_blocking")
-        
-
-        
-
-        
-        
-
-
 
+    def link_candidates(self, candidate_pairs, parameter, scorer = None):
+        """
+        Runs the matching algorithm over the candidates of a block.
 
+        Inputs:
+            - candidate_pairs (list of tuples): (row, list of candidates)
+            - Parameter(float): JW similarity score paramter
+            - scorer (PairScorer): optional scoring cascade
+        Returns:
+            - matched restaurants(list): list of matched restaurants
+        """
+        if scorer is None:
+            from scoring import PairScorer
+            scorer = PairScorer(parameter)
+        all_ids = set()
+        linked_rests = []
+        for pair in candidate_pairs:
+            restaurant_main = pair[0]
+            list_candidates = pair[1]
+
+            if restaurant_main["id"] not in all_ids:
+                dct_linked, ids_temp = self.find_linked(restaurant_main,
+                                            list_candidates, parameter, scorer)
+                linked_rests.append(dct_linked)
+                all_ids.update(ids_temp)
+        return linked_rests
+
+    def get_sorted_neighbourhood_candidates(self, window,
+                                            passes=SORTED_PASSES,
+                                            max_id=None):
+        """
+        Gets the candidates for the matching algorithm by sorted
+        neighbourhood: the restaurants are sorted once per pass on that
+        pass's normalized keys and each is paired with the next window
+        restaurants in that order. The pairs of all passes are merged,
+        so a restaurant is compared with at most 2 * window * len(passes)
+        others, however the restaurants are spread over blocks.
+        Inputs:
+            - window (int): number of following restaurants compared
+            - passes (tuple of tuples): sort keys of each pass
+            - max_id (int): when given, restaurants with a larger id are
+              left out
+        Returns:
+            - candidate_pairs (list of tuples): candidates for matching
+            (row, list of candidates) for every not cleaned restaurant
+        """
+        try:
+            rows = [row for row in self.find_all_restaurants()
+                    if max_id is None or row["id"] <= max_id]
+            neighbours = [{i} for i in range(len(rows))]
+            for keys in passes:
+                order = sorted(range(len(rows)), key=lambda i:
+                               [rows[i][key] or "" for key in keys]
+                               + [rows[i]["id"]])
+                for position, i in enumerate(order):
+                    for j in order[position + 1:position + 1 + window]:
+                        neighbours[i].add(j)
+                        neighbours[j].add(i)
+            return [(rows[i], [rows[j] for j in sorted(neighbours[i])])
+                    for i in sorted(range(len(rows)), key=lambda i: rows[i]["id"])
+                    if not rows[i]["clean"]]
+        except Exception as e:
+            print(e, "error in get_sorted_neighbourhood_candidates")
+            return []
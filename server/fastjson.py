@@ -0,0 +1,37 @@
+"""
+JSON encoding for responses, using orjson when it is installed and the
+standard library json module otherwise.
+"""
+import json
+
+from bottle import JSONPlugin
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def std_dumps(obj):
+    """
+    Encodes obj as UTF-8 JSON bytes with the standard library.
+    """
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+if orjson is not None:
+    def dumps(obj):
+        """
+        Encodes obj as UTF-8 JSON bytes.
+        """
+        return orjson.dumps(obj)
+else:
+    dumps = std_dumps
+
+
+def install(app, json_dumps=dumps):
+    """
+    Replaces the app's JSON plugin with one that encodes using json_dumps.
+    """
+    app.uninstall(JSONPlugin)
+    app.install(JSONPlugin(json_dumps=json_dumps))
@@ -0,0 +1,329 @@
+"""
+Background /clean jobs.
+
+A job splits a clean into blocks: the letter chunks of the blocking
+strategy, or batches of not cleaned restaurant ids for the sorted and full
+strategies. The plan is stored in ri_clean_jobs when the job is created.
+A job runs on its own thread and connection. Each block's clusters are
+committed in one transaction together with the block's row in
+ri_clean_checkpoints, so a job that stops for any reason (cancel, error or
+a crash of the server) can be resumed and skips the blocks already
+written. The sorted and full strategies compare with the restaurants that
+existed when the job was planned, up to its max_id parameter, so a resumed
+job does not link the composites its earlier blocks wrote. Jobs read and
+write SQL only, never the server's in-memory store, which the server
+rebuilds when a job stops.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from db import CACHED_STATEMENTS
+from db import DB
+from db import dict_factory
+
+# Not cleaned restaurants per block of the sorted and full strategies.
+BATCH_SIZE = 200
+
+# Seconds a job waits for the server's connection to release its lock.
+LOCK_TIMEOUT = 30.0
+
+# Statuses a job can be resumed from.
+RESUMABLE = ("cancelled", "failed", "interrupted")
+
+
+def plan_blocks(db, strategy, num_blocks):
+    """
+    Splits a clean into blocks.
+
+    Returns: a list of blocks, {"chunk": [...]} for blocking and
+             {"ids": [first, last]} otherwise.
+    """
+    if strategy == "blocking":
+        return [{"chunk": chunk} for chunk in db.block_chunks(num_blocks)]
+    ids = sorted(row["id"] for row in db.not_clean())
+    return [{"ids": [batch[0], batch[-1]]}
+            for batch in (ids[i:i + BATCH_SIZE]
+                          for i in range(0, len(ids), BATCH_SIZE))]
+
+
+class CleanJob:
+    """
+    One background clean. The counters cover the current run, the
+    blocks_done count includes blocks checkpointed by earlier runs.
+    """
+    def __init__(self, job_id, db_file, strategy, params, blocks, done,
+                 scorer, on_finish=None):
+        self.id = job_id
+        self.db_file = db_file
+        self.strategy = strategy
+        self.params = params
+        self.blocks = blocks
+        self.done = set(done)
+        self.scorer = scorer
+        self.on_finish = on_finish
+        self.status = "running"
+        self.error = None
+        self.clusters = 0
+        self.blocks_run = 0
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        # Set by CleanJobs.stop, whose caller resets the database.
+        self.discarded = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.started = time.time()
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=LOCK_TIMEOUT,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = dict_factory
+        return conn
+
+    def run(self):
+        conn = self.connect()
+        db = DB(conn)
+        db.defer_commits = True
+        linked = set()
+        candidates = None
+        try:
+            for index, block in enumerate(self.blocks):
+                if index in self.done:
+                    continue
+                if self.cancelled.is_set():
+                    self.status = "cancelled"
+                    break
+                if self.strategy == "blocking":
+                    pairs = db.get_candidates_within_block(block["chunk"])
+                else:
+                    if candidates is None:
+                        candidates = self.all_candidates(db)
+                    first, last = block["ids"]
+                    pairs = [pair for pair in candidates
+                             if first <= pair[0]["id"] <= last
+                             and pair[0]["id"] not in linked]
+                matched = db.link_candidates(pairs or [], 0.7, self.scorer)
+                before = self.count_clusters(conn)
+                for restaurant in matched:
+                    db.gen_aut_restaurant(restaurant)
+                    for restaurants in restaurant.values():
+                        linked.update(rest["id"] for rest in restaurants)
+                self.checkpoint(conn, index, self.count_clusters(conn) - before)
+            else:
+                self.status = "done"
+        except Exception as e:
+            print(e, "error in clean job", self.id)
+            conn.rollback()
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            try:
+                conn.execute("""UPDATE ri_clean_jobs SET status = ?, error = ?
+                             WHERE id = ?""", (self.status, self.error, self.id))
+                conn.commit()
+            except Exception as e:
+                print(e, "error saving clean job status", self.id)
+            if self.on_finish is not None:
+                self.on_finish(self, conn)
+            conn.close()
+
+    def all_candidates(self, db):
+        """
+        Candidate pairs of the sorted and full strategies, for every not
+        cleaned restaurant; each block keeps the ones in its id range.
+        Restaurants above max_id, like the composites of the blocks already
+        done, are left out.
+        """
+        max_id = self.params.get("max_id")
+        if self.strategy == "sorted":
+            return db.get_sorted_neighbourhood_candidates(
+                self.params["window"], max_id=max_id)
+        all_restaurants = [row for row in db.find_all_restaurants()
+                           if max_id is None or row["id"] <= max_id]
+        return [(row, all_restaurants) for row in db.not_clean()
+                if max_id is None or row["id"] <= max_id]
+
+    def count_clusters(self, conn):
+        """
+        Returns: the rows of ri_clusters. A restaurant matched with nothing
+                 is marked clean without one, so the rows a block adds are
+                 its clusters of more than one restaurant.
+        """
+        return conn.execute("SELECT COUNT(*) AS cnt FROM ri_clusters"
+                            ).fetchone()["cnt"]
+
+    def checkpoint(self, conn, index, clusters):
+        """
+        Commits the block's clusters along with its checkpoint.
+        """
+        conn.execute("""INSERT INTO ri_clean_checkpoints
+                     (job_id, block, clusters, finished) VALUES (?,?,?,?)""",
+                     (self.id, index, clusters, time.time()))
+        conn.execute("""UPDATE ri_clean_jobs SET blocks_done = ? WHERE id = ?""",
+                     (len(self.done) + 1, self.id))
+        conn.commit()
+        self.done.add(index)
+        self.blocks_run += 1
+        self.clusters += clusters
+
+    def progress(self):
+        """
+        Returns: the job's state, progress and, while it runs, an estimate
+                 of the seconds left.
+        """
+        end = self.finished or time.time()
+        elapsed = end - self.started
+        left = len(self.blocks) - len(self.done)
+        eta = None
+        if self.status == "running" and self.blocks_run:
+            eta = round(elapsed / self.blocks_run * left, 3)
+        return {"id": self.id, "strategy": self.strategy,
+                "params": self.params, "status": self.status,
+                "error": self.error,
+                "blocks_total": len(self.blocks),
+                "blocks_done": len(self.done),
+                "pairs": self.scorer.pairs, "matches": self.scorer.matches,
+                "clusters": self.clusters,
+                "elapsed": round(elapsed, 3), "eta": eta}
+
+
+class CleanJobs:
+    """
+    The server's clean jobs: at most one runs at a time, finished and
+    interrupted ones are read back from ri_clean_jobs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active = None
+
+    def running(self):
+        with self.lock:
+            return self.active is not None and self.active.thread.is_alive()
+
+    def create(self, connection, strategy, params, num_blocks):
+        """
+        Plans a job and stores it.
+
+        Returns: the new job's id.
+        """
+        db = DB(connection)
+        blocks = plan_blocks(db, strategy, num_blocks)
+        c = connection.cursor()
+        if strategy != "blocking":
+            params = dict(params, max_id=c.execute(
+                "SELECT COALESCE(MAX(id), 0) AS id FROM ri_restaurants"
+                ).fetchone()["id"])
+        c.execute("""INSERT INTO ri_clean_jobs
+                  (strategy, params, blocks, status, blocks_total, blocks_done,
+                  created) VALUES (?,?,?,?,?,?,?)""",
+                  (strategy, json.dumps(params), json.dumps(blocks), "created",
+                   len(blocks), 0, time.time()))
+        connection.commit()
+        job_id = c.lastrowid
+        c.close()
+        return job_id
+
+    def start(self, connection, job_id, db_file, scorer, on_finish=None):
+        """
+        Starts, or resumes, a stored job on a background thread.
+
+        Returns: the job, or None when job_id is unknown.
+        """
+        c = connection.cursor()
+        row = c.execute("""SELECT strategy, params, blocks FROM ri_clean_jobs
+                        WHERE id = ?""", [job_id]).fetchone()
+        if row is None:
+            c.close()
+            return None
+        done = [r["block"] for r in c.execute(
+            "SELECT block FROM ri_clean_checkpoints WHERE job_id = ?", [job_id])]
+        c.execute("UPDATE ri_clean_jobs SET status = 'running' WHERE id = ?",
+                  [job_id])
+        connection.commit()
+        c.close()
+        job = CleanJob(job_id, db_file, row["strategy"], json.loads(row["params"]),
+                       json.loads(row["blocks"]), done, scorer, on_finish)
+        with self.lock:
+            self.jobs[job_id] = job
+            self.active = job
+        job.start()
+        return job
+
+    def progress(self, connection, job_id):
+        """
+        Returns: the progress of a job, or None when job_id is unknown.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job.progress()
+        c = connection.cursor()
+        row = c.execute("""SELECT id, strategy, params, status, error,
+                        blocks_total, blocks_done FROM ri_clean_jobs
+                        WHERE id = ?""", [job_id]).fetchone()
+        if row is None:
+            c.close()
+            return None
+        clusters = c.execute("""SELECT COALESCE(SUM(clusters), 0) AS clusters
+                             FROM ri_clean_checkpoints WHERE job_id = ?""",
+                             [job_id]).fetchone()["clusters"]
+        c.close()
+        row["params"] = json.loads(row["params"])
+        row["clusters"] = clusters
+        return row
+
+    def status(self, connection, job_id):
+        progress = self.progress(connection, job_id)
+        return progress["status"] if progress is not None else None
+
+    def cancel(self, job_id):
+        """
+        Asks a running job to stop after its current block.
+
+        Returns: False when the job is not running.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None or not job.thread.is_alive():
+            return False
+        job.cancel()
+        return True
+
+    def stop(self):
+        """
+        Cancels the running job, if any, and waits for it to stop. The job
+        is marked discarded, so its finish hook does not wait on the
+        caller.
+        """
+        with self.lock:
+            job = self.active
+        if job is not None:
+            job.discarded.set()
+            job.cancel()
+            job.thread.join()
+
+    def forget(self):
+        with self.lock:
+            self.jobs.clear()
+            self.active = None
+
+    def recover(self, connection):
+        """
+        Marks the jobs left running by a previous server process as
+        interrupted, so they can be resumed.
+        """
+        try:
+            connection.execute("""UPDATE ri_clean_jobs SET status = 'interrupted'
+                               WHERE status = 'running'""")
+            connection.commit()
+        except Exception as e:
+            print(e, "error recovering clean jobs")
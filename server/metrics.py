@@ -0,0 +1,270 @@
+"""
+Call counts and latency histograms for the Bottle routes and the DB class,
+rendered in the Prometheus text exposition format.
+
+Nothing in here is active until enable() is called, so a server started
+without --metrics runs the original, unwrapped code.
+"""
+import functools
+import inspect
+import threading
+import time
+
+from bottle import response
+
+from db import add_trace_callback
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# SQLite calls the progress handler every this many VM instructions.
+VM_STEP_UNIT = 1000
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """
+    Registry of route and DB method metrics.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.route_calls = {}
+        self.route_latency = {}
+        self.db_latency = {}
+        self.db_statements = {}
+        self.db_rows = {}
+        self.db_vm_steps = {}
+        self.local = threading.local()
+
+    def current_method(self):
+        """
+        Returns the innermost DB method running on this thread, or None.
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            return stack[-1]
+        return None
+
+    def observe_route(self, rule, method, status, seconds):
+        with self.lock:
+            key = (rule, method, str(status))
+            self.route_calls[key] = self.route_calls.get(key, 0) + 1
+            hist = self.route_latency.get((rule, method))
+            if hist is None:
+                hist = self.route_latency[(rule, method)] = Histogram()
+            hist.observe(seconds)
+
+    def observe_db(self, name, seconds):
+        with self.lock:
+            hist = self.db_latency.get(name)
+            if hist is None:
+                hist = self.db_latency[name] = Histogram()
+            hist.observe(seconds)
+
+    def count_statement(self, statement):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        key = (self.current_method() or "", verb)
+        with self.lock:
+            self.db_statements[key] = self.db_statements.get(key, 0) + 1
+
+    def count_row(self):
+        key = self.current_method() or ""
+        with self.lock:
+            self.db_rows[key] = self.db_rows.get(key, 0) + 1
+
+    def count_vm_steps(self):
+        key = self.current_method() or ""
+        with self.lock:
+            self.db_vm_steps[key] = self.db_vm_steps.get(key, 0) + VM_STEP_UNIT
+        # A non-zero return value would abort the running statement.
+        return 0
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            lines.append("# HELP insp_http_requests_total Requests handled per route.")
+            lines.append("# TYPE insp_http_requests_total counter")
+            for (rule, method, status), value in sorted(self.route_calls.items()):
+                lines.append('insp_http_requests_total{route="%s",method="%s",status="%s"} %d'
+                             % (rule, method, status, value))
+            render_histograms(lines, "insp_http_request_seconds",
+                              "Route latency in seconds.",
+                              {'route="%s",method="%s"' % key: hist
+                               for key, hist in self.route_latency.items()})
+            render_histograms(lines, "insp_db_call_seconds",
+                              "DB method latency in seconds.",
+                              {'method="%s"' % key: hist
+                               for key, hist in self.db_latency.items()})
+            lines.append("# HELP insp_db_statements_total SQL statements issued per DB method.")
+            lines.append("# TYPE insp_db_statements_total counter")
+            for (name, verb), value in sorted(self.db_statements.items()):
+                lines.append('insp_db_statements_total{method="%s",verb="%s"} %d'
+                             % (name, verb, value))
+            lines.append("# HELP insp_db_rows_total Rows read back from SQLite per DB method.")
+            lines.append("# TYPE insp_db_rows_total counter")
+            for name, value in sorted(self.db_rows.items()):
+                lines.append('insp_db_rows_total{method="%s"} %d' % (name, value))
+            lines.append("# HELP insp_db_vm_steps_total Approximate SQLite VM "
+                         "instructions per DB method, a proxy for rows scanned.")
+            lines.append("# TYPE insp_db_vm_steps_total counter")
+            for name, value in sorted(self.db_vm_steps.items()):
+                lines.append('insp_db_vm_steps_total{method="%s"} %d' % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+def render_histograms(lines, metric, help_text, histograms):
+    lines.append("# HELP %s %s" % (metric, help_text))
+    lines.append("# TYPE %s histogram" % metric)
+    for labels, hist in sorted(histograms.items()):
+        for bound, value in zip(hist.buckets, hist.counts):
+            lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, bound, value))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, labels, hist.count))
+        lines.append("%s_sum{%s} %f" % (metric, labels, hist.sum))
+        lines.append("%s_count{%s} %d" % (metric, labels, hist.count))
+
+
+class MetricsPlugin:
+    """
+    Bottle plugin that times every route callback.
+    """
+    name = "metrics"
+    api = 2
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def apply(self, callback, route):
+        metrics = self.metrics
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = 200
+            try:
+                rv = callback(*args, **kwargs)
+                status = response.status_code
+                return rv
+            except Exception as e:
+                status = getattr(e, "status_code", 500)
+                raise
+            finally:
+                metrics.observe_route(route.rule, route.method, status,
+                                      time.perf_counter() - start)
+        return wrapper
+
+
+def timed_method(metrics, name, method):
+    """
+    Wraps a DB method so its latency is recorded and the statements it
+    issues are attributed to it. A generator method is timed while it
+    runs, one step at a time, and observed once it is exhausted or closed.
+    """
+    if inspect.isgeneratorfunction(method):
+        return timed_generator(metrics, name, method)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        stack = getattr(metrics.local, "stack", None)
+        if stack is None:
+            stack = metrics.local.stack = []
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics.observe_db(name, time.perf_counter() - start)
+            stack.pop()
+    wrapper.__wrapped_by_metrics__ = method
+    return wrapper
+
+
+def timed_generator(metrics, name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        generator = method(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                stack = getattr(metrics.local, "stack", None)
+                if stack is None:
+                    stack = metrics.local.stack = []
+                stack.append(name)
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                    stack.pop()
+                yield item
+        finally:
+            generator.close()
+            metrics.observe_db(name, elapsed)
+    wrapper.__wrapped_by_metrics__ = method
+    return wrapper
+
+
+def instrument_db(db_class, metrics):
+    """
+    Replaces every public method of db_class with a timed wrapper.
+    """
+    for name, attr in list(vars(db_class).items()):
+        if name.startswith("_") or not callable(attr):
+            continue
+        if hasattr(attr, "__wrapped_by_metrics__"):
+            continue
+        setattr(db_class, name, timed_method(metrics, name, attr))
+
+
+def attach_connection(connection, metrics):
+    """
+    Counts statements, rows and VM steps on a sqlite3 connection.
+    """
+    row_factory = connection.row_factory
+
+    def counting_factory(cursor, row):
+        metrics.count_row()
+        if row_factory is None:
+            return row
+        return row_factory(cursor, row)
+
+    connection.row_factory = counting_factory
+    add_trace_callback(connection, metrics.count_statement)
+    connection.set_progress_handler(metrics.count_vm_steps, VM_STEP_UNIT)
+    return row_factory
+
+
+def enable(app, db_class):
+    """
+    Turns instrumentation on for a Bottle app, its connection and db_class.
+    """
+    if getattr(app, "metrics", None) is not None:
+        return app.metrics
+    metrics = Metrics()
+    instrument_db(db_class, metrics)
+    app.install(MetricsPlugin(metrics))
+    app.metrics_row_factory = attach_connection(app.db_connection, metrics)
+    app.metrics = metrics
+    return metrics
@@ -0,0 +1,106 @@
+"""
+Normalized match keys for restaurants.
+
+The keys are computed once when a restaurant is inserted and stored next to
+it, so blocking, indexing and scoring read them instead of lower-casing and
+slicing the raw columns on every comparison.
+"""
+import re
+import string
+
+# Punctuation is replaced by a space so "MC'DONALDS" and "MC DONALDS" agree.
+PUNCTUATION = str.maketrans(string.punctuation, " " * len(string.punctuation))
+
+# Street suffixes and directions of addresses, folded to their USPS
+# abbreviation.
+CANONICAL_WORDS = {
+    "street": "st", "str": "st",
+    "avenue": "ave", "av": "ave",
+    "boulevard": "blvd", "blv": "blvd",
+    "road": "rd",
+    "drive": "dr",
+    "place": "pl",
+    "court": "ct",
+    "lane": "ln",
+    "parkway": "pkwy", "pky": "pkwy",
+    "highway": "hwy",
+    "square": "sq",
+    "terrace": "ter",
+    "north": "n", "south": "s", "east": "e", "west": "w",
+}
+
+# Number of leading zip code digits shared by a block's index lookups.
+ZIP_PREFIX_LENGTH = 4
+
+# The derived columns stored on ri_restaurants, in insert order.
+KEY_COLUMNS = ("norm_name", "name_key", "norm_address", "norm_city",
+               "norm_state", "zip_prefix", "block_key")
+
+# Version of the keys restaurant_keys computes, kept in ri_meta; the keys
+# of a database from another version are all computed again (see
+# DB.fill_match_keys). Version 2 stopped folding street suffixes in names.
+MATCH_KEYS_VERSION = "2"
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def fold(value):
+    """
+    Lower-cases value, turns punctuation into spaces and collapses runs of
+    whitespace. Missing values fold to the empty string.
+    """
+    if value is None:
+        return ""
+    value = str(value).lower().translate(PUNCTUATION)
+    return WHITESPACE.sub(" ", value).strip()
+
+
+def canonical(value):
+    """
+    Folds an address and replaces street suffixes and directions with
+    their abbreviations.
+    """
+    return " ".join(CANONICAL_WORDS.get(word, word)
+                    for word in fold(value).split())
+
+
+def phonetic_key(norm_name):
+    """
+    Metaphone code of a normalized name, "" for an empty name. jellyfish
+    is imported by the first restaurant added rather than at startup.
+    """
+    if not norm_name:
+        return ""
+    import jellyfish
+    return jellyfish.metaphone(norm_name)
+
+
+def zip_prefix(zip_code):
+    if zip_code is None:
+        return ""
+    return str(zip_code).strip()[:ZIP_PREFIX_LENGTH]
+
+
+def block_key(norm_name):
+    """
+    The blocking key of a normalized name: its first character, which
+    /clean groups into blocks of letters and digits.
+    """
+    return norm_name[:1]
+
+
+def restaurant_keys(data):
+    """
+    Computes the derived match columns of a restaurant.
+
+    Inputs: data - (dict) restaurant attributes as given to add_restaurant.
+    Returns: dict of KEY_COLUMNS to their values.
+    """
+    norm_name = fold(data.get("name", None))
+    return {"norm_name": norm_name,
+            "name_key": phonetic_key(norm_name),
+            "norm_address": canonical(data.get("address", None)),
+            "norm_city": fold(data.get("city", None)),
+            "norm_state": fold(data.get("state", None)),
+            "zip_prefix": zip_prefix(data.get("zip", None)),
+            "block_key": block_key(norm_name)}
@@ -0,0 +1,156 @@
+"""
+Query plan auditing for the statements the DB class issues.
+
+Every SELECT/UPDATE/DELETE seen on the connection is queued by the trace
+callback and, on the next flush(), run once through EXPLAIN QUERY PLAN.
+Statements are grouped by their template (literals replaced with ?), so
+each distinct statement is only explained the first time it shows up.
+"""
+import logging
+import re
+import threading
+
+from db import add_trace_callback
+
+# Only these statements have a plan worth looking at.
+AUDITED_VERBS = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+WHITESPACE = re.compile(r"\s+")
+
+
+def statement_template(statement):
+    """
+    Collapses a traced statement to a template with its literals replaced.
+    """
+    template = STRING_LITERAL.sub("?", statement)
+    template = NUMBER_LITERAL.sub("?", template)
+    return WHITESPACE.sub(" ", template).strip()
+
+
+def is_full_scan(detail):
+    """
+    True if an EXPLAIN QUERY PLAN row reads a whole table without an index.
+    """
+    if not detail.startswith("SCAN "):
+        return False
+    if "USING" in detail or "VIRTUAL TABLE" in detail:
+        return False
+    return detail != "SCAN CONSTANT ROW"
+
+
+class PlanAuditor:
+    """
+    Collects the plans of every distinct statement run on a connection.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.plans = {}
+
+    def trace(self, statement):
+        words = statement.lstrip().split(None, 1)
+        if not words or words[0].upper() not in AUDITED_VERBS:
+            return
+        with self.lock:
+            self.pending.append(statement)
+
+    def flush(self, connection):
+        """
+        Explains every queued statement not already seen, and returns the
+        entries of all the statements that were queued.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        flushed = []
+        for statement in pending:
+            template = statement_template(statement)
+            entry = self.plans.get(template)
+            if entry is not None:
+                entry["calls"] += 1
+            else:
+                entry = self.explain(connection, statement, template)
+                self.plans[template] = entry
+            flushed.append(entry)
+        return flushed
+
+    def explain(self, connection, statement, template):
+        entry = {"statement": template, "calls": 1, "plan": [], "scans": []}
+        c = connection.cursor()
+        # Don't let the row factory turn the plan rows into dicts; the plan
+        # rows are read by position.
+        c.row_factory = None
+        try:
+            rows = c.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+        except Exception as e:
+            entry["error"] = str(e)
+            return entry
+        finally:
+            c.close()
+        for row in rows:
+            detail = row[-1]
+            entry["plan"].append(detail)
+            if is_full_scan(detail):
+                entry["scans"].append(detail)
+        if entry["scans"]:
+            logging.warning("Full table scan (%s) in: %s",
+                            "; ".join(entry["scans"]), template)
+        return entry
+
+    def report(self):
+        """
+        Returns the audited statements, the ones with full scans first.
+        """
+        entries = sorted(self.plans.values(),
+                         key=lambda e: (not e["scans"], e["statement"]))
+        return {"statements": entries,
+                "scans": sum(1 for e in entries if e["scans"])}
+
+    def scans(self):
+        return [e for e in self.plans.values() if e["scans"]]
+
+
+class PlanAuditPlugin:
+    """
+    Bottle plugin that explains the statements a request issued once the
+    request has finished.
+    """
+    name = "plan_audit"
+    api = 2
+
+    def __init__(self, auditor, connection):
+        self.auditor = auditor
+        self.connection = connection
+
+    def apply(self, callback, route):
+        auditor = self.auditor
+        connection = self.connection
+
+        def wrapper(*args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                auditor.flush(connection)
+        return wrapper
+
+
+def attach(connection):
+    """
+    Starts auditing the statements run on a connection.
+    """
+    auditor = PlanAuditor()
+    add_trace_callback(connection, auditor.trace)
+    return auditor
+
+
+def enable(app):
+    """
+    Turns plan auditing on for a Bottle app and its connection.
+    """
+    if getattr(app, "plan_auditor", None) is not None:
+        return app.plan_auditor
+    auditor = attach(app.db_connection)
+    app.install(PlanAuditPlugin(auditor, app.db_connection))
+    app.plan_auditor = auditor
+    return auditor
@@ -0,0 +1,120 @@
+"""
+Opt-in profiling of /clean runs.
+
+A run is profiled with cProfile and, at the same time, sampled by a
+background thread that records the stack of the cleaning thread every few
+milliseconds. The results are written as a pstats file, a collapsed-stack
+file (one `frame;frame;frame count` line per stack, the input format of
+flamegraph.pl and speedscope) and a JSON summary of the time spent in each
+phase of the clean.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+# Seconds between two stack samples.
+SAMPLE_INTERVAL = 0.005
+
+
+class CleanProfiler:
+    """
+    Profiles a single clean run, split into named phases.
+    """
+    def __init__(self, out_dir, interval=SAMPLE_INTERVAL):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.phases = {}
+        self.current_phase = "other"
+        self.stacks = {}
+        self.profile = cProfile.Profile()
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.target = None
+        self.start_time = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Attributes the time and samples taken inside the block to a phase.
+        """
+        previous = self.current_phase
+        self.current_phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stats["seconds"] += time.perf_counter() - start
+            stats["calls"] += 1
+            self.current_phase = previous
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.start_time = time.perf_counter()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        self.profile.enable()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(self.current_phase)
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        """
+        Stops profiling and writes the results.
+
+        Returns: a summary with the output paths and per-phase timings.
+        """
+        self.profile.disable()
+        self.stopped.set()
+        self.sampler.join()
+        total = time.perf_counter() - self.start_time
+        os.makedirs(self.out_dir, exist_ok=True)
+        now = time.time()
+        base = os.path.join(self.out_dir, "clean-%s-%03d" % (
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+            int(now * 1000) % 1000))
+        self.profile.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+        samples = {}
+        for stack, count in self.stacks.items():
+            phase = stack.split(";", 1)[0]
+            samples[phase] = samples.get(phase, 0) + count
+        phases = {}
+        for name, stats in self.phases.items():
+            phases[name] = {"seconds": round(stats["seconds"], 6),
+                            "calls": stats["calls"],
+                            "share": round(stats["seconds"] / total, 4) if total else 0,
+                            "samples": samples.get(name, 0)}
+        summary = {"seconds": round(total, 6),
+                   "phases": phases,
+                   "pstats": base + ".pstats",
+                   "collapsed": base + ".collapsed"}
+        with open(base + ".phases.json", "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def no_phase(name):
+    """
+    Stand-in for CleanProfiler.phase when a clean is not profiled.
+    """
+    return contextlib.nullcontext()
@@ -0,0 +1,161 @@
+"""
+Read replicas of the server's database.
+
+With --replicas the GET routes read from in-memory copies of the database
+instead of the server's connection, so they do not wait for a /clean, a
+clean job or an ingest transaction holding the connection or the write
+lock. A background thread takes a snapshot of the committed database with
+sqlite3.Connection.backup every interval seconds, copies it into each
+replica and swaps the new copies in; requests still running on the old
+copies finish on them, and each old copy is closed once its last request
+releases it. Replicas are read-only (PRAGMA query_only).
+
+A replica older than max_staleness seconds is not used: the request falls
+back to the server's connection.
+"""
+import itertools
+import sqlite3
+import threading
+import time
+
+from db import CACHED_STATEMENTS
+from db import dict_factory
+from violations import release
+
+# Seconds a snapshot waits for a writer to release the database.
+SNAPSHOT_TIMEOUT = 30.0
+
+
+def copy_database(source):
+    """
+    Returns: a read-only in-memory copy of the database of source.
+    """
+    copy = sqlite3.connect(":memory:", check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS)
+    source.backup(copy)
+    copy.execute("PRAGMA query_only = ON")
+    copy.row_factory = dict_factory
+    return copy
+
+
+class ReplicaSet:
+    """
+    Read-only copies of a database file, refreshed on a background thread.
+
+    Inputs: db_file (string) - the primary database
+            count (int) - number of copies, served round robin
+            interval (float) - seconds between snapshots
+            max_staleness (float) - age in seconds above which the
+                                    copies are not used
+    """
+    def __init__(self, db_file, count=1, interval=1.0, max_staleness=5.0):
+        self.db_file = db_file
+        self.count = count
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.lock = threading.Lock()
+        self.replicas = []
+        # Requests reading each copy, and the copies swapped out while
+        # requests were still reading them.
+        self.readers = {}
+        self.retired = set()
+        self.as_of = None
+        self.next = itertools.count()
+        self.reads = 0
+        self.fallbacks = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.refresh_time = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.refresh()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def refresh(self):
+        """
+        Snapshots the committed state of the primary into new copies.
+        """
+        start = time.time()
+        source = sqlite3.connect("file:%s?mode=ro" % self.db_file, uri=True,
+                                 timeout=SNAPSHOT_TIMEOUT)
+        try:
+            first = copy_database(source)
+        finally:
+            source.close()
+        replicas = [first] + [copy_database(first)
+                              for _ in range(self.count - 1)]
+        with self.lock:
+            if self.as_of is not None and self.as_of > start:
+                # A later snapshot was swapped in while this one ran.
+                closed = replicas
+            else:
+                closed = [replica for replica in self.replicas
+                          if replica not in self.readers]
+                self.retired.update(replica for replica in self.replicas
+                                    if replica in self.readers)
+                self.replicas = replicas
+                self.as_of = start
+                self.refreshes += 1
+                self.refresh_time = time.time() - start
+        for replica in closed:
+            self.close(replica)
+
+    def close(self, replica):
+        release(replica)
+        replica.close()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(e, "error refreshing replicas")
+                self.failures += 1
+
+    def acquire(self):
+        """
+        Picks a replica for one request.
+
+        Returns: (connection, as_of), the time the snapshot was taken, or
+                 (None, None) when the replicas are staler than allowed.
+        """
+        with self.lock:
+            if (self.as_of is None
+                    or time.time() - self.as_of > self.max_staleness):
+                self.fallbacks += 1
+                return None, None
+            self.reads += 1
+            replica = self.replicas[next(self.next) % len(self.replicas)]
+            self.readers[replica] = self.readers.get(replica, 0) + 1
+            return replica, self.as_of
+
+    def release(self, replica):
+        """
+        Ends a request's use of a replica from acquire, closing it if it
+        was swapped out and this was its last request.
+        """
+        with self.lock:
+            readers = self.readers.pop(replica) - 1
+            if readers:
+                self.readers[replica] = readers
+                return
+            if replica not in self.retired:
+                return
+            self.retired.discard(replica)
+        self.close(replica)
+
+    def stats(self):
+        with self.lock:
+            age = time.time() - self.as_of if self.as_of is not None else None
+            return {"replicas": self.count, "interval": self.interval,
+                    "max_staleness": self.max_staleness,
+                    "age": round(age, 3) if age is not None else None,
+                    "reads": self.reads, "fallbacks": self.fallbacks,
+                    "refreshes": self.refreshes, "failures": self.failures,
+                    "refresh_time": round(self.refresh_time, 6)}
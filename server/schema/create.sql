@@ -2,6 +2,16 @@ DROP TABLE IF EXISTS ri_inspections;
 DROP TABLE IF EXISTS ri_restaurants;
 DROP TABLE IF EXISTS ri_tweetmatch;
 DROP TABLE IF EXISTS ri_linked;
+DROP TABLE IF EXISTS ri_primary;
+DROP TABLE IF EXISTS ri_clusters;
+DROP TABLE IF EXISTS ri_clean_jobs;
+DROP TABLE IF EXISTS ri_clean_checkpoints;
+DROP TABLE IF EXISTS ri_meta;
+DROP TABLE IF EXISTS ri_violation_clauses;
+DROP TABLE IF EXISTS ri_restaurants_fts;
+DROP TABLE IF EXISTS ri_inspections_fts;
+DROP TABLE IF EXISTS ri_inspection_stats;
+DROP TABLE IF EXISTS ri_tweet_stats;
 
 
 CREATE TABLE ri_restaurants (
@@ -14,7 +24,15 @@ CREATE TABLE ri_restaurants (
     zip char(5),
     latitude real,
     longitude real,
-    clean boolean DEFAULT FALSE
+    clean boolean DEFAULT FALSE,
+    -- Match keys derived from the columns above, see normalize.py.
+    norm_name varchar(60),
+    name_key varchar(60),
+    norm_address varchar(60),
+    norm_city varchar(30),
+    norm_state char(2),
+    zip_prefix char(4),
+    block_key char(1)
 );
 
 CREATE TABLE ri_inspections (
@@ -44,3 +62,117 @@ CREATE TABLE ri_linked (
     FOREIGN KEY (primary_rest_id) REFERENCES ri_restaurants,
     FOREIGN KEY (original_rest_id) REFERENCES ri_restaurants
 );
+
+CREATE INDEX ri_restaurants_name_address ON ri_restaurants (name, address);
+CREATE INDEX ri_restaurants_lower_name ON ri_restaurants (lower(name));
+CREATE INDEX ri_restaurants_location ON ri_restaurants (latitude, longitude);
+CREATE INDEX ri_restaurants_norm_name ON ri_restaurants (norm_name);
+CREATE INDEX ri_restaurants_name_key ON ri_restaurants (name_key);
+-- Blocks of the scaling clean are ranges of this index.
+CREATE INDEX ri_restaurants_block ON ri_restaurants (block_key, zip_prefix);
+CREATE INDEX ri_inspections_restaurant ON ri_inspections (restaurant_id, id);
+CREATE INDEX ri_tweetmatch_restaurant ON ri_tweetmatch (restaurant_id);
+CREATE INDEX ri_linked_original ON ri_linked (original_rest_id);
+
+-- Maintained by gen_aut_restaurant: every linked restaurant (and the
+-- composite itself) maps to its primary, and every primary lists its
+-- linked restaurants.
+CREATE TABLE ri_primary (
+    restaurant_id int PRIMARY KEY,
+    primary_rest_id int NOT NULL,
+    FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants,
+    FOREIGN KEY (primary_rest_id) REFERENCES ri_restaurants
+);
+
+CREATE TABLE ri_clusters (
+    primary_rest_id int PRIMARY KEY,
+    member_ids text NOT NULL,
+    FOREIGN KEY (primary_rest_id) REFERENCES ri_restaurants
+);
+
+-- Background clean jobs (jobs.py): the planned blocks as JSON and one
+-- checkpoint row per block committed.
+CREATE TABLE ri_clean_jobs (
+    id integer PRIMARY KEY,
+    strategy varchar(10) NOT NULL,
+    params text NOT NULL,
+    blocks text NOT NULL,
+    status varchar(12) NOT NULL,
+    error text,
+    blocks_total int NOT NULL,
+    blocks_done int NOT NULL,
+    created real NOT NULL
+);
+
+CREATE TABLE ri_clean_checkpoints (
+    job_id int NOT NULL,
+    block int NOT NULL,
+    clusters int NOT NULL,
+    finished real NOT NULL,
+    PRIMARY KEY (job_id, block)
+);
+
+-- Memoized Jaro-Winkler scores of normalized string pairs (a <= b). Kept
+-- across resets since the scores do not depend on the data.
+CREATE TABLE IF NOT EXISTS ri_similarity (
+    a text NOT NULL,
+    b text NOT NULL,
+    score real NOT NULL,
+    PRIMARY KEY (a, b)
+);
+
+-- Full-text indexes for /search, see search.py, written by DB.add_restaurant
+-- and DB.add_inspection: an insert trigger on ri_restaurants made ingest
+-- more than twice as slow (bench.py ingest). The restaurant index reads
+-- its text from ri_restaurants; the violations index stores none (the
+-- column may be coded).
+CREATE VIRTUAL TABLE ri_restaurants_fts USING fts5(
+    name, address, content='ri_restaurants', content_rowid='id'
+);
+
+CREATE VIRTUAL TABLE ri_inspections_fts USING fts5(
+    violations, content='', tokenize='porter unicode61'
+);
+
+-- Rollups served by /stats, see stats.py, kept up to date by
+-- DB.add_inspection, DB.update_inspection_restaurant_id and DB.add_tweet.
+-- Every inspection is counted under its zip code, its risk and its facility
+-- type; merged inspections move to the composite's zip and facility type.
+CREATE TABLE ri_inspection_stats (
+    dimension varchar(15) NOT NULL,
+    value varchar(50) NOT NULL,
+    month char(7) NOT NULL,
+    inspections int NOT NULL,
+    passed int NOT NULL,
+    passed_with_conditions int NOT NULL,
+    failed int NOT NULL,
+    PRIMARY KEY (dimension, value, month)
+) WITHOUT ROWID;
+
+CREATE TABLE ri_tweet_stats (
+    restaurant_id integer PRIMARY KEY,
+    tweets int NOT NULL,
+    name_matches int NOT NULL,
+    geo_matches int NOT NULL,
+    both_matches int NOT NULL,
+    FOREIGN KEY (restaurant_id) REFERENCES ri_restaurants
+);
+
+CREATE INDEX ri_tweet_stats_tweets ON ri_tweet_stats (tweets);
+
+-- Violation headings of the coded violations, see violations.py.
+CREATE TABLE ri_violation_clauses (
+    id integer PRIMARY KEY,
+    clause text NOT NULL UNIQUE
+);
+
+-- Settings of the database. The epoch is new on every reset, so a snapshot
+-- of the restaurants (see snapshot.py) cannot be taken for another reset's.
+CREATE TABLE ri_meta (
+    name text PRIMARY KEY,
+    value text
+);
+
+INSERT INTO ri_meta (name, value) VALUES ('epoch', lower(hex(randomblob(8))));
+-- normalize.MATCH_KEYS_VERSION of the keys stored on ri_restaurants.
+INSERT INTO ri_meta (name, value) VALUES ('match_keys', '2');
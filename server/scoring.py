@@ -0,0 +1,261 @@
+"""
+Pair scoring for /clean.
+
+A candidate pair goes through the stages state, city, name and address in
+order and is dropped at the first stage it fails. Before Jaro-Winkler is
+computed for a stage, two cheap filters run: equal strings score 1 without
+calling jellyfish, and an upper bound on the score, from the characters
+the strings have in common and their common prefix, rejects pairs that
+cannot reach the stage's threshold. The scorer counts how many pairs each stage and each
+filter rejected. Scores that still have to be computed are memoized in a
+SimilarityCache, shared by every clean and optionally saved to SQLite.
+"""
+import functools
+import itertools
+
+import jellyfish as td
+
+STAGES = ("state", "city", "name", "address")
+
+# Normalized column compared by each stage, see normalize.py.
+STAGE_COLUMNS = {"state": "norm_state", "city": "norm_city",
+                 "name": "norm_name", "address": "norm_address"}
+
+# Prefix length and scale of the Winkler adjustment.
+WINKLER_PREFIX = 4
+WINKLER_SCALE = 0.1
+
+# Slack for float rounding when comparing the bound to a threshold.
+EPSILON = 1e-9
+
+# Bit of char_mask() for the k-th occurrence of a character, handed out on
+# first sight. Two threads handing out the same bit to two keys only make
+# the bound looser.
+CHARACTER_BITS = {}
+
+
+@functools.lru_cache(maxsize=65536)
+def char_mask(text):
+    """
+    Returns: an int with a bit for each character of text, the k-th
+             occurrence of a character always setting the same bit, so the
+             bits two masks share count the characters that two strings
+             have in common.
+    """
+    mask = 0
+    seen = {}
+    for character in text:
+        k = seen.get(character, 0)
+        seen[character] = k + 1
+        bit = CHARACTER_BITS.get((character, k))
+        if bit is None:
+            bit = CHARACTER_BITS.setdefault((character, k), len(CHARACTER_BITS))
+        mask |= 1 << bit
+    return mask
+
+
+def jaro_winkler_bound(a, b):
+    """
+    Upper bound of td.jaro_winkler(a, b) from the characters a and b have
+    in common and their common prefix. Jaro pairs equal characters, so at
+    most that many match, which bounds the Jaro score, and the Winkler
+    adjustment is at most the common prefix (up to 4 characters) times 0.1.
+    """
+    common = bin(char_mask(a) & char_mask(b)).count("1")
+    if common == 0:
+        return 0.0
+    jaro = (common / len(a) + common / len(b) + 1.0) / 3.0
+    prefix = 0
+    for x, y in zip(a[:WINKLER_PREFIX], b[:WINKLER_PREFIX]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * WINKLER_SCALE * (1.0 - jaro)
+
+
+class SimilarityCache:
+    """
+    Bounded LRU memo of Jaro-Winkler scores keyed on the (sorted) pair of
+    normalized strings. functools.lru_cache is used rather than
+    cache.LRUCache because a lookup has to be much cheaper than the C
+    implementation of jaro_winkler to pay off.
+
+    With persist set, scores computed since the last save are written to
+    the ri_similarity table by save(); load() reads them back into a dict
+    consulted on LRU misses, so they survive a restart. That dict, the
+    scores waiting to be saved and the table each keep the maxsize most
+    recent scores, the oldest being dropped first.
+    """
+    def __init__(self, maxsize=200000, persist=False):
+        self.maxsize = maxsize
+        self.persist = persist
+        self.saved = {}
+        self.unsaved = {}
+        self.lookup = functools.lru_cache(maxsize)(self.compute)
+
+    def compute(self, a, b):
+        score = self.saved.get((a, b))
+        if score is None:
+            score = td.jaro_winkler(a, b)
+            if self.persist:
+                self.unsaved[(a, b)] = score
+                if len(self.unsaved) > self.maxsize:
+                    del self.unsaved[next(iter(self.unsaved))]
+        return score
+
+    def jaro_winkler(self, a, b):
+        if a <= b:
+            return self.lookup(a, b)
+        return self.lookup(b, a)
+
+    def load(self, connection):
+        """
+        Reads up to maxsize of the scores saved in ri_similarity.
+        """
+        c = connection.cursor()
+        c.row_factory = None
+        try:
+            rows = c.execute("""SELECT a, b, score FROM ri_similarity
+                             ORDER BY rowid DESC LIMIT ?""",
+                             [self.maxsize]).fetchall()
+            # Oldest first, as save() adds them.
+            for a, b, score in reversed(rows):
+                self.saved[(a, b)] = score
+        except Exception as e:
+            print(e, "error loading similarity cache")
+        finally:
+            c.close()
+
+    def save(self, connection):
+        """
+        Writes the scores computed since the last save to ri_similarity,
+        and drops the oldest ones past maxsize from the table and from
+        memory.
+        """
+        if not self.unsaved:
+            return
+        c = connection.cursor()
+        try:
+            c.executemany("""INSERT OR IGNORE INTO ri_similarity (a, b, score)
+                          VALUES (?,?,?)""",
+                          [key + (score,) for key, score in self.unsaved.items()])
+            c.execute("""DELETE FROM ri_similarity WHERE rowid <=
+                      (SELECT rowid FROM ri_similarity
+                       ORDER BY rowid DESC LIMIT 1 OFFSET ?)""",
+                      [self.maxsize])
+            connection.commit()
+            self.saved.update(self.unsaved)
+            self.unsaved.clear()
+            excess = len(self.saved) - self.maxsize
+            if excess > 0:
+                for key in list(itertools.islice(self.saved, excess)):
+                    del self.saved[key]
+        except Exception as e:
+            print(e, "error saving similarity cache")
+        finally:
+            c.close()
+
+    def stats(self):
+        info = self.lookup.cache_info()
+        lookups = info.hits + info.misses
+        return {"size": info.currsize, "maxsize": self.maxsize,
+                "hits": info.hits, "misses": info.misses,
+                "hit_rate": round(info.hits / lookups, 4) if lookups else 0,
+                "saved": len(self.saved), "unsaved": len(self.unsaved)}
+
+
+class PairScorer:
+    """
+    Decides whether two restaurants are the same one.
+
+    Inputs: parameter (float) - threshold of the state, city and name stages
+            address_threshold (float) - threshold of the address stage,
+                                        0 disables the stage
+            name_weight, address_weight (float) - weights of the name and
+                address scores in the combined score, which must also reach
+                parameter when address_weight is not 0
+            cache (SimilarityCache) - optional memo of computed scores
+    """
+    def __init__(self, parameter, address_threshold=0.0, name_weight=1.0,
+                 address_weight=0.0, cache=None):
+        self.parameter = parameter
+        self.cache = cache
+        self.thresholds = {"state": parameter, "city": parameter,
+                           "name": parameter,
+                           "address": address_threshold}
+        self.name_weight = name_weight
+        self.address_weight = address_weight
+        self.pairs = 0
+        self.matches = 0
+        self.rejected = dict.fromkeys(STAGES + ("score",), 0)
+        self.pruned = dict.fromkeys(STAGES, 0)
+        self.exact = dict.fromkeys(STAGES, 0)
+        self.computed = dict.fromkeys(STAGES, 0)
+
+    def similarity(self, stage, a, b):
+        """
+        Jaro-Winkler similarity of a and b for a stage, or None when the
+        bound shows it is below the stage's threshold.
+        """
+        a = a or ""
+        b = b or ""
+        if a == b:
+            # Two missing values agree too, though jellyfish scores two
+            # empty strings 0.
+            self.exact[stage] += 1
+            return 1.0
+        if jaro_winkler_bound(a, b) < self.thresholds[stage] - EPSILON:
+            self.pruned[stage] += 1
+            return None
+        self.computed[stage] += 1
+        if self.cache is not None:
+            return self.cache.jaro_winkler(a, b)
+        return td.jaro_winkler(a, b)
+
+    def stage(self, stage, main, candidate):
+        """
+        Score of one stage, or None when the pair fails it.
+        """
+        column = STAGE_COLUMNS[stage]
+        score = self.similarity(stage, main[column], candidate[column])
+        if score is None or score < self.thresholds[stage]:
+            self.rejected[stage] += 1
+            return None
+        return score
+
+    def match(self, main, candidate):
+        """
+        Runs the cascade on one pair.
+
+        Returns: True when every stage passes.
+        """
+        self.pairs += 1
+        for stage in ("state", "city"):
+            if self.stage(stage, main, candidate) is None:
+                return False
+        name = self.stage("name", main, candidate)
+        if name is None:
+            return False
+        if self.thresholds["address"] > 0 or self.address_weight:
+            address = self.stage("address", main, candidate)
+            if address is None:
+                return False
+            if self.address_weight:
+                score = ((self.name_weight * name + self.address_weight * address)
+                         / (self.name_weight + self.address_weight))
+                if score < self.parameter:
+                    self.rejected["score"] += 1
+                    return False
+        self.matches += 1
+        return True
+
+    def stats(self):
+        """
+        Returns: the counters, per stage, of one clean.
+        """
+        stats = {"pairs": self.pairs, "matches": self.matches,
+                 "rejected": dict(self.rejected), "pruned": dict(self.pruned),
+                 "exact": dict(self.exact), "computed": dict(self.computed)}
+        if self.cache is not None:
+            stats["similarity_cache"] = self.cache.stats()
+        return stats
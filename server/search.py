@@ -0,0 +1,77 @@
+"""
+Full-text search over restaurants and inspection violations.
+
+ri_restaurants_fts indexes restaurant names and addresses and
+ri_inspections_fts the violations text, with SQLite's FTS5 (see
+schema/create.sql). User queries are turned into FTS5 query strings here
+so punctuation in them ("7-38-005", "joe's") cannot be read as query
+syntax.
+"""
+import re
+
+# A double-quoted phrase, or a word with an optional trailing * for a
+# prefix search.
+QUERY_TERM = re.compile(r'"([^"]*)"|([^\s"]+)')
+
+# Splits text into tokens the way FTS5's unicode61 tokenizer does.
+TOKEN = re.compile(r"[^\W_]+")
+
+# Results of a query past the first MAX_RESULTS are not served, so a page
+# never costs more than ranking MAX_RESULTS matches.
+MAX_RESULTS = 1000
+
+
+def tokens(text):
+    """
+    Returns: the lower-cased tokens of text.
+    """
+    return TOKEN.findall(text.lower())
+
+
+def phrase(words):
+    return '"%s"' % " ".join(words)
+
+
+def fts_query(text):
+    """
+    Turns a search box query into an FTS5 query matching documents that
+    have every term: words, "quoted phrases" and word* prefixes.
+
+    Returns: the query string, None when text has no words.
+    """
+    terms = []
+    for quoted, word in QUERY_TERM.findall(text):
+        words = tokens(quoted or word)
+        if not words:
+            continue
+        term = phrase(words)
+        if word.endswith("*"):
+            term += " *"
+        terms.append(term)
+    return " AND ".join(terms) or None
+
+
+def name_phrases(text):
+    """
+    The phrase queries tweet name matching runs on ri_restaurants_fts: one
+    anchored at the first token of the name for every word of the tweet.
+
+    Returns: (the tweet's tokens, the query string or None).
+    """
+    words = tokens(text)
+    if not words:
+        return words, None
+    anchors = sorted(set(words))
+    return words, "name : (%s)" % " OR ".join(
+        "^" + phrase([word]) for word in anchors)
+
+
+def contains_phrase(words, name_words):
+    """
+    True when name_words occur in words, one after the other.
+    """
+    size = len(name_words)
+    if not size:
+        return False
+    return any(words[i:i + size] == name_words
+               for i in range(len(words) - size + 1))
@@ -1,15 +1,41 @@
+import startup
+startup.track_imports()
 from bottle import Bottle, post, get, HTTPResponse, request, response
 import argparse
+import contextlib
+import functools
 import os
 import sys
 import sqlite3
 import logging
+import threading
 from db import DB
 from db import dict_factory
 from db import InspError
+from db import INSPECTION_FIELDS
+from db import CACHED_STATEMENTS
+import metrics
+import plans
+from cache import LRUCache
+from cache import ResponseCache
+from cache import InspectionCounter
+from store import RestaurantStore
+from store import attach_store
+from jobs import CleanJobs
+from jobs import RESUMABLE
+from txn import GroupCommit
+from txn import GroupCommitPlugin
+import violations
+from search import MAX_RESULTS
+from stats import group_by
+from stats import merge_groups
+from stats import MAX_RESTAURANTS
+import urllib.parse
 import string
 import json
+import fastjson
 import time
+startup.imported()
 
 
 
@@ -17,9 +43,44 @@ DB_NAME = "insp.db"
 logging.basicConfig(level=logging.INFO)
 
 app = Bottle()
-app.counter = 0
-app.transaction_size = 1
+# Commits ingest after /txn's number of records or milliseconds.
+app.group_commit = GroupCommit(lambda: app.db_connection,
+                               lambda: app.inspection_count.commit())
 app.num_blocks = 4
+app.scaling = False
+app.metrics = None
+# Resolved primary/linked restaurants, emptied whenever clusters change.
+app.cluster_cache = LRUCache()
+# GET responses served from memory until they expire or a write drops them.
+app.response_cache = ResponseCache()
+app.inspection_count = InspectionCounter()
+# In-memory restaurant columns for matching, only kept with --columnar.
+app.store = None
+fastjson.install(app)
+app.install(GroupCommitPlugin(app.group_commit))
+app.plan_auditor = None
+app.profile_clean = False
+app.profile_dir = "profiles"
+app.window = 10
+app.address_threshold = 0.0
+app.address_weight = 0.0
+app.clean_stats = None
+# Jaro-Winkler memo of /clean, created by the first clean, see
+# similarity_cache().
+app.similarity_cache = None
+app.similarity_cache_size = 200000
+app.persist_similarity = False
+app.clean_jobs = CleanJobs()
+# Set on the shard servers of a sharded deployment, see shards.py.
+app.shard_id = None
+# Read-only copies the GET routes read from, only kept with --replicas.
+app.replicas = None
+# Binary snapshot of the store written after each clean, set by --snapshot.
+app.snapshot_file = None
+# Store violations coded and compressed, see violations.py.
+app.compress_violations = False
+# How tweets are matched to restaurant names, "exact" or "fts".
+app.tweet_match = "exact"
 
 @app.get("/hello")
 def hello():
@@ -28,8 +89,20 @@ def hello():
 @app.get("/reset")
 @app.get("/create")
 def create():
+    app.clean_jobs.stop()
+    app.clean_jobs.forget()
     db = DB(app.db_connection)
     db.create_script()
+    if app.shard_id is not None:
+        from shards import first_restaurant_id
+        db.reserve_restaurant_ids(first_restaurant_id(app.shard_id))
+    app.cluster_cache.clear()
+    app.response_cache.clear()
+    app.inspection_count.reset(0)
+    app.group_commit.discard()
+    compress_violations()
+    reload_store()
+    refresh_replicas()
     return "Created"
 
 
@@ -37,34 +110,234 @@ def create():
 def seed():
     db = DB(app.db_connection)
     db.seed_data()
+    db.rebuild_search_index()
+    db.rebuild_stats()
+    app.cluster_cache.clear()
+    app.response_cache.clear()
+    app.inspection_count.reset(db.count_inspections())
+    app.group_commit.discard()
+    compress_violations()
+    reload_store()
+    refresh_replicas()
     return "Seeded"
 
-@app.get("/restaurants/<restaurant_id:int>")
+@app.get("/metrics")
+def export_metrics():
+    """
+    Returns route and DB method metrics in the Prometheus text format.
+    Only available when the server is started with --metrics.
+    """
+    if app.metrics is None:
+        raise HTTPResponse(status=404)
+    response.content_type = "text/plain; version=0.0.4"
+    return app.metrics.render()
+
+@app.get("/debug/query-plans")
+def query_plans():
+    """
+    Returns the query plan of every distinct statement seen so far, with
+    the ones doing full table scans first. Only available when the server
+    is started with --audit-plans.
+    """
+    if app.plan_auditor is None:
+        raise HTTPResponse(status=404)
+    return app.plan_auditor.report()
+
+# Key of the request environ holding when a GET response's data was read.
+DATA_AS_OF = "insp.data_as_of"
+
+
+def data_as_of(as_of):
+    """
+    Records the time a GET response's data was read as of and sends its
+    age, in seconds, in the X-Data-Age header.
+    """
+    request.environ[DATA_AS_OF] = as_of
+    response.set_header("X-Data-Age", "%.3f" % max(0.0, time.time() - as_of))
+
+
+@contextlib.contextmanager
+def read_connection():
+    """
+    The connection a GET route reads from: a replica when there are
+    replicas fresh enough, otherwise the server's connection, holding the
+    group commit lock like every other route does. The routes using it
+    skip GroupCommitPlugin so replica reads do not wait for writes.
+    """
+    connection, as_of = None, None
+    if app.replicas is not None:
+        connection, as_of = app.replicas.acquire()
+    if connection is None:
+        with app.group_commit.lock:
+            data_as_of(time.time())
+            yield app.db_connection
+    else:
+        try:
+            data_as_of(as_of)
+            yield connection
+        finally:
+            app.replicas.release(connection)
+
+
+def compress_violations():
+    """
+    Codes the violations stored as text, with --compress-violations.
+    """
+    if app.compress_violations:
+        try:
+            coded = violations.compress(app.db_connection)
+            logging.info("Coded the violations of %d inspections", coded)
+        except Exception as e:
+            print(e, "error compressing violations")
+
+
+def refresh_replicas():
+    """
+    Snapshots the replicas after a change that should not wait for the
+    next refresh (a reset, the seed script, a clean or a clean job).
+    """
+    if app.replicas is not None:
+        try:
+            app.replicas.refresh()
+        except Exception as e:
+            print(e, "error refreshing replicas")
+
+
+def cached_response(route):
+    """
+    Serves a GET route taking a restaurant_id from app.response_cache. The
+    cache key is the route, the restaurant id and the query string, and
+    responses are cached already serialized, along with the time their
+    data was read as of.
+    """
+    def decorator(callback):
+        @functools.wraps(callback)
+        def wrapper(restaurant_id, **kwargs):
+            if app.response_cache.ttl <= 0:
+                return callback(restaurant_id, **kwargs)
+            variant = request.query_string
+            cached = app.response_cache.get(route, restaurant_id, variant)
+            if cached is not None:
+                response.content_type, rv, as_of = cached
+                data_as_of(as_of)
+                return rv
+            rv = callback(restaurant_id, **kwargs)
+            if isinstance(rv, dict):
+                rv = fastjson.dumps(rv)
+                response.content_type = "application/json"
+            if response.status_code == 200 and isinstance(rv, (bytes, str)):
+                as_of = request.environ.get(DATA_AS_OF, time.time())
+                # A replica's response may predate a write that already
+                # invalidated it, and must not outlive the staleness bound.
+                max_age = (app.replicas.max_staleness
+                           if app.replicas is not None else None)
+                app.response_cache.put(route, restaurant_id, variant,
+                                       (response.content_type, rv, as_of),
+                                       as_of, max_age)
+            return rv
+        return wrapper
+    return decorator
+
+@app.get("/restaurants/<restaurant_id:int>", skip=["groupcommit"])
+@cached_response("restaurant")
 def find_restaurant(restaurant_id):
     """
     Returns a restaurant and all of its associated inspections.
+
+    The inspections can be paged with ?after=<inspection_id>&limit=N (the
+    response then has the "next" value to pass as after), trimmed with
+    ?fields=id,results,inspection_date and streamed as newline-delimited
+    JSON with ?format=ndjson. With ?rows=tuples the inspections are
+    returned as arrays, in the order given by "columns".
     """
-    db = DB(app.db_connection)
+    after, limit, fields = inspection_page_args()
+    if request.query.get("format") == "ndjson":
+        response.content_type = "application/x-ndjson"
+        return stream_inspections(restaurant_id, after, limit, fields)
+    with read_connection() as connection:
+        db = DB(connection)
+        try:
+            table = db.find_restaurant(restaurant_id)
+            restaurant = table[0]
+        except:
+            raise HTTPResponse(status=404)
+        try:
+            rv = {}
+            rv["restaurant"] = restaurant
+            if request.query.get("rows") == "tuples":
+                columns, inspections = db.find_inspection_rows(
+                    restaurant_id, after, limit, fields)
+                rv["columns"] = columns
+                last_id = lambda: inspections[-1][columns.index("id")]
+            else:
+                inspections = db.find_inspections(restaurant_id, after, limit,
+                                                  fields)
+                last_id = lambda: inspections[-1]["id"]
+            rv["inspections"] = inspections
+            if limit is not None:
+                rv["next"] = None
+                if len(inspections) == limit:
+                    rv["next"] = last_id()
+            return rv
+        except:
+            raise HTTPResponse(status=404)
+
+
+def inspection_page_args():
+    """
+    Reads the ?after=, ?limit= and ?fields= inspection query parameters.
+    The inspection id is always returned so it can be used as a cursor.
+
+    Returns: (after, limit, fields), each None when not given.
+    """
+    after = request.query.get("after") or None
+    limit = request.query.get("limit")
+    fields = request.query.get("fields")
     try:
-        rv = {}
-        table = db.find_restaurant(restaurant_id)
-        inspections = db.find_inspections(restaurant_id)
-        rv["restaurant"] = table[0]
-        rv["inspections"] = inspections
-        return rv
-    except:
-        raise HTTPResponse(status=404)
-    
+        if limit is not None:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError(limit)
+    except ValueError:
+        raise HTTPResponse(status=400)
+    if fields is not None:
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+        if any(field not in INSPECTION_FIELDS for field in fields):
+            raise HTTPResponse(status=400)
+        if "id" not in fields:
+            fields.insert(0, "id")
+    return after, limit, fields
 
 
-@app.get("/restaurants/by-inspection/<inspection_id>")
+def stream_inspections(restaurant_id, after, limit, fields):
+    """
+    Yields the restaurant and then each of its inspections as one JSON
+    document per line. Bottle reads the first line while the route runs
+    and the others after it returned, so the generator holds its own
+    read_connection() (the group commit lock, or the replica it read the
+    restaurant from) until the last line is sent or the client goes away.
+    """
+    with read_connection() as connection:
+        db = DB(connection)
+        try:
+            restaurant = db.find_restaurant(restaurant_id)[0]
+        except:
+            raise HTTPResponse(status=404)
+        yield fastjson.dumps({"restaurant": restaurant}) + b"\n"
+        for inspection in db.iter_inspections(restaurant_id, after, limit,
+                                              fields):
+            yield fastjson.dumps(inspection) + b"\n"
+
+
+@app.get("/restaurants/by-inspection/<inspection_id>", skip=["groupcommit"])
 def find_restaurant_by_inspection_id(inspection_id):
     """
     Returns a restaurant associated with a given inspection.
     """
     try:
-        db = DB(app.db_connection)
-        return db.find_restaurant_by_inspection_id(inspection_id)
+        with read_connection() as connection:
+            db = DB(connection)
+            return db.find_restaurant_by_inspection_id(inspection_id)
     except:
         raise HTTPResponse(status=404)
 
@@ -81,51 +354,69 @@ def load_inspection():
         rest_name = data.get("name", None)
         if inspection_id is None or rest_name is None:
             raise HTTPResponse(status=400)
-        rest_address = data["address"]
-        inspection = db.find_inspection(inspection_id)
-        restaurant = db.find_restaurant_by_name_adress(rest_name, data["address"], False)
-        if inspection is not None:
-            request.status = 200
-            return restaurant
-        elif inspection is None and restaurant is not None:
-            restaurant_id = restaurant["id"]
-            db.add_inspection(data, restaurant_id)
+        restaurant, outcome = db.ingest_inspection(data)
+        if outcome != "duplicate":
+            inspection_added(restaurant["id"])
             commit_check(db)
-            response.status = 200
-            return restaurant
-        else:
-            db.add_restaurant(data)
-            restaurant = db.find_restaurant_by_name_adress(rest_name, rest_address, False)
-            restaurant_id = restaurant["id"]
-            db.add_inspection(data, restaurant_id)
-            commit_check(db)
-            response.status = 201
-            return restaurant
+        # 201 when the inspection brought a new restaurant.
+        response.status = 201 if outcome == "created" else 200
+        return restaurant
     except Exception as e:
         raise HTTPResponse(status=501)
 
+def inspection_added(restaurant_id):
+    """
+    Updates the inspection count and drops the cached responses of a
+    restaurant that just got a new inspection.
+    """
+    app.inspection_count.added()
+    app.response_cache.invalidate("restaurant", restaurant_id)
+
 @app.get("/txn/<txnsize:int>")
 def set_transaction_size(txnsize):
     """
-    Sets the transaction size for database commit.
+    Sets the transaction size for database commit. With ?ms= a record is
+    also committed at most that many milliseconds after it was written,
+    by a background timer, whichever limit is reached first.
     """
     try:
-        db = DB(app.db_connection)
-        if db.conn.in_transaction:
-            db.commit()
-            db.conn.start_transaction()
-        app.counter = 0
-        app.transaction_size = txnsize
+        interval = float(request.query.get("ms") or 0) / 1000
+        if txnsize <= 0 or interval < 0:
+            raise ValueError(txnsize)
+    except ValueError:
+        raise HTTPResponse(status=400)
+    try:
+        app.group_commit.configure(txnsize, interval)
         response.status = 200
     except:
         raise HTTPResponse(status=501)
 
+@app.get("/txn")
+def transaction_stats():
+    """
+    Returns the commit policy, the number of commits by trigger, and the
+    average and longest time the oldest record of a batch waited for it.
+    """
+    return app.group_commit.stats()
+
+@app.get("/replicas")
+def replica_stats():
+    """
+    Returns the replicas' age and settings, the reads they served and the
+    reads that fell back to the server's connection because they were
+    staler than allowed. Only available with --replicas.
+    """
+    if app.replicas is None:
+        raise HTTPResponse(status=404)
+    return app.replicas.stats()
+
 @app.get("/commit")
 def commit_txn():
     logging.info("Committing active transactions")
     db = DB(app.db_connection)
     try:
         db.commit()
+        app.group_commit.committed()
         response.status = 200
     except:
         raise HTTPResponse(status=501)
@@ -136,26 +427,138 @@ def abort_txn():
     db = DB(app.db_connection)
     try:
         db.abort()
+        app.group_commit.discard()
+        app.inspection_count.rollback()
+        app.cluster_cache.clear()
+        app.response_cache.clear()
+        reload_store()
         response.status = 200
     except:
         raise HTTPResponse(status=501)
 
 
-@app.get("/count")
+@app.get("/count", skip=["groupcommit"])
 def count_insp():
     logging.info("Counting Inspections")
-    db = DB(app.db_connection)
     try:
-        c = db.conn.cursor()
-        result = c.execute("""SELECT COUNT(id) as cnt FROM ri_inspections""")
-        table = result.fetchall()
-        c.close()
+        if app.inspection_count.loaded:
+            data_as_of(time.time())
+            return str(app.inspection_count.value())
+        with read_connection() as connection:
+            count = DB(connection).count_inspections()
+            if connection is app.db_connection:
+                app.inspection_count.load(count)
         response.status = 200
-        count = table[0]["cnt"]
-        return str(count)    
+        return str(count)
     except Exception as e:
         raise HTTPResponse(status=501)
 
+def search_args(query):
+    """
+    Reads the ?q=, ?in=, ?limit= and ?offset= parameters of /search.
+
+    Returns: (q, scope, limit, offset)
+    """
+    text = (query.get("q") or "").strip()
+    scope = query.get("in") or "restaurants"
+    if not text or scope not in ("restaurants", "inspections"):
+        raise HTTPResponse(status=400)
+    try:
+        limit = int(query.get("limit") or 20)
+        offset = int(query.get("offset") or 0)
+    except ValueError:
+        raise HTTPResponse(status=400)
+    if limit <= 0 or offset < 0 or offset + limit > MAX_RESULTS:
+        raise HTTPResponse(status=400)
+    return text, scope, limit, offset
+
+
+@app.get("/search", skip=["groupcommit"])
+def search():
+    '''
+    Full-text search. ?q= takes words, "quoted phrases" and prefix* terms,
+    all of which must match. ?in=restaurants (the default) searches
+    restaurant names and addresses, ?in=inspections the violations.
+    Results come best match first with their score, a page of ?limit=
+    (default 20) from ?offset=, within the first MAX_RESULTS; "next" is
+    the offset of the next page, None after the last one.
+    '''
+    text, scope, limit, offset = search_args(request.query)
+    with read_connection() as connection:
+        db = DB(connection)
+        try:
+            if scope == "inspections":
+                results = db.search_inspections(text, limit, offset)
+            else:
+                results = db.search_restaurants(text, limit, offset)
+        except Exception as e:
+            print(e, "error searching")
+            raise HTTPResponse(status=501)
+    return {"query": text, "in": scope, "results": results,
+            "next": offset + limit if len(results) == limit else None}
+
+def stats_limit(query):
+    """
+    Reads the ?limit= parameter of /stats/tweets.
+    """
+    try:
+        limit = int(query.get("limit") or 20)
+    except ValueError:
+        raise HTTPResponse(status=400)
+    if not 0 < limit <= MAX_RESTAURANTS:
+        raise HTTPResponse(status=400)
+    return limit
+
+
+@app.get("/stats/inspections", skip=["groupcommit"])
+def inspection_stats():
+    '''
+    Inspections with their pass and fail counts and rates, grouped by
+    ?by=: zip, risk or facility_type, month, one of those and month (e.g.
+    ?by=zip,month), or nothing for the totals. Read from the rollups in
+    ri_inspection_stats.
+    '''
+    try:
+        keys = group_by(request.query.get("by"))
+    except ValueError:
+        raise HTTPResponse(status=400)
+    with read_connection() as connection:
+        try:
+            groups = DB(connection).inspection_stats(keys)
+        except Exception as e:
+            print(e, "error reading inspection stats")
+            raise HTTPResponse(status=501)
+    return {"by": keys, "groups": groups}
+
+
+@app.get("/stats/tweets", skip=["groupcommit"])
+def tweet_stats():
+    '''
+    The ?limit= (default 20) restaurants matched to the most tweets, with
+    how many matched by name, by location or both.
+    '''
+    limit = stats_limit(request.query)
+    with read_connection() as connection:
+        try:
+            restaurants = DB(connection).tweet_stats(limit)
+        except Exception as e:
+            print(e, "error reading tweet stats")
+            raise HTTPResponse(status=501)
+    return {"restaurants": restaurants}
+
+
+@app.get("/stats/tweets/<restaurant_id:int>", skip=["groupcommit"])
+def restaurant_tweet_stats(restaurant_id):
+    '''
+    The tweet counts of one restaurant.
+    '''
+    with read_connection() as connection:
+        try:
+            return DB(connection).restaurant_tweet_stats(restaurant_id)
+        except Exception as e:
+            print(e, "error reading tweet stats")
+            raise HTTPResponse(status=501)
+
 # A helper function that will take text and split it into n-grams based on spaces.
 def ngrams(tweet, n):
     single_word = tweet.translate(str.maketrans('', '', string.punctuation)).split()
@@ -179,26 +582,164 @@ def tweet():
             n_grams = ngrams(text, n)
             n_grams = [word.lower() for word in n_grams]
             tweet_ngrams = tweet_ngrams + n_grams
-        result = db.match_tweet_restaurant(tweet, tweet_ngrams, lat, lon)
+        result = db.match_tweet_restaurant(tweet, tweet_ngrams, lat, lon,
+                                           app.tweet_match)
+        for restaurant_id in result["matches"]:
+            app.response_cache.invalidate("tweets", restaurant_id)
         response.status = 201
         return result
     except Exception as e:
         raise HTTPResponse(status=501)
 
 
-@app.get("/tweets/<restaurant_id:int>")
+@app.get("/tweets/<restaurant_id:int>", skip=["groupcommit"])
+@cached_response("tweets")
 def find_restaurant_tweets(restaurant_id):
     """
     Returns a restaurant's associated tweets (tkey and match).
     """
     try:
-        db = DB(app.db_connection)
-        results = db.find_tweets_by_restaurant(restaurant_id)
+        with read_connection() as connection:
+            db = DB(connection)
+            results = db.find_tweets_by_restaurant(restaurant_id)
         response.status = 200
-        return json.dumps(results)
+        response.content_type = "application/json"
+        return fastjson.dumps(results)
     except Exception as e:
         raise HTTPResponse(status=501)
 
+def reload_store():
+    """
+    Rebuilds the in-memory restaurant store, if there is one, after the
+    restaurant table changed outside of DB.add_restaurant (a reset, the
+    seed script or a rollback).
+    """
+    if app.store is not None:
+        app.store = RestaurantStore.load(app.db_connection)
+        attach_store(app.db_connection, app.store)
+
+def export_snapshot(connection):
+    """
+    Writes the store to the --snapshot file after a clean, so the next
+    start maps it instead of rebuilding the store.
+    """
+    if app.snapshot_file is None or app.store is None:
+        return
+    import snapshot
+    try:
+        start = time.time()
+        size = snapshot.export(app.store, connection, app.snapshot_file)
+        logging.info("Snapshot of %d restaurants written to %s "
+                     "(%d bytes, %.3fs)", len(app.store), app.snapshot_file,
+                     size, time.time() - start)
+    except Exception as e:
+        print(e, "error writing snapshot", app.snapshot_file)
+
+def load_store(connection):
+    """
+    Builds the store from the --snapshot file when it matches the
+    database, otherwise from the restaurants visible on connection.
+    """
+    store = None
+    if app.snapshot_file:
+        import snapshot
+        store = snapshot.load(app.snapshot_file, connection)
+        if store is not None:
+            logging.info("Mapped snapshot %s", app.snapshot_file)
+    if store is None:
+        store = RestaurantStore.load(connection)
+    return store
+
+def load_store_in_background(db_file):
+    """
+    Loads the store with --prewarm, on a connection of its own while the
+    routes match and clean in SQL, then attaches it between requests,
+    after adding the restaurants inserted in the meantime. When the
+    database was reset or cleaned meanwhile the store is built again from
+    the server's connection instead.
+    """
+    import snapshot
+    start = time.time()
+    store, version = None, None
+    try:
+        connection = sqlite3.connect(db_file)
+        try:
+            before = snapshot.data_version(connection)
+            store = load_store(connection)
+            version = snapshot.data_version(connection)
+        finally:
+            connection.close()
+        if not snapshot.matches(before, version):
+            store = None
+    except Exception as e:
+        print(e, "error loading restaurant store in the background")
+        store = None
+    while True:
+        with app.group_commit.lock:
+            # A clean job that stops rebuilds the store; one attached
+            # while the job runs would be replaced.
+            if not app.clean_jobs.running():
+                try:
+                    current = snapshot.data_version(app.db_connection)
+                except Exception as e:
+                    # No schema yet.
+                    print(e, "error reading data version")
+                    current = None
+                if (store is None or current is None
+                        or not snapshot.matches(version, current)):
+                    store = RestaurantStore.load(app.db_connection)
+                else:
+                    store.load_rows(app.db_connection,
+                                    store.columns["id"][-1] if len(store) else 0)
+                    if len(store) != current["restaurants"]:
+                        store = RestaurantStore.load(app.db_connection)
+                app.store = store
+                attach_store(app.db_connection, app.store)
+                break
+        time.sleep(0.1)
+    logging.info("Loaded %d restaurants in the background in %.3fs",
+                 len(app.store), time.time() - start)
+
+def prewarm(db_file, load):
+    """
+    Warms the server up once its port is bound, with --prewarm: imports
+    the modules the first /clean would, loads the store (with load) and
+    the memoized similarity scores of --persist-similarity.
+    """
+    try:
+        start = time.time()
+        import jellyfish
+        import profiling
+        import scoring
+        logging.info("Imported the matching modules in %.3fs",
+                     time.time() - start)
+        if load:
+            load_store_in_background(db_file)
+        if app.persist_similarity:
+            start = time.time()
+            with app.group_commit.lock:
+                similarity_cache()
+            logging.info("Warmed the similarity cache in %.3fs",
+                         time.time() - start)
+    except Exception as e:
+        print(e, "error prewarming")
+
+def serving(startup_profile, warm, load):
+    """
+    Runs once the port is bound: logs the startup profile with
+    --startup-profile and, with --prewarm, starts prewarming on a thread
+    of its own.
+    """
+    startup.mark("bind")
+    if startup_profile:
+        for line in startup.report():
+            logging.info(line)
+    if warm:
+        logging.info("Prewarming in the background")
+        threading.Thread(target=prewarm,
+                         args=(database_file(app.db_connection), load),
+                         daemon=True).start()
+
 def commit_check(db):
     """
     Checks if the transaction size is reached 
@@ -208,60 +749,584 @@ def commit_check(db):
     Returns:
         Nothing.
     """
-    app.counter += 1
-    if app.counter == app.transaction_size:
-        db.commit()
-        app.counter = 0
+    app.group_commit.added()
+
+
+CLEAN_STRATEGIES = ("blocking", "sorted", "full")
+
+
+def similarity_cache():
+    """
+    The Jaro-Winkler memo shared by every clean. The first clean imports
+    the scoring module, creates it and, with --persist-similarity, loads
+    the saved scores into it.
+    """
+    if app.similarity_cache is None:
+        from scoring import SimilarityCache
+        cache = SimilarityCache(app.similarity_cache_size,
+                                app.persist_similarity)
+        if app.persist_similarity:
+            logging.info("Loading memoized similarity scores")
+            cache.load(app.db_connection)
+        app.similarity_cache = cache
+    return app.similarity_cache
+
+
+def clean_args(query):
+    """
+    Reads the ?strategy=, ?window=, ?address_threshold= and
+    ?address_weight= clean parameters, falling back on the server's
+    settings.
+
+    Returns: (strategy, window, scorer)
+    """
+    strategy = query.get("strategy") or ("blocking" if app.scaling else "full")
+    if strategy not in CLEAN_STRATEGIES:
+        raise HTTPResponse(status=400)
+    try:
+        window = int(query.get("window") or app.window)
+        if window <= 0:
+            raise ValueError(window)
+        from scoring import PairScorer
+        scorer = PairScorer(0.7,
+            address_threshold=float(query.get("address_threshold")
+                                    or app.address_threshold),
+            address_weight=float(query.get("address_weight")
+                                 or app.address_weight),
+            cache=similarity_cache())
+    except ValueError:
+        raise HTTPResponse(status=400)
+    return strategy, window, scorer
 
 
 @app.get("/clean")
 def clean():
     '''
     Cleans the restaurants and links the associated restaurants together.
+    ?strategy= picks how candidates are generated: "blocking" (name
+    letter and zip prefix blocks, the default with --scaling), "sorted"
+    (sorted neighbourhood over ?window= following restaurants) or "full"
+    (every pair, the default otherwise).
+    ?address_threshold= and ?address_weight= turn on the address stage of
+    the scoring cascade; the cascade's counters are served on /clean/stats.
+    With ?profile=1 (or when started with --profile-clean) the run is
+    profiled and a per-phase summary is returned.
     '''
+    from profiling import CleanProfiler
+    from profiling import no_phase
     logging.info("Cleaning Restaurants")
+    if app.clean_jobs.running():
+        raise HTTPResponse(status=409)
+    strategy, window, scorer = clean_args(request.query)
     start = time.time()
+    profiler = None
+    phase = no_phase
+    if app.profile_clean or request.query.get("profile") == "1":
+        profiler = CleanProfiler(app.profile_dir)
+        phase = profiler.phase
+        profiler.start()
+    app.cluster_cache.clear()
+    app.response_cache.clear()
     try:    
         db = DB(app.db_connection)
-        if app.scaling:
-            print("blocking")
-            db.create_blocks(app.num_blocks)
-            block_names = db.get_block_names()
-            for index, block_name in enumerate(block_names):
-                db.create_index(block_name, index)
-                matched = db.match_with_blocking(block_name, 0.7)
+        if strategy == "blocking":
+            if db.store is not None:
+                print("blocking (columnar)")
+                candidates = db.store.candidates_within_block
+            else:
+                print("blocking")
+                candidates = db.get_candidates_within_block
+            for chunk in db.block_chunks(app.num_blocks):
+                with phase("candidate generation"):
+                    candidate_pairs = candidates(chunk)
+                with phase("scoring"):
+                    matched = db.link_candidates(candidate_pairs, 0.7, scorer)
+                with phase("writes"):
+                    for restaurant in matched:
+                        db.gen_aut_restaurant(restaurant)
+        elif strategy == "sorted":
+            print("sorted neighbourhood, window", window)
+            with phase("candidate generation"):
+                candidate_pairs = db.get_sorted_neighbourhood_candidates(window)
+            with phase("scoring"):
+                matched = db.link_candidates(candidate_pairs, 0.7, scorer)
+            with phase("writes"):
                 for restaurant in matched:
                     db.gen_aut_restaurant(restaurant)
         else:
             print("not blocking")
-            linked_restaurants = db.find_all_linked(0.7)
-            for restaurant in linked_restaurants:
-                db.gen_aut_restaurant(restaurant)
+            with phase("candidate generation"):
+                not_clean = list(db.not_clean())
+                all_restaurants = list(db.find_all_restaurants())
+            with phase("scoring"):
+                linked_restaurants = db.link_restaurants(not_clean,
+                                                         all_restaurants, 0.7,
+                                                         scorer)
+            with phase("writes"):
+                for restaurant in linked_restaurants:
+                    db.gen_aut_restaurant(restaurant)
         response.status = 200
         end = time.time()
         print("Time took to clean:", end - start)
+        if similarity_cache().persist:
+            similarity_cache().save(app.db_connection)
+        app.clean_stats = scorer.stats()
+        logging.info("Clean scoring: %s", app.clean_stats)
+        export_snapshot(app.db_connection)
     except Exception as e:
         print(e)
         raise HTTPResponse(status=501)
+    finally:
+        # Cleaning commits as it goes, which commits any pending inserts.
+        app.group_commit.committed()
+        refresh_replicas()
+        if profiler is not None:
+            summary = profiler.stop()
+    if profiler is not None:
+        logging.info("Clean profile written to %s", summary["pstats"])
+        summary["scoring"] = app.clean_stats
+        return summary
+
+
+@app.get("/clean/stats")
+def clean_stats():
+    '''
+    Returns the scoring counters of the last clean: pairs scored and, per
+    stage, the pairs rejected, pruned by the length and prefix bound,
+    matched by equality, and scored with Jaro-Winkler, along with the hit
+    rate of the similarity cache.
+    '''
+    if app.clean_stats is None:
+        raise HTTPResponse(status=404)
+    return app.clean_stats
+
+def database_file(connection):
+    """
+    Path of the main database of connection, "" for an in-memory one.
+    """
+    return connection.execute("PRAGMA database_list").fetchone()["file"]
+
+
+def clean_job_finished(job, connection):
+    """
+    Runs on a clean job's thread, with the job's connection, when the job
+    stops.
+    """
+    app.cluster_cache.clear()
+    app.response_cache.clear()
+    if similarity_cache().persist:
+        similarity_cache().save(connection)
+    app.clean_stats = job.scorer.stats()
+    logging.info("Clean job %s %s: %s", job.id, job.status, app.clean_stats)
+    if app.store is not None:
+        # The job wrote its composites, clean flags and clusters in SQL
+        # only. The store is rebuilt from the server's connection, which
+        # also sees the restaurants it has not committed yet.
+        lock = app.group_commit.lock
+        while not lock.acquire(timeout=0.1):
+            if job.discarded.is_set():
+                # /create holds the lock, waits for the job and reloads
+                # the store itself.
+                return
+        try:
+            reload_store()
+            if job.status != "failed":
+                export_snapshot(app.db_connection)
+        finally:
+            lock.release()
+    # The blocks checkpointed before any cancel or failure are committed.
+    refresh_replicas()
+
 
-@app.get("/restaurants/all-by-inspection/<inspection_id>")
+def start_clean_job(job_id, scorer):
+    db_file = database_file(app.db_connection)
+    if not db_file:
+        raise HTTPResponse(status=501)
+    # The job reads what the server's connection has written.
+    app.db_connection.commit()
+    app.group_commit.committed()
+    app.cluster_cache.clear()
+    app.response_cache.clear()
+    job = app.clean_jobs.start(app.db_connection, job_id, db_file, scorer,
+                               clean_job_finished)
+    if job is None:
+        raise HTTPResponse(status=404)
+    response.status = 202
+    return job.progress()
+
+
+@app.post("/clean/jobs")
+def create_clean_job():
+    '''
+    Starts a clean in the background and returns its progress, with the
+    job id. Takes the parameters of /clean. Only one job runs at a time.
+    '''
+    if app.clean_jobs.running():
+        raise HTTPResponse(status=409)
+    strategy, window, scorer = clean_args(request.query)
+    job_id = app.clean_jobs.create(app.db_connection, strategy,
+                                   {"window": window}, app.num_blocks)
+    logging.info("Starting clean job %s (%s)", job_id, strategy)
+    return start_clean_job(job_id, scorer)
+
+
+@app.get("/clean/jobs/<job_id:int>")
+def clean_job(job_id):
+    '''
+    Returns a clean job's status and progress: blocks done out of
+    blocks_total, pairs scored, clusters written and, while it runs, the
+    estimated seconds left.
+    '''
+    progress = app.clean_jobs.progress(app.db_connection, job_id)
+    if progress is None:
+        raise HTTPResponse(status=404)
+    return progress
+
+
+@app.post("/clean/jobs/<job_id:int>/cancel")
+def cancel_clean_job(job_id):
+    '''
+    Stops a running clean job after its current block.
+    '''
+    if app.clean_jobs.progress(app.db_connection, job_id) is None:
+        raise HTTPResponse(status=404)
+    if not app.clean_jobs.cancel(job_id):
+        raise HTTPResponse(status=409)
+    response.status = 202
+    return app.clean_jobs.progress(app.db_connection, job_id)
+
+
+@app.post("/clean/jobs/<job_id:int>/resume")
+def resume_clean_job(job_id):
+    '''
+    Restarts a cancelled, failed or interrupted clean job, skipping the
+    blocks it already wrote. Takes the scoring parameters of /clean.
+    '''
+    status = app.clean_jobs.status(app.db_connection, job_id)
+    if status is None:
+        raise HTTPResponse(status=404)
+    if status not in RESUMABLE or app.clean_jobs.running():
+        raise HTTPResponse(status=409)
+    logging.info("Resuming clean job %s", job_id)
+    return start_clean_job(job_id, clean_args(request.query)[2])
+
+
+@app.get("/restaurants/all-by-inspection/<inspection_id>", skip=["groupcommit"])
 def find_all_restaurants_by_inspection_id(inspection_id):
     '''
     Finds and returns all restaurants assocuated with an inspection id.
     '''
     logging.info("Finding all restaurants by inspection id: %s" % inspection_id)
+    key = ("inspection", inspection_id)
+    rv = app.cluster_cache.get(key)
+    if rv is not None:
+        data_as_of(time.time())
+        return rv
     try:
-        db = DB(app.db_connection)
-        linked_restaurants, primary_restaurant = db.find_all_restaurants_by_inspection_id(inspection_id)
-        ids = [rest["id"] for rest in linked_restaurants]
-        ids.append(primary_restaurant["id"])
-        rv = {"primary": primary_restaurant,
-                "linked":linked_restaurants,
-                "ids": ids}
+        with read_connection() as connection:
+            db = DB(connection)
+            linked_restaurants, primary_restaurant = db.find_all_restaurants_by_inspection_id(inspection_id)
+        rv = cluster_response(linked_restaurants, primary_restaurant)
         response.status = 200
     except Exception as e:
         raise HTTPResponse(status=501)
+    cache_cluster(key, rv, connection)
+    return rv
+
+
+@app.get("/restaurants/all-by-restaurant/<restaurant_id:int>",
+         skip=["groupcommit"])
+def find_all_restaurants_by_restaurant_id(restaurant_id):
+    '''
+    Finds and returns the primary of a restaurant and all restaurants
+    linked to it.
+    '''
+    key = ("restaurant", restaurant_id)
+    rv = app.cluster_cache.get(key)
+    if rv is not None:
+        data_as_of(time.time())
+        return rv
+    with read_connection() as connection:
+        db = DB(connection)
+        cluster = db.find_cluster(restaurant_id)
+    if cluster is None:
+        raise HTTPResponse(status=404)
+    linked_restaurants, primary_restaurant = cluster
+    rv = cluster_response(linked_restaurants, primary_restaurant)
+    cache_cluster(key, rv, connection)
+    return rv
+
+
+def cache_cluster(key, rv, connection):
+    '''
+    Caches a cluster read from the server's connection. Clusters read from
+    a replica are not cached: the cache is only emptied when clusters
+    change, so it would keep the replica's older clusters.
+    '''
+    if connection is app.db_connection:
+        app.cluster_cache.put(key, rv)
+
+
+def cluster_response(linked_restaurants, primary_restaurant):
+    ids = [rest["id"] for rest in linked_restaurants]
+    ids.append(primary_restaurant["id"])
+    return {"primary": primary_restaurant,
+            "linked": linked_restaurants,
+            "ids": ids}
+
+
+# The router of a sharded deployment, run instead of app with --shards.
+router = Bottle()
+fastjson.install(router)
+router.shards = None
+
+
+# Headers of a shard's reply passed on by the router.
+SHARD_HEADERS = ("Content-Type", "X-Data-Age")
+
+
+def shard_response(reply):
+    headers = {name: reply.headers.get(name) for name in SHARD_HEADERS
+               if reply.headers.get(name) is not None}
+    return HTTPResponse(reply.body, reply.status, headers)
+
+
+def all_shards(replies):
+    """
+    Returns the first failed reply of a fan out, or the first reply when
+    every shard succeeded.
+    """
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+    return shard_response(replies[0])
+
+
+def restaurant_shard(restaurant_id):
+    shard = router.shards.for_restaurant(restaurant_id)
+    if shard is None:
+        raise HTTPResponse(status=404)
+    return shard
+
+
+@router.get("/hello")
+def router_hello():
+    return "Hello, World!"
+
+
+@router.get("/reset")
+@router.get("/create")
+@router.get("/txn/<txnsize:int>")
+@router.get("/commit")
+@router.get("/abort")
+def router_broadcast(txnsize=None):
+    """
+    Runs a schema or transaction route on every shard.
+    """
+    return all_shards(router.shards.fan_out("GET", request.path,
+                                            request.query_string))
+
+
+def seed_records():
+    """
+    Runs the seed script on a scratch database.
+
+    Returns: the seeded inspections with their restaurants, in the form
+             posted to /inspections.
+    """
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = dict_factory
+    try:
+        db = DB(conn)
+        db.create_script()
+        db.seed_data()
+        return conn.execute("""SELECT i.id AS inspection_id, r.name,
+                            r.facility_type, i.risk, r.address, r.city,
+                            r.state, r.zip, i.inspection_date AS date,
+                            i.inspection_type, i.results, i.violations,
+                            r.latitude, r.longitude
+                            FROM ri_inspections AS i
+                            JOIN ri_restaurants AS r ON r.id = i.restaurant_id
+                            ORDER BY i.rowid""").fetchall()
+    finally:
+        conn.close()
+
+
+@router.get("/seed")
+def router_seed():
+    """
+    The seed script inserts fixed restaurant ids, which only fit shard 0,
+    so each seeded inspection is posted to the shard of its zip code
+    instead, creating its restaurant there.
+    """
+    for record in seed_records():
+        reply = router.shards.call(router.shards.for_zip(record["zip"]),
+                                   "POST", "/inspections",
+                                   body=json.dumps(record).encode("utf-8"))
+        if not reply.ok:
+            return shard_response(reply)
+    return "Seeded"
+
+
+@router.get("/count")
+def router_count():
+    logging.info("Counting Inspections on %d shards", len(router.shards))
+    replies = router.shards.fan_out("GET", "/count")
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+    return str(sum(int(reply.body) for reply in replies))
+
+
+@router.get("/search")
+def router_search():
+    '''
+    Searches every shard for the first offset + limit results and merges
+    them by score.
+    '''
+    text, scope, limit, offset = search_args(request.query)
+    query = urllib.parse.urlencode({"q": text, "in": scope,
+                                    "limit": offset + limit})
+    replies = router.shards.fan_out("GET", "/search", query)
+    results = []
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+        results.extend(reply.json()["results"])
+    results.sort(key=lambda result: -result["score"])
+    results = results[offset:offset + limit]
+    return {"query": text, "in": scope, "results": results,
+            "next": offset + limit if len(results) == limit else None}
+
+
+@router.get("/stats/inspections")
+def router_inspection_stats():
+    '''
+    Adds up the groups of every shard.
+    '''
+    try:
+        keys = group_by(request.query.get("by"))
+    except ValueError:
+        raise HTTPResponse(status=400)
+    replies = router.shards.fan_out("GET", "/stats/inspections",
+                                    request.query_string)
+    groups = []
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+        groups.extend(reply.json()["groups"])
+    return {"by": keys, "groups": merge_groups(keys, groups)}
+
+
+@router.get("/stats/tweets")
+def router_tweet_stats():
+    '''
+    Merges the top restaurants of every shard; a restaurant's tweets are
+    all on its shard.
+    '''
+    limit = stats_limit(request.query)
+    replies = router.shards.fan_out("GET", "/stats/tweets",
+                                    request.query_string)
+    restaurants = []
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+        restaurants.extend(reply.json()["restaurants"])
+    restaurants.sort(key=lambda restaurant: (restaurant["tweets"],
+                                             restaurant["restaurant_id"]),
+                     reverse=True)
+    return {"restaurants": restaurants[:limit]}
+
+
+@router.post("/inspections")
+def router_load_inspection():
+    """
+    Sends an inspection to the shard of its zip code.
+    """
+    body = request.body.read()
+    try:
+        data = json.loads(body)
+        shard = router.shards.for_zip(data.get("zip", None))
+    except Exception:
+        raise HTTPResponse(status=400)
+    return shard_response(router.shards.call(shard, "POST", "/inspections",
+                                             body=body))
+
+
+@router.post("/tweet")
+def router_tweet():
+    """
+    Matches a tweet on every shard; each shard records its own matches.
+    """
+    replies = router.shards.fan_out("POST", "/tweet", body=request.body.read())
+    matches = []
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+        matches.extend(reply.json()["matches"])
+    response.status = 201
+    return {"matches": sorted(matches)}
+
+
+@router.get("/restaurants/<restaurant_id:int>")
+@router.get("/tweets/<restaurant_id:int>")
+@router.get("/stats/tweets/<restaurant_id:int>")
+@router.get("/restaurants/all-by-restaurant/<restaurant_id:int>")
+def router_restaurant(restaurant_id):
+    """
+    Sends a per-restaurant GET to the shard the restaurant id belongs to.
+    """
+    return shard_response(router.shards.call(restaurant_shard(restaurant_id),
+                                             "GET", request.path,
+                                             request.query_string))
+
 
+@router.get("/restaurants/by-inspection/<inspection_id>")
+@router.get("/restaurants/all-by-inspection/<inspection_id>")
+def router_by_inspection(inspection_id):
+    """
+    Asks every shard for the inspection's restaurant and returns the one
+    that has it, or shard 0's reply when none does.
+    """
+    replies = router.shards.fan_out("GET", request.path)
+    for reply in replies:
+        if reply.ok and reply.body not in (b"", b"null"):
+            return shard_response(reply)
+    return shard_response(replies[0])
+
+
+@router.get("/clean")
+def router_clean():
+    '''
+    Cleans every shard in parallel. Returns nothing, like /clean, unless
+    the shards return profiles, which are returned as "shards".
+    '''
+    logging.info("Cleaning Restaurants on %d shards", len(router.shards))
+    start = time.time()
+    replies = router.shards.fan_out("GET", "/clean", request.query_string)
+    print("Time took to clean:", time.time() - start)
+    for reply in replies:
+        if not reply.ok:
+            return shard_response(reply)
+    if any(reply.body for reply in replies):
+        return {"shards": [reply.json() for reply in replies]}
+
+
+@router.get("/clean/stats")
+@router.get("/txn")
+def router_shard_stats():
+    '''
+    Returns each shard's reply as "shards", None for the shards that have
+    nothing to report.
+    '''
+    replies = router.shards.fan_out("GET", request.path)
+    if not any(reply.ok for reply in replies):
+        return shard_response(replies[0])
+    return {"shards": [reply.json() if reply.ok else None
+                       for reply in replies]}
+
+
+startup.mark("routes")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -276,25 +1341,246 @@ if __name__ == "__main__":
         default=30235,
         type=int
     )
+    parser.add_argument(
+        "--database",
+        help="SQLite database file (default %s)" % DB_NAME,
+        default=DB_NAME
+    )
+    parser.add_argument(
+        "--shard-id",
+        help="Run as shard N of a sharded deployment, see shards.py",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--shards",
+        help="Run as the router of the comma separated shard server URLs",
+        default=None
+    )
+    parser.add_argument(
+        "--replicas",
+        help="Serve GET routes from N read-only copies, 0 disables (default 0)",
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        "--replica-interval",
+        help="Seconds between replica snapshots (default 1)",
+        default=1.0,
+        type=float
+    )
+    parser.add_argument(
+        "--max-staleness",
+        help="Age in seconds above which GETs skip the replicas (default 5)",
+        default=5.0,
+        type=float
+    )
     parser.add_argument(
         "-s","--scaling",
         help="Enable large scale cleaning",
         default=False,
         action="store_true"
     )
+    parser.add_argument(
+        "--window",
+        help="Restaurants compared by /clean?strategy=sorted (default 10)",
+        default=10,
+        type=int
+    )
+    parser.add_argument(
+        "--address-threshold",
+        help="Minimum address similarity for /clean, 0 disables (default 0)",
+        default=0.0,
+        type=float
+    )
+    parser.add_argument(
+        "--address-weight",
+        help="Weight of the address against the name score (default 0)",
+        default=0.0,
+        type=float
+    )
+    parser.add_argument(
+        "--similarity-cache",
+        help="Jaro-Winkler scores memoized across cleans (default 200000)",
+        default=200000,
+        type=int
+    )
+    parser.add_argument(
+        "--persist-similarity",
+        help="Save memoized scores in ri_similarity and load them at start",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Record call counts and latencies, served on /metrics",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--audit-plans",
+        help="Explain every distinct statement and log full table scans",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--columnar",
+        help="Keep restaurant columns in memory for matching and cleaning",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds to cache GET responses for, 0 disables (default 5)",
+        default=5.0,
+        type=float
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="Binary snapshot of the restaurant store, mapped at startup "
+             "and rewritten after each clean (implies --columnar)",
+        default=None
+    )
+    parser.add_argument(
+        "--tweet-match",
+        help="Match tweets to restaurant names equal to an n-gram (exact, "
+             "the default) or found as a phrase through the full-text "
+             "index (fts)",
+        choices=("exact", "fts"),
+        default="exact"
+    )
+    parser.add_argument(
+        "--compress-violations",
+        help="Store inspection violations coded and compressed",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile-clean",
+        help="Profile every /clean run (or pass ?profile=1 to /clean)",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile-dir",
+        help="Directory for clean profiles (default profiles)",
+        default="profiles"
+    )
+    parser.add_argument(
+        "--prewarm",
+        help="Once the port is bound, import the matching modules, load "
+             "the --columnar store and the --persist-similarity scores in "
+             "the background instead of before serving",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--startup-profile",
+        help="Log the time of each import and initialization step once "
+             "the port is bound",
+        default=False,
+        action="store_true"
+    )
 
     # Create the parser argument object
     args = parser.parse_args()
+    startup.mark("arguments")
+    if args.shards:
+        from shards import ShardRouter
+        from shards import ThreadingWSGIServer
+        router.shards = ShardRouter(args.shards.split(","))
+        logging.info("Routing to %d shards", len(router.shards))
+        startup.mark("shard router")
+        server_class = ThreadingWSGIServer
+        if args.startup_profile:
+            server_class = startup.notify_bound(
+                server_class, functools.partial(serving, True, False, False))
+        router.run(host=args.host, port=args.port, server_class=server_class)
+        sys.exit(0)
     # Create the database connection and store it in the app object
-    app.db_connection = sqlite3.connect(DB_NAME)
+    # The group commit timer commits from its own thread.
+    app.db_connection = sqlite3.connect(args.database, check_same_thread=False,
+                                        cached_statements=CACHED_STATEMENTS)
     # See https://stackoverflow.com/questions/3300464/how-can-i-get-dict-from-sqlite-query
     app.db_connection.row_factory = dict_factory
+    startup.mark("connection")
     app.scaling = False
     if args.scaling:
         logging.info("Set to use large scale cleaning")
         app.scaling = True
+    app.window = args.window
+    app.address_threshold = args.address_threshold
+    app.address_weight = args.address_weight
+    app.similarity_cache_size = args.similarity_cache
+    app.persist_similarity = args.persist_similarity
+    if args.persist_similarity and not args.prewarm:
+        similarity_cache()
+        startup.mark("similarity cache")
+    if args.metrics:
+        logging.info("Recording metrics on /metrics")
+        metrics.enable(app, DB)
+    app.response_cache.ttl = args.cache_ttl
+    app.compress_violations = args.compress_violations
+    app.tweet_match = args.tweet_match
+    try:
+        filled = DB(app.db_connection).fill_match_keys()
+        if filled:
+            logging.info("Computed the match keys of %d restaurants", filled)
+    except Exception as e:
+        # No schema yet; /create makes the columns.
+        print(e, "error filling match keys")
+    startup.mark("match keys")
+    compress_violations()
+    startup.mark("violations")
+    app.snapshot_file = args.snapshot
+    # An in-memory database is only seen by the server's connection.
+    load_later = (args.prewarm and (args.columnar or args.snapshot)
+                  and database_file(app.db_connection))
+    if (args.columnar or args.snapshot) and not load_later:
+        logging.info("Keeping restaurant columns in memory")
+        start = time.time()
+        app.store = load_store(app.db_connection)
+        attach_store(app.db_connection, app.store)
+        logging.info("Loaded %d restaurants in %.3fs", len(app.store),
+                     time.time() - start)
+        startup.mark("store")
+    app.profile_clean = args.profile_clean
+    app.clean_jobs.recover(app.db_connection)
+    startup.mark("clean jobs")
+    if args.shard_id is not None:
+        from shards import first_restaurant_id
+        logging.info("Serving shard %d", args.shard_id)
+        app.shard_id = args.shard_id
+        try:
+            DB(app.db_connection).reserve_restaurant_ids(
+                first_restaurant_id(app.shard_id))
+        except Exception as e:
+            # No schema yet; /create reserves the ids.
+            print(e, "error reserving shard restaurant ids")
+    app.profile_dir = args.profile_dir
+    if args.audit_plans:
+        logging.info("Auditing query plans on /debug/query-plans")
+        plans.enable(app)
+    options = {}
+    if args.replicas > 0:
+        from replica import ReplicaSet
+        from shards import ThreadingWSGIServer
+        logging.info("Serving GETs from %d replicas", args.replicas)
+        app.replicas = ReplicaSet(args.database, args.replicas,
+                                  args.replica_interval, args.max_staleness)
+        app.replicas.start()
+        # Replica reads run on their own threads, next to the locked routes.
+        options["server_class"] = ThreadingWSGIServer
+        startup.mark("replicas")
+    if args.prewarm or args.startup_profile:
+        options["server_class"] = startup.notify_bound(
+            options.get("server_class"),
+            functools.partial(serving, args.startup_profile, args.prewarm,
+                              bool(load_later)))
     try:
         logging.info("Starting Inspection Service")
-        app.run(host=args.host, port=args.port)
+        app.run(host=args.host, port=args.port, **options)
     finally:
+        if app.replicas is not None:
+            app.replicas.stop()
         app.db_connection.close()
\ No newline at end of file
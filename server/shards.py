@@ -0,0 +1,132 @@
+"""
+Sharded deployment.
+
+Restaurants and their inspections are partitioned across shard servers,
+each an ordinary server.py process with its own database file, by the zip
+prefix of the restaurant (normalize.zip_prefix, the key blocking pairs
+candidates on). A restaurant, its inspections and every candidate it can
+be matched with by the blocking clean therefore live on one shard. Each
+shard hands out restaurant ids from its own range of SHARD_ID_SPAN ids, so
+the shard of a restaurant is read off its id.
+
+The router (server.py --shards) forwards a request to the shard that owns
+it and fans the rest out to every shard in parallel.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
+import json
+import urllib.error
+import urllib.request
+import zlib
+
+from normalize import zip_prefix
+
+# Restaurant ids of shard i are in (i * SHARD_ID_SPAN, (i + 1) * SHARD_ID_SPAN).
+SHARD_ID_SPAN = 1000000000
+
+# Seconds the router waits for a shard, long enough for a /clean.
+FORWARD_TIMEOUT = 600.0
+
+
+def shard_for_zip(zip_code, count):
+    """
+    Returns: the shard, out of count, owning the restaurants of a zip code.
+    """
+    return zlib.crc32(zip_prefix(zip_code).encode("utf-8")) % count
+
+
+def shard_for_restaurant(restaurant_id, count):
+    """
+    Returns: the shard that created a restaurant id, None when no shard
+             of count did.
+    """
+    shard = restaurant_id // SHARD_ID_SPAN
+    if 0 <= shard < count:
+        return shard
+    return None
+
+
+def first_restaurant_id(shard_id):
+    """
+    Returns: the id below every restaurant id of a shard.
+    """
+    return shard_id * SHARD_ID_SPAN
+
+
+class ShardReply:
+    """
+    A shard's response to a forwarded request.
+    """
+    def __init__(self, shard, status, headers, body):
+        self.shard = shard
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def json(self):
+        if not self.body:
+            return None
+        return json.loads(self.body)
+
+
+class ShardRouter:
+    """
+    The shard servers of a sharded deployment.
+
+    Inputs: urls (list) - base URL of each shard server, in shard id order
+    """
+    def __init__(self, urls):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.pool = ThreadPoolExecutor(max_workers=4 * len(self.urls))
+
+    def __len__(self):
+        return len(self.urls)
+
+    def for_zip(self, zip_code):
+        return shard_for_zip(zip_code, len(self.urls))
+
+    def for_restaurant(self, restaurant_id):
+        return shard_for_restaurant(restaurant_id, len(self.urls))
+
+    def call(self, shard, method, path, query="", body=None):
+        """
+        Sends a request to one shard.
+
+        Returns: the shard's ShardReply, status 502 when it is unreachable.
+        """
+        url = self.urls[shard] + path + ("?" + query if query else "")
+        req = urllib.request.Request(url, data=body, method=method)
+        if body is not None:
+            req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=FORWARD_TIMEOUT) as rv:
+                return ShardReply(shard, rv.status, rv.headers, rv.read())
+        except urllib.error.HTTPError as e:
+            return ShardReply(shard, e.code, e.headers, e.read())
+        except Exception as e:
+            print(e, "error calling shard", shard)
+            return ShardReply(shard, 502, {}, b"")
+
+    def fan_out(self, method, path, query="", body=None):
+        """
+        Sends the same request to every shard in parallel.
+
+        Returns: the replies, in shard order.
+        """
+        return list(self.pool.map(
+            lambda shard: self.call(shard, method, path, query, body),
+            range(len(self.urls))))
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    wsgiref server handling each request on its own thread, for the
+    router, which only waits on the shards, and for a server with
+    replicas.
+    """
+    daemon_threads = True
@@ -0,0 +1,262 @@
+"""
+Binary snapshots of the in-memory restaurant store.
+
+A snapshot holds everything RestaurantStore keeps: the restaurant columns
+with their match keys, the lower-cased name index and the primary/linked
+clusters. It is written after a clean and memory-mapped at startup, so a
+server started with --snapshot does not rebuild the store from
+ri_restaurants.
+
+Layout: the 8 byte MAGIC, a uint32 FORMAT_VERSION, a uint32 header length
+and a JSON header, then 8 byte aligned sections of fixed-width arrays in
+the machine's byte order. Text columns are uint32 indexes into a pool of
+distinct strings stored once, NUL separated, with their byte offsets;
+index 0 stands for NULL. The header records the data version of the
+database the snapshot was taken from (see data_version); a snapshot is
+only loaded when the database has not changed since apart from new, not
+cleaned restaurants, which are then read from the database.
+"""
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+from store import FloatColumn
+from store import FLOAT_COLUMNS
+from store import RestaurantStore
+from store import TEXT_COLUMNS
+from store import numpy_module
+
+MAGIC = b"RISNAP\x00\x00"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("=8sII")
+ALIGNMENT = 8
+
+
+def data_version(connection):
+    """
+    Identifies the restaurant data of a database: the epoch of its last
+    reset, the number of restaurants and of clean ones, the largest
+    restaurant id and the number of restaurants with a primary.
+    """
+    c = connection.cursor()
+    c.row_factory = None
+    try:
+        try:
+            epoch = c.execute("""SELECT value FROM ri_meta
+                              WHERE name = 'epoch'""").fetchone()
+        except Exception:
+            epoch = None
+        restaurants, clean, max_id = c.execute(
+            """SELECT COUNT(*), COALESCE(SUM(clean), 0), COALESCE(MAX(id), 0)
+               FROM ri_restaurants""").fetchone()
+        primaries = c.execute("SELECT COUNT(*) FROM ri_primary").fetchone()[0]
+    finally:
+        c.close()
+    return {"epoch": epoch[0] if epoch else None, "restaurants": restaurants,
+            "clean": clean, "max_id": max_id, "primaries": primaries}
+
+
+def float_bytes(column):
+    numpy = numpy_module()
+    if numpy is not None:
+        return column.view().astype(numpy.float64).tobytes()
+    return column.view().tobytes()
+
+
+def export(store, connection, snapshot_file):
+    """
+    Writes store to snapshot_file, replacing it atomically. connection
+    must see the same restaurants as the store.
+
+    Returns: the size of the file in bytes.
+    """
+    version = data_version(connection)
+    pool = {}
+    strings = []
+
+    def intern(value):
+        if value is None:
+            return 0
+        index = pool.get(value)
+        if index is None:
+            strings.append(value)
+            index = pool[value] = len(strings)
+        return index
+
+    sections = [("id", array("q", store.columns["id"]).tobytes()),
+                ("clean", bytes(store.columns["clean"]))]
+    for column in FLOAT_COLUMNS:
+        sections.append((column, float_bytes(store.columns[column])))
+    for column in TEXT_COLUMNS:
+        indexes = array("I", [intern(value) for value in store.columns[column]])
+        sections.append(("text:" + column, indexes.tobytes()))
+    name_keys = array("I")
+    name_ids = array("q")
+    for name, restaurant_ids in store.names.items():
+        key = intern(name)
+        for restaurant_id in restaurant_ids:
+            name_keys.append(key)
+            name_ids.append(restaurant_id)
+    sections.append(("name_keys", name_keys.tobytes()))
+    sections.append(("name_ids", name_ids.tobytes()))
+    primaries = array("q")
+    for restaurant_id, primary_id in store.primaries.items():
+        primaries.extend((restaurant_id, primary_id))
+    sections.append(("primaries", primaries.tobytes()))
+    clusters = array("q")
+    for primary_id, member_ids in store.clusters.items():
+        clusters.extend([primary_id, len(member_ids)] + list(member_ids))
+    sections.append(("clusters", clusters.tobytes()))
+    encoded = [value.encode("utf-8") for value in strings]
+    offsets = array("I", [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value) + 1)
+    sections.append(("pool_offsets", offsets.tobytes()))
+    sections.append(("pool", b"\x00".join(encoded)))
+
+    header = {"version": version, "byteorder": sys.byteorder,
+              "rows": len(store), "strings": len(strings), "sections": {}}
+    # Offsets are relative to the end of the header, known once it is built.
+    offset = 0
+    for name, data in sections:
+        header["sections"][name] = [offset, len(data)]
+        offset += len(data) + (-len(data) % ALIGNMENT)
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-(PREAMBLE.size + len(header_bytes)) % ALIGNMENT)
+
+    tmp_file = snapshot_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, data in sections:
+            f.write(data)
+            f.write(b"\x00" * (-len(data) % ALIGNMENT))
+    os.replace(tmp_file, snapshot_file)
+    return os.path.getsize(snapshot_file)
+
+
+class Snapshot:
+    """
+    A memory-mapped snapshot file.
+    """
+    def __init__(self, snapshot_file):
+        with open(snapshot_file, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size = PREAMBLE.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("not a version %d snapshot" % FORMAT_VERSION)
+        start = PREAMBLE.size
+        self.header = json.loads(bytes(self.map[start:start + header_size]))
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError("snapshot has another byte order")
+        self.base = start + header_size
+        self.rows = self.header["rows"]
+
+    def section(self, name):
+        offset, size = self.header["sections"][name]
+        return self.base + offset, size
+
+    def array(self, name, typecode):
+        offset, size = self.section(name)
+        values = array(typecode)
+        values.frombytes(self.map[offset:offset + size])
+        return values
+
+    def floats(self, name):
+        """
+        A FloatColumn over the section, mapped rather than copied when
+        NumPy is installed; the first append copies it.
+        """
+        column = FloatColumn()
+        numpy = numpy_module()
+        if numpy is not None and self.rows:
+            offset, size = self.section(name)
+            column.values = numpy.frombuffer(self.map, numpy.float64,
+                                             self.rows, offset)
+        else:
+            column.values = self.array(name, "d")
+        column.size = self.rows
+        return column
+
+    def strings(self):
+        """
+        Returns: the string pool as a list, None at index 0.
+        """
+        offset, size = self.section("pool")
+        count = self.header["strings"]
+        if not count:
+            return [None]
+        text = self.map[offset:offset + size].decode("utf-8")
+        values = text.split("\x00")
+        if len(values) != count:
+            # A string with a NUL in it; slice by the stored offsets.
+            raw = self.map[offset:offset + size]
+            offsets = self.array("pool_offsets", "I")
+            values = [raw[offsets[i]:offsets[i + 1] - 1].decode("utf-8")
+                      for i in range(count)]
+        return [None] + values
+
+
+def matches(version, current):
+    """
+    True when, since a snapshot of data version `version` was taken, the
+    database was not reset or cleaned; it may have new restaurants.
+    """
+    return (version["epoch"] == current["epoch"]
+            and version["clean"] == current["clean"]
+            and version["primaries"] == current["primaries"]
+            and current["max_id"] >= version["max_id"])
+
+
+def load(snapshot_file, connection):
+    """
+    Builds a store from a snapshot, adding the restaurants inserted since
+    it was taken.
+
+    Returns: the store, or None when the file is missing, unreadable or
+             does not match the database.
+    """
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        snapshot = Snapshot(snapshot_file)
+        version = snapshot.header["version"]
+        current = data_version(connection)
+        if not matches(version, current):
+            print("snapshot", snapshot_file, "is out of date")
+            return None
+        store = RestaurantStore()
+        store.snapshot = snapshot
+        store.columns["id"] = snapshot.array("id", "q")
+        offset, size = snapshot.section("clean")
+        store.columns["clean"] = bytearray(snapshot.map[offset:offset + size])
+        for column in FLOAT_COLUMNS:
+            store.columns[column] = snapshot.floats(column)
+        strings = snapshot.strings()
+        for column in TEXT_COLUMNS:
+            store.columns[column] = list(map(
+                strings.__getitem__, snapshot.array("text:" + column, "I")))
+        store.positions = dict(zip(store.columns["id"], range(snapshot.rows)))
+        for key, restaurant_id in zip(snapshot.array("name_keys", "I"),
+                                      snapshot.array("name_ids", "q")):
+            store.names.setdefault(strings[key], []).append(restaurant_id)
+        primaries = snapshot.array("primaries", "q")
+        store.primaries = dict(zip(primaries[::2], primaries[1::2]))
+        clusters = snapshot.array("clusters", "q")
+        i = 0
+        while i < len(clusters):
+            count = clusters[i + 1]
+            store.clusters[clusters[i]] = list(clusters[i + 2:i + 2 + count])
+            i += 2 + count
+        store.load_rows(connection, version["max_id"])
+    except Exception as e:
+        print(e, "error loading snapshot", snapshot_file)
+        return None
+    # Catches restaurants deleted, e.g. by a rollback, since the snapshot.
+    if len(store) != current["restaurants"]:
+        print("snapshot", snapshot_file, "is out of date")
+        return None
+    return store
@@ -0,0 +1,120 @@
+"""
+Startup timing of server.py.
+
+server.py tracks its imports from its first line: every module it imports
+is timed together with the modules that one imports in turn, so bottle's
+time includes the email and cgi modules it pulls in. The initialization
+steps after the imports are timed by mark(), and with --startup-profile
+report() lists both once the port is bound.
+
+Matching and cleaning modules (scoring and jellyfish, profiling, the
+sharding and replica modules, snapshots) are imported by the routes that
+use them rather than here, and --prewarm imports them in the background
+after the port is bound, see server.py. NumPy is imported by the first
+--columnar store built.
+"""
+import builtins
+import time
+
+STARTED = time.perf_counter()
+
+# Imports quicker than this were of modules already imported, and are left
+# out of the report.
+MIN_REPORTED = 0.00001
+
+# Seconds spent importing each module server.py imports, in import order.
+IMPORTS = {}
+# Initialization steps and their seconds, in order.
+STEPS = []
+
+# The builtin __import__ while track_imports() replaces it, and how many
+# imports deep the timed one is.
+original_import = None
+depth = 0
+last_mark = STARTED
+
+
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global depth
+    if depth:
+        return original_import(name, globals, locals, fromlist, level)
+    depth += 1
+    start = time.perf_counter()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        depth -= 1
+        IMPORTS[name] = IMPORTS.get(name, 0.0) + time.perf_counter() - start
+
+
+def track_imports():
+    """
+    Times the imports made until imported() is called.
+    """
+    global original_import
+    if original_import is None:
+        original_import = builtins.__import__
+        builtins.__import__ = timed_import
+
+
+def imported():
+    """
+    Stops timing imports; the initialization steps are timed from here.
+    """
+    global original_import, last_mark
+    if original_import is not None:
+        builtins.__import__ = original_import
+        original_import = None
+    last_mark = time.perf_counter()
+
+
+def mark(step):
+    """
+    Records the time since the previous mark, or since the imports, as
+    the time of an initialization step.
+    """
+    global last_mark
+    now = time.perf_counter()
+    STEPS.append((step, now - last_mark))
+    last_mark = now
+
+
+def elapsed():
+    """
+    Returns: seconds since server.py started importing.
+    """
+    return time.perf_counter() - STARTED
+
+
+def report():
+    """
+    Returns: the lines of the startup profile, the imports slowest first
+             then the initialization steps in order, in milliseconds.
+    """
+    lines = ["Started in %.1f ms: imports %.1f ms, initialization %.1f ms"
+             % (elapsed() * 1000, sum(IMPORTS.values()) * 1000,
+                sum(seconds for step, seconds in STEPS) * 1000)]
+    for name, seconds in sorted(IMPORTS.items(), key=lambda item: -item[1]):
+        if seconds < MIN_REPORTED:
+            break
+        lines.append("  import %-24s %8.2f ms" % (name, seconds * 1000))
+    for step, seconds in STEPS:
+        lines.append("  %-31s %8.2f ms" % (step, seconds * 1000))
+    return lines
+
+
+def notify_bound(server_class, callback):
+    """
+    Returns: a subclass of the WSGI server class server_class (the
+             wsgiref server when None) that calls callback once it
+             listens on its port.
+    """
+    if server_class is None:
+        from wsgiref.simple_server import WSGIServer as server_class
+
+    class BoundServer(server_class):
+        def server_activate(self):
+            super().server_activate()
+            callback()
+
+    return BoundServer
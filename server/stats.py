@@ -0,0 +1,208 @@
+"""
+Rollups of inspection results and tweet matches, served by /stats.
+
+ri_inspection_stats counts the inspections of every zip code, risk level
+and facility type in every month: one row per dimension, value and month,
+with how many inspections passed, passed with conditions and failed.
+ri_tweet_stats counts the tweets matched to each restaurant, by how they
+were matched. DB keeps both up to date as inspections and tweets are
+added and as a clean moves inspections to composite restaurants (see
+schema/create.sql), so /stats reads one row per group rather than
+scanning ri_inspections joined to ri_restaurants.
+
+The rollups are written one row per statement: a statement writing several
+rows opens a statement transaction, which makes FTS5 flush the terms it has
+pending for the search indexes, and that made ingest twice as slow.
+"""
+import re
+
+# The dimensions of ri_inspection_stats, and the column of an inspection i
+# or of its restaurant r each one is read from.
+DIMENSIONS = {"zip": "r.zip", "risk": "i.risk",
+              "facility_type": "r.facility_type"}
+
+# Restaurants /stats/tweets lists at most.
+MAX_RESTAURANTS = 1000
+
+# Every inspection is counted once under each dimension, so any one of them
+# gives the totals by month; the risk rows are the fewest.
+TOTALS_DIMENSION = "risk"
+
+# Counters of a group, and the inspection result each but the first counts.
+COUNTERS = ["inspections", "passed", "passed_with_conditions", "failed"]
+RESULTS = {"passed": "Pass", "passed_with_conditions": "Pass w/ Conditions",
+           "failed": "Fail"}
+
+# YYYY-MM of an inspection date, dates being MM/DD/YYYY in the city's data
+# and YYYY-MM-DD in schema/seed.sql; '' for anything else. month() is the
+# same in Python.
+MONTH = """CASE WHEN i.inspection_date GLOB
+                     '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]*'
+                THEN substr(i.inspection_date, 7, 4) || '-'
+                     || substr(i.inspection_date, 1, 2)
+                WHEN i.inspection_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'
+                THEN substr(i.inspection_date, 1, 7)
+                ELSE '' END"""
+
+MM_DD_YYYY = re.compile(r"[0-9]{2}/[0-9]{2}/[0-9]{4}")
+YYYY_MM = re.compile(r"[0-9]{4}-[0-9]{2}")
+
+# Adds counts to a group (dimension, value, month and the COUNTERS).
+ADD_COUNTS = """INSERT INTO ri_inspection_stats
+                (dimension, value, month, inspections, passed,
+                passed_with_conditions, failed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dimension, value, month) DO UPDATE SET
+                inspections = inspections + excluded.inspections,
+                passed = passed + excluded.passed,
+                passed_with_conditions = passed_with_conditions
+                                         + excluded.passed_with_conditions,
+                failed = failed + excluded.failed"""
+
+# The inspections of a JSON list of restaurants, with the zip code and the
+# facility type of their restaurant.
+MOVED_INSPECTIONS = """SELECT i.risk, i.inspection_date AS date, i.results,
+                       r.zip, r.facility_type
+                       FROM ri_inspections AS i
+                       JOIN ri_restaurants AS r ON r.id == i.restaurant_id
+                       WHERE i.restaurant_id IN
+                       (SELECT value FROM json_each(?))"""
+
+# Counts every inspection, into an empty ri_inspection_stats.
+COUNT_ALL = """INSERT INTO ri_inspection_stats
+               (dimension, value, month, inspections, passed,
+               passed_with_conditions, failed)
+               SELECT d.column1, coalesce(CASE d.column1 %s END, ''), %s,
+               COUNT(*), %s
+               FROM ri_inspections AS i
+               JOIN ri_restaurants AS r ON r.id == i.restaurant_id
+               CROSS JOIN (VALUES %s) AS d
+               GROUP BY 1, 2, 3""" % (
+    " ".join("WHEN '%s' THEN %s" % (dimension, column)
+             for dimension, column in DIMENSIONS.items()),
+    MONTH,
+    ", ".join("SUM(i.results IS '%s')" % RESULTS[counter]
+              for counter in COUNTERS[1:]),
+    ", ".join("('%s')" % dimension for dimension in DIMENSIONS))
+
+# Counts a tweet matched to a restaurant (the id and whether it matched by
+# name, by location or both).
+ADD_TWEET = """INSERT INTO ri_tweet_stats
+               (restaurant_id, tweets, name_matches, geo_matches, both_matches)
+               VALUES (?, 1, ?, ?, ?)
+               ON CONFLICT (restaurant_id) DO UPDATE SET
+               tweets = tweets + 1,
+               name_matches = name_matches + excluded.name_matches,
+               geo_matches = geo_matches + excluded.geo_matches,
+               both_matches = both_matches + excluded.both_matches"""
+COUNT_ALL_TWEETS = """INSERT INTO ri_tweet_stats
+                      (restaurant_id, tweets, name_matches, geo_matches,
+                      both_matches)
+                      SELECT restaurant_id, COUNT(*), SUM(match == 'name'),
+                      SUM(match == 'geo'), SUM(match == 'both')
+                      FROM ri_tweetmatch GROUP BY restaurant_id"""
+
+
+def month(date):
+    """
+    Returns: the YYYY-MM month of an inspection date, as MONTH reads it.
+    """
+    if not isinstance(date, str):
+        return ""
+    if MM_DD_YYYY.match(date):
+        return date[6:10] + "-" + date[0:2]
+    if YYYY_MM.match(date):
+        return date[:7]
+    return ""
+
+
+def inspection_counts(inspection, restaurant, sign=1):
+    """
+    Returns: the rows of ADD_COUNTS adding (sign 1) or taking out (sign -1)
+             an inspection of a restaurant with the given zip and
+             facility_type, one per dimension.
+    """
+    values = {"zip": restaurant.get("zip", None),
+              "risk": inspection.get("risk", None),
+              "facility_type": restaurant.get("facility_type", None)}
+    results = inspection.get("results", None)
+    counts = (month(inspection.get("date", None)), sign,
+              sign * (results == RESULTS["passed"]),
+              sign * (results == RESULTS["passed_with_conditions"]),
+              sign * (results == RESULTS["failed"]))
+    return [(dimension, "" if value is None else value) + counts
+            for dimension, value in values.items()]
+
+
+def moved_counts(inspections, composite):
+    """
+    Returns: the rows of ADD_COUNTS moving inspections, rows of
+             MOVED_INSPECTIONS, from the groups of their restaurants to
+             the groups of the composite they are merged into; the groups
+             that do not change, like those of the risk, are left out.
+    """
+    deltas = {}
+    for inspection in inspections:
+        for taken, added in zip(inspection_counts(inspection, inspection, -1),
+                                inspection_counts(inspection, composite)):
+            if taken[:2] == added[:2]:
+                continue
+            for row in (taken, added):
+                total = deltas.setdefault(row[:3], [0] * len(COUNTERS))
+                for index, count in enumerate(row[3:]):
+                    total[index] += count
+    return [key + tuple(counts) for key, counts in deltas.items()
+            if any(counts)]
+
+
+def group_by(text):
+    """
+    Reads the ?by= parameter of /stats/inspections: a comma separated list
+    of a dimension, month, both or neither.
+
+    Returns: the list of keys, raising ValueError when it is not one of
+             those.
+    """
+    keys = [key.strip() for key in (text or "").split(",") if key.strip()]
+    if len(set(keys)) != len(keys):
+        raise ValueError("repeated key in %r" % text)
+    if any(key != "month" and key not in DIMENSIONS for key in keys):
+        raise ValueError("unknown key in %r" % text)
+    if len([key for key in keys if key != "month"]) > 1:
+        raise ValueError("more than one dimension in %r" % text)
+    return keys
+
+
+def with_rates(group):
+    """
+    Adds the pass rate (passes with or without conditions) and the fail
+    rate of a group, out of its inspections that passed or failed. Both
+    are None when none did.
+    """
+    decided = (group["passed"] + group["passed_with_conditions"]
+               + group["failed"])
+    if decided:
+        group["pass_rate"] = (group["passed"]
+                              + group["passed_with_conditions"]) / decided
+        group["fail_rate"] = group["failed"] / decided
+    else:
+        group["pass_rate"] = group["fail_rate"] = None
+    return group
+
+
+def merge_groups(keys, groups):
+    """
+    Adds up the groups of several shards that have the same keys.
+
+    Returns: the merged groups ordered by their keys, with their rates.
+    """
+    merged = {}
+    for group in groups:
+        key = tuple(group[name] for name in keys)
+        total = merged.get(key)
+        if total is None:
+            merged[key] = {name: group[name] for name in keys + COUNTERS}
+        else:
+            for counter in COUNTERS:
+                total[counter] += group[counter]
+    return [with_rates(merged[key]) for key in sorted(merged)]
@@ -0,0 +1,281 @@
+"""
+Optional in-memory, column-oriented copy of ri_restaurants for matching.
+
+Tweet matching and cleaning only ever read a handful of restaurant columns,
+so with --columnar the server keeps those columns in memory and answers
+match_by_name, match_by_geo and the /clean candidate stage without SQL.
+Latitude and longitude are NumPy arrays when NumPy is installed (falling
+back to array.array and a Python loop), NumPy being imported by the first
+store built rather than at server start; text columns are lists of interned
+strings, and the store is kept in sync by DB.add_restaurant,
+DB.update_cleaned_restaurant and DB.add_cluster. The store also holds the
+clusters of ri_primary/ri_clusters, which DB.find_cluster reads from it.
+"""
+from array import array
+import functools
+import json
+import math
+import sys
+
+from normalize import KEY_COLUMNS
+from normalize import restaurant_keys
+
+TEXT_COLUMNS = ("name", "facility_type", "address", "city", "state",
+                "zip") + KEY_COLUMNS
+FLOAT_COLUMNS = ("latitude", "longitude")
+COLUMNS = ("id",) + TEXT_COLUMNS + FLOAT_COLUMNS + ("clean",)
+
+# The same bounding box DB.match_by_geo uses.
+GEO_LAT_DELTA = 0.00225001
+GEO_LON_DELTA = 0.00302190
+
+# Stores attached to connections, looked up by DB.__init__.
+STORES = {}
+
+
+def attach_store(connection, store):
+    """
+    Makes every DB built on connection read from and update store.
+    """
+    if store is None:
+        STORES.pop(connection, None)
+    else:
+        STORES[connection] = store
+
+
+@functools.lru_cache(maxsize=None)
+def numpy_module():
+    """
+    Returns: the numpy module, None when it is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def to_float(value):
+    if value is None or value == "":
+        return math.nan
+    return float(value)
+
+
+class FloatColumn:
+    """
+    Growable column of floats, NaN standing in for NULL.
+    """
+    def __init__(self):
+        numpy = numpy_module()
+        if numpy is not None:
+            self.values = numpy.empty(1024, dtype=numpy.float64)
+        else:
+            self.values = array("d")
+        self.size = 0
+
+    def append(self, value):
+        numpy = numpy_module()
+        if numpy is None:
+            self.values.append(value)
+        else:
+            if self.size == len(self.values):
+                grown = numpy.empty(len(self.values) * 2, dtype=numpy.float64)
+                grown[:self.size] = self.values[:self.size]
+                self.values = grown
+            self.values[self.size] = value
+        self.size += 1
+
+    def view(self):
+        return self.values[:self.size]
+
+    def __getitem__(self, index):
+        value = float(self.values[index])
+        return None if math.isnan(value) else value
+
+
+class StoreRow:
+    """
+    A row of the store, indexable by column name like the dict and
+    sqlite3.Row results the matching code was written against.
+    """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, column):
+        return self.store.columns[column][self.index]
+
+    def keys(self):
+        return list(COLUMNS)
+
+
+class RestaurantStore:
+    """
+    Column arrays of the restaurant table plus a lower-cased name index.
+    """
+    def __init__(self):
+        self.columns = {"id": array("q"), "clean": bytearray()}
+        for column in TEXT_COLUMNS:
+            self.columns[column] = []
+        for column in FLOAT_COLUMNS:
+            self.columns[column] = FloatColumn()
+        self.positions = {}
+        self.names = {}
+        # Restaurant id to the id of its primary, and primary id to the ids
+        # of the restaurants linked to it.
+        self.primaries = {}
+        self.clusters = {}
+        # The mapped snapshot the store was loaded from, see snapshot.py.
+        self.snapshot = None
+
+    @classmethod
+    def load(cls, connection):
+        """
+        Builds a store from the restaurants visible on connection.
+        """
+        store = cls()
+        try:
+            store.load_rows(connection)
+            store.load_clusters(connection)
+        except Exception as e:
+            # No schema yet; start empty.
+            print(e, "error loading restaurant store")
+        return store
+
+    def load_rows(self, connection, after_id=0):
+        """
+        Appends the restaurants with an id above after_id.
+        """
+        c = connection.cursor()
+        c.row_factory = None
+        try:
+            rows = c.execute("""SELECT id, %s, clean FROM ri_restaurants
+                                WHERE id > ? ORDER BY id"""
+                             % ", ".join(TEXT_COLUMNS + FLOAT_COLUMNS),
+                             [after_id])
+            for row in rows:
+                self.append(row[0], dict(zip(TEXT_COLUMNS + FLOAT_COLUMNS,
+                                             row[1:-1])), row[-1])
+        finally:
+            c.close()
+
+    def load_clusters(self, connection):
+        c = connection.cursor()
+        c.row_factory = None
+        try:
+            for restaurant_id, primary_id in c.execute(
+                    "SELECT restaurant_id, primary_rest_id FROM ri_primary"):
+                self.primaries[restaurant_id] = primary_id
+            for primary_id, member_ids in c.execute(
+                    "SELECT primary_rest_id, member_ids FROM ri_clusters"):
+                self.clusters[primary_id] = json.loads(member_ids)
+        finally:
+            c.close()
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def append(self, restaurant_id, data, clean=False):
+        """
+        Adds a restaurant row, data holding the same keys add_restaurant takes
+        and, optionally, its match keys (computed here when missing).
+        """
+        if "norm_name" not in data:
+            data = dict(data, **restaurant_keys(data))
+        index = len(self.columns["id"])
+        self.columns["id"].append(restaurant_id)
+        self.columns["clean"].append(1 if clean else 0)
+        for column in TEXT_COLUMNS:
+            value = data.get(column, None)
+            if value is not None:
+                value = sys.intern(str(value))
+            self.columns[column].append(value)
+        for column in FLOAT_COLUMNS:
+            self.columns[column].append(to_float(data.get(column, None)))
+        self.positions[restaurant_id] = index
+        name = data.get("name", None)
+        if name is not None:
+            self.names.setdefault(name.lower(), []).append(restaurant_id)
+
+    def set_clean(self, restaurant_ids):
+        for restaurant_id in restaurant_ids:
+            index = self.positions.get(int(restaurant_id))
+            if index is not None:
+                self.columns["clean"][index] = 1
+
+    def add_cluster(self, composite_id, restaurant_ids):
+        for restaurant_id in [composite_id] + list(restaurant_ids):
+            self.primaries[restaurant_id] = composite_id
+        self.clusters[composite_id] = list(restaurant_ids)
+
+    def row(self, index):
+        return StoreRow(self, index)
+
+    def cluster_ids(self, restaurant_id):
+        """
+        Resolves a restaurant's cluster without SQL.
+
+        Returns: (primary id, linked ids), or None if the restaurant does
+                 not exist.
+        """
+        if restaurant_id not in self.positions:
+            return None
+        primary_id = self.primaries.get(restaurant_id, restaurant_id)
+        return primary_id, self.clusters.get(primary_id, [])
+
+    def match_by_name(self, tweet_ngrams):
+        """
+        Returns the ids of restaurants whose lower-cased name is an n-gram.
+        """
+        rv = []
+        for ngram in set(tweet_ngrams):
+            rv.extend(self.names.get(ngram, ()))
+        return rv
+
+    def match_by_geo(self, lat, lon):
+        """
+        Returns the ids of restaurants inside the tweet's bounding box.
+        """
+        lat_lo, lat_hi = lat - GEO_LAT_DELTA, lat + GEO_LAT_DELTA
+        lon_lo, lon_hi = lon - GEO_LON_DELTA, lon + GEO_LON_DELTA
+        lats = self.columns["latitude"].view()
+        lons = self.columns["longitude"].view()
+        ids = self.columns["id"]
+        numpy = numpy_module()
+        if numpy is not None:
+            mask = ((lats >= lat_lo) & (lats <= lat_hi)
+                    & (lons >= lon_lo) & (lons <= lon_hi))
+            return [ids[i] for i in numpy.flatnonzero(mask)]
+        return [ids[i] for i in range(len(ids))
+                if lat_lo <= lats[i] <= lat_hi and lon_lo <= lons[i] <= lon_hi]
+
+    def not_clean(self):
+        clean = self.columns["clean"]
+        return [self.row(i) for i in range(len(clean)) if not clean[i]]
+
+    def all_rows(self):
+        return [self.row(i) for i in range(len(self))]
+
+    def candidates_within_block(self, chunk):
+        """
+        The store's version of DB.get_candidates_within_block: the block is
+        every restaurant whose block key is in chunk, and each not cleaned
+        restaurant of the block is paired with the block's restaurants
+        sharing its zip prefix.
+        """
+        letters = set(chunk)
+        keys = self.columns["block_key"]
+        zips = self.columns["zip_prefix"]
+        clean = self.columns["clean"]
+        by_zip = {}
+        mains = []
+        for i in range(len(self)):
+            if keys[i] not in letters:
+                continue
+            row = self.row(i)
+            by_zip.setdefault(zips[i], []).append(row)
+            if not clean[i]:
+                mains.append(row)
+        return [(row, by_zip[zips[row.index]]) for row in mains]
@@ -0,0 +1,150 @@
+"""
+Group commit for ingest.
+
+Writes are committed once size records are pending or, when an interval is
+set, once the oldest pending record has waited interval seconds, whichever
+comes first. The time-based flush runs on a background timer thread, so
+the last partial batch of a large /txn size is not left uncommitted until
+someone calls /commit. Request handlers and the timer take the same lock,
+installed around every route by GroupCommitPlugin, so the timer only
+commits between requests.
+"""
+import functools
+import threading
+import time
+
+
+class GroupCommit:
+    """
+    Size- and time-bounded commits of one connection.
+
+    Inputs: connection (callable) - returns the connection to commit
+            on_commit (callable) - called after each commit
+    """
+    def __init__(self, connection, on_commit=None, size=1, interval=0.0):
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+        self.size = size
+        self.interval = interval
+        self.connection = connection
+        self.on_commit = on_commit
+        self.pending = 0
+        self.oldest = None
+        self.timer = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.commits = {"size": 0, "timer": 0, "manual": 0}
+            self.records = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def configure(self, size, interval=0.0):
+        """
+        Commits what is pending and switches to the new policy.
+
+        Inputs: size (int) - records per commit
+                interval (float) - seconds a record may stay uncommitted,
+                                   0 for no time limit
+        """
+        with self.lock:
+            self.flush()
+            self.size = size
+            self.interval = interval
+            if interval > 0 and self.timer is None:
+                self.timer = threading.Thread(target=self.run, daemon=True)
+                self.timer.start()
+            self.wakeup.notify()
+
+    def added(self, n=1):
+        """
+        Records n pending writes and commits when the batch is full.
+        """
+        with self.lock:
+            if self.pending == 0:
+                self.oldest = time.monotonic()
+                self.wakeup.notify()
+            self.pending += n
+            if self.pending >= self.size:
+                self.flush("size")
+
+    def flush(self, reason="manual"):
+        """
+        Commits the pending writes, if any.
+        """
+        with self.lock:
+            if self.pending == 0:
+                return
+            self.connection().commit()
+            self.committed(reason)
+
+    def committed(self, reason="manual"):
+        """
+        Marks the pending writes as committed, for callers that committed
+        the connection themselves.
+        """
+        with self.lock:
+            if self.pending:
+                wait = time.monotonic() - self.oldest
+                self.commits[reason] += 1
+                self.records += self.pending
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            self.pending = 0
+            self.oldest = None
+            if self.on_commit is not None:
+                self.on_commit()
+
+    def discard(self):
+        """
+        Forgets the pending writes after a rollback.
+        """
+        with self.lock:
+            self.pending = 0
+            self.oldest = None
+
+    def run(self):
+        with self.lock:
+            while True:
+                if self.pending and self.interval > 0:
+                    left = self.oldest + self.interval - time.monotonic()
+                    if left <= 0:
+                        try:
+                            self.flush("timer")
+                        except Exception as e:
+                            print(e, "error in timed commit")
+                            self.discard()
+                        continue
+                    self.wakeup.wait(left)
+                else:
+                    self.wakeup.wait()
+
+    def stats(self):
+        with self.lock:
+            commits = sum(self.commits.values())
+            return {"size": self.size, "interval": self.interval,
+                    "pending": self.pending, "records": self.records,
+                    "commits": dict(self.commits),
+                    "avg_wait": round(self.wait_total / commits, 6) if commits else 0,
+                    "max_wait": round(self.wait_max, 6)}
+
+
+class GroupCommitPlugin:
+    """
+    Bottle plugin that runs every route holding the group commit lock.
+    """
+    name = "groupcommit"
+    api = 2
+
+    def __init__(self, group_commit):
+        self.group_commit = group_commit
+
+    def apply(self, callback, route):
+        lock = self.group_commit.lock
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            with lock:
+                return callback(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,316 @@
+"""
+Compressed storage of inspection violations.
+
+The violations of a Chicago inspection are numbered clauses separated by
+" | ", each a fixed heading ("32. FOOD AND NON-FOOD CONTACT SURFACES ...")
+and usually " - Comments: " with the inspector's free text. With coded
+violations (server.py --compress-violations) the column holds a BLOB
+instead of the text: the ids of the headings in ri_violation_clauses,
+followed by the comments deflated with a preset dictionary of the
+sentences most common in the database's comments, kept in ri_meta. The
+dictionary is built once, by compress(), when the database has enough
+comments to learn it from; until then comments are deflated without one.
+
+Rows are decoded in SQL by the violations_text() function registered on
+the connection, so the read paths return the same text as before. Plain
+text rows (written before the mode was turned on, or holding a NUL) are
+returned as they are.
+"""
+from collections import Counter
+import zlib
+
+CLAUSE_SEPARATOR = " | "
+COMMENTS_SEPARATOR = " - Comments: "
+
+# First byte of a coded value: how the comments that follow are stored.
+DEFLATED_ZDICT = b"\x01"
+STORED = b"\x02"
+DEFLATED = b"\x03"
+
+# Bytes of comment sentences in the preset dictionary.
+ZDICT_SIZE = 16384
+# Inspections whose comments the dictionary is built from, at least
+# MIN_TRAINING_ROWS of them.
+TRAINING_ROWS = 20000
+MIN_TRAINING_ROWS = 100
+COMPRESS_LEVEL = 6
+
+# The codec of each connection, None for a database with plain violations.
+CODECS = {}
+
+
+def codec_for(connection):
+    """
+    Returns: the ViolationCodec of connection, None when its database does
+             not store coded violations.
+    """
+    try:
+        return CODECS[connection]
+    except KeyError:
+        pass
+    codec = None
+    c = connection.cursor()
+    c.row_factory = None
+    try:
+        row = c.execute("""SELECT value FROM ri_meta
+                        WHERE name = 'violations'""").fetchone()
+        if row is not None and row[0] == "coded":
+            codec = ViolationCodec(connection)
+    except Exception as e:
+        # No schema yet.
+        print(e, "error reading violations mode")
+    finally:
+        c.close()
+    CODECS[connection] = codec
+    return codec
+
+
+def release(connection):
+    """
+    Forgets the codec of connection: after a reset or a rollback, which
+    can drop clause ids the codec handed out, and for connections that
+    are thrown away.
+    """
+    CODECS.pop(connection, None)
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def split_clause(clause):
+    """
+    Returns: (heading, comments), heading None when the clause is not a
+             numbered heading, comments None when it has none.
+    """
+    heading, separator, comments = clause.partition(COMMENTS_SEPARATOR)
+    if not separator:
+        comments = None
+    number, dot, _ = heading.partition(". ")
+    if not dot or not number.isdigit():
+        return None, clause
+    return heading, comments
+
+
+def train(texts, size=ZDICT_SIZE):
+    """
+    Builds the preset dictionary: the comment sentences that occur more
+    than once, most common last, where deflate finds them cheapest.
+    """
+    counts = Counter()
+    for text in texts:
+        for clause in text.split(CLAUSE_SEPARATOR):
+            heading, comments = split_clause(clause)
+            if comments:
+                counts.update(comments.split(". "))
+    picked = []
+    total = 0
+    for sentence, count in counts.most_common():
+        if count < 2:
+            break
+        if total + len(sentence) + 2 > size:
+            continue
+        picked.append(sentence)
+        total += len(sentence) + 2
+    return ". ".join(reversed(picked)).encode("utf-8")
+
+
+class ViolationCodec:
+    """
+    Encodes and decodes the violations of one connection's database.
+    """
+    def __init__(self, connection):
+        self.conn = connection
+        self.load_zdict()
+        self.headings = {}
+        self.ids = {}
+        self.load_clauses()
+        connection.create_function("violations_text", 1, self.decode,
+                                   deterministic=True)
+
+    def load_zdict(self):
+        c = self.conn.cursor()
+        c.row_factory = None
+        try:
+            row = c.execute("""SELECT value FROM ri_meta
+                            WHERE name = 'violations_zdict'""").fetchone()
+        finally:
+            c.close()
+        self.zdict = bytes(row[0]) if row is not None else b""
+        # Primed with the dictionary once; every value deflates on a copy.
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15,
+                                           8, zlib.Z_DEFAULT_STRATEGY,
+                                           self.zdict)
+
+    def load_clauses(self):
+        c = self.conn.cursor()
+        c.row_factory = None
+        try:
+            for clause_id, heading in c.execute(
+                    "SELECT id, clause FROM ri_violation_clauses"):
+                self.headings[clause_id] = heading
+                self.ids[heading] = clause_id
+        finally:
+            c.close()
+
+    def clause_id(self, heading):
+        clause_id = self.ids.get(heading)
+        if clause_id is None:
+            c = self.conn.cursor()
+            try:
+                c.execute("INSERT INTO ri_violation_clauses (clause) VALUES (?)",
+                          [heading])
+                clause_id = c.lastrowid
+            finally:
+                c.close()
+            self.ids[heading] = clause_id
+            self.headings[clause_id] = heading
+        return clause_id
+
+    def known(self, text):
+        """
+        Returns: False when coding a violations text would add headings to
+                 ri_violation_clauses.
+        """
+        if not text or not isinstance(text, str) or "\x00" in text:
+            return True
+        for clause in text.split(CLAUSE_SEPARATOR):
+            heading, comment = split_clause(clause)
+            if heading is not None and heading not in self.ids:
+                return False
+        return True
+
+    def encode(self, text):
+        """
+        Returns: the coded value of a violations text, the text itself when
+                 it is empty or cannot be coded.
+        """
+        if not text or not isinstance(text, str) or "\x00" in text:
+            return text
+        clauses = text.split(CLAUSE_SEPARATOR)
+        out = bytearray()
+        write_varint(out, len(clauses))
+        comments = []
+        for clause in clauses:
+            heading, comment = split_clause(clause)
+            clause_id = self.clause_id(heading) if heading is not None else 0
+            write_varint(out, clause_id << 1 | (comment is not None))
+            if comment is not None:
+                comments.append(comment)
+        data = "\x00".join(comments).encode("utf-8")
+        compressor = self.compressor.copy()
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data):
+            kind = DEFLATED_ZDICT if self.zdict else DEFLATED
+            return kind + bytes(out) + deflated
+        return STORED + bytes(out) + data
+
+    def decode(self, value):
+        """
+        Returns: the violations text of a stored value.
+        """
+        if not isinstance(value, bytes):
+            return value
+        count, offset = read_varint(value, 1)
+        codes = []
+        for _ in range(count):
+            code, offset = read_varint(value, offset)
+            codes.append(code)
+        data = value[offset:]
+        kind = value[:1]
+        if kind == DEFLATED_ZDICT and not self.zdict:
+            # Built by another connection since this one was opened.
+            self.load_zdict()
+        if kind != STORED:
+            decompressor = zlib.decompressobj(
+                -15, self.zdict if kind == DEFLATED_ZDICT else b"")
+            data = decompressor.decompress(data) + decompressor.flush()
+        comments = iter(data.decode("utf-8").split("\x00"))
+        clauses = []
+        for code in codes:
+            clause_id = code >> 1
+            if clause_id == 0:
+                clauses.append(next(comments))
+                continue
+            heading = self.headings.get(clause_id)
+            if heading is None:
+                # Written by another connection since the clauses were read.
+                self.load_clauses()
+                heading = self.headings[clause_id]
+            if code & 1:
+                heading += COMMENTS_SEPARATOR + next(comments)
+            clauses.append(heading)
+        return CLAUSE_SEPARATOR.join(clauses)
+
+
+def compress(connection, batch_size=1000):
+    """
+    Turns on coded violations for the database of connection and codes the
+    plain text rows. The preset dictionary is built from the violations
+    the first time there are MIN_TRAINING_ROWS of them; the rows deflated
+    without it before are then coded again.
+
+    Returns: the number of rows coded.
+    """
+    c = connection.cursor()
+    c.row_factory = None
+    try:
+        c.execute("""INSERT INTO ri_meta (name, value) VALUES ('violations', 'coded')
+                  ON CONFLICT (name) DO UPDATE SET value = excluded.value""")
+        connection.commit()
+        release(connection)
+        codec = codec_for(connection)
+        if not codec.zdict:
+            texts = [codec.decode(value) for value, in c.execute(
+                """SELECT violations FROM ri_inspections
+                   WHERE violations != '' LIMIT ?""", [TRAINING_ROWS])]
+            if len(texts) >= MIN_TRAINING_ROWS:
+                c.execute("""INSERT INTO ri_meta (name, value)
+                          VALUES ('violations_zdict', ?)""", [train(texts)])
+                connection.commit()
+                release(connection)
+                codec = codec_for(connection)
+    finally:
+        c.close()
+    # Rows deflated without the dictionary are coded again once it exists;
+    # without one, the rows already coded are left as they are.
+    recode = DEFLATED if codec.zdict else None
+    coded = 0
+    last = 0
+    while True:
+        c = connection.cursor()
+        c.row_factory = None
+        try:
+            rows = c.execute("""SELECT rowid, violations FROM ri_inspections
+                             WHERE rowid > ?
+                             AND (typeof(violations) = 'text'
+                                  AND violations != ''
+                                  OR substr(violations, 1, 1) == ?)
+                             ORDER BY rowid LIMIT ?""",
+                             [last, recode, batch_size]).fetchall()
+            if not rows:
+                break
+            values = [(codec.encode(codec.decode(value)), rowid)
+                      for rowid, value in rows]
+            c.executemany("""UPDATE ri_inspections SET violations = ?
+                          WHERE rowid = ?""", values)
+            connection.commit()
+        finally:
+            c.close()
+        last = rows[-1][0]
+        coded += sum(isinstance(value, bytes) for value, rowid in values)
+    return coded